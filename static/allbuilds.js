@@ -0,0 +1,66 @@
+/* Expand the compact build results sent for the all-builds page
+   (see BuildMatrix.encode) into tables of links to each build */
+
+function escape_html(s) {
+  return String(s).replace(/&/g, '&amp;').replace(/</g, '&lt;')
+                  .replace(/>/g, '&gt;').replace(/"/g, '&quot;');
+}
+
+function decode_build_results(results, ncells) {
+  var cells = new Array(ncells);
+  var re = /(\d*)([.pf])/g;
+  var match;
+  var pos = 0;
+  while ((match = re.exec(results)) !== null) {
+    var n = match[1] ? parseInt(match[1], 10) : 1;
+    for (var i = 0; i < n; ++i) {
+      cells[pos++] = match[2];
+    }
+  }
+  return cells;
+}
+
+function make_build_table(data, table) {
+  var systems = data.systems;
+  var html = ['<thead><tr><th>Build</th>'];
+  for (var j = 0; j < systems.length; ++j) {
+    html.push('<th><a href="' + escape_html(systems[j][2]) + '">'
+              + escape_html(systems[j][1]) + '</a></th>');
+  }
+  html.push('</tr></thead><tbody>');
+  var cells = decode_build_results(table.results,
+                                   table.builds.length * systems.length);
+  var pos = 0;
+  for (var i = 0; i < table.builds.length; ++i) {
+    var build = table.builds[i];
+    html.push('<tr><td class="builddate" title="">'
+              + escape_html(build[1]) + '</td>');
+    for (var j = 0; j < systems.length; ++j) {
+      var cell = cells[pos++];
+      if (cell == '.') {
+        html.push('<td>none</td>');
+      } else {
+        var url = data.root + systems[j][0] + '/build/' + build[0];
+        if (cell == 'p') {
+          html.push('<td><a class="buildbox build_ok" title="Build OK" href="'
+                    + url + '">&nbsp;</a></td>');
+        } else {
+          html.push('<td><a class="buildbox build_fail" '
+                    + 'title="Build failed" href="' + url
+                    + '">&nbsp;</a></td>');
+        }
+      }
+    }
+    html.push('</tr>');
+  }
+  html.push('</tbody>');
+  return html.join('');
+}
+
+function show_build_matrix(dataid) {
+  var data = JSON.parse(document.getElementById(dataid).textContent);
+  for (var branch in data.tables) {
+    var table = document.getElementById('allbuilds_' + branch);
+    table.innerHTML = make_build_table(data, data.tables[branch]);
+  }
+}
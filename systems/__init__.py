@@ -1,15 +1,23 @@
 import json
 import operator
 import itertools
-from flask import g, render_template, request, abort, redirect, url_for
-from .database import get_all_systems, add_all_build_results, ALL_BRANCHES
+from flask import (render_template, request, abort, redirect, url_for,
+                   stream_template)
+from .database import (get_all_systems, add_all_build_results, release_db,
+                       get_tag_index, get_build_window, get_build_matrix,
+                       has_newer_build,
+                       get_test_stderr, ALL_BRANCHES)
 from .app import app
+from .conditional import conditional_get, build_data_version, metadata_version
+from .badge import get_badge
+from .pages import (get_build_page_store, get_build_page_version,
+                    stored_page_response)
+from . import commands, compress, fragments  # noqa: F401
 
 
 @app.teardown_appcontext
 def close_db(error):
-    if hasattr(g, 'db_conn'):
-        g.db_conn.close()
+    release_db()
 
 
 @app.template_filter('timeformat')
@@ -26,12 +34,31 @@ def timeformat_filter(t):
     return "%d days" % t
 
 
+def stream_page(template_name, **context):
+    """Like render_template, but send the page to the client as it is
+       rendered rather than building it all in memory first"""
+    stream = stream_template(template_name, **context)
+    # Send the page in chunks rather than as individual template fragments
+    # (each of which would otherwise also be flushed separately when
+    # compressed)
+    size = app.config.get('STREAM_BUFFER_SIZE', 50)
+
+    def generate():
+        while True:
+            chunk = list(itertools.islice(stream, size))
+            if not chunk:
+                break
+            yield ''.join(chunk)
+    return app.response_class(generate(), mimetype='text/html')
+
+
 @app.errorhandler(500)
 def internal_error(error):
     return render_template('500.html'), 500
 
 
 @app.route('/')
+@conditional_get(build_data_version)
 def summary():
     # Permament (301) redirect to new badge URL
     sysstat = request.args.get('sysstat')
@@ -45,46 +72,68 @@ def summary():
 
     only_tag = request.args.get('tag')
     all_sys = get_all_systems()
-    tags = frozenset(itertools.chain.from_iterable(s.tags for s in all_sys))
+    tag_index = get_tag_index(all_sys)
     if only_tag:
-        all_sys = [s for s in all_sys if only_tag in s.tags]
-    add_all_build_results(all_sys)
+        names = tag_index.get(only_tag, frozenset())
+        all_sys = [s for s in all_sys if s.name in names]
+    add_all_build_results(all_sys, latest_only=True, all_systems=not only_tag)
     all_sys = sorted(all_sys, key=operator.attrgetter('name'))
     tested_sys = [s for s in all_sys if s.last_build_results]
     develop_sys = [s for s in all_sys if not s.last_build_results]
-    return render_template('summary.html', tested_systems=tested_sys,
-                           develop_systems=develop_sys,
-                           tags=sorted(tags, key=lambda x: x.lower()),
-                           only_tag=only_tag, top_level='summary')
+    return stream_page('summary.html', tested_systems=tested_sys,
+                       develop_systems=develop_sys,
+                       tags=sorted(tag_index.keys(), key=lambda x: x.lower()),
+                       only_tag=only_tag, top_level='summary')
 
 
 @app.route('/all-builds')
+@conditional_get(build_data_version)
 def all_builds():
+    branch = request.args.get('branch')
+    if branch is not None and branch not in ALL_BRANCHES:
+        abort(400)
+    default_limit = app.config.get('ALL_BUILDS_LIMIT', 60)
+    limit = request.args.get('limit', default_limit, type=int)
+    limit = max(1, min(limit, app.config.get('ALL_BUILDS_MAX_LIMIT', 1000)))
+    before = request.args.get('before', type=int)
+    since = request.args.get('since', type=int)
+    windows = [get_build_window(b, limit, before, since)
+               for b in ([branch] if branch else ALL_BRANCHES)]
     all_sys = get_all_systems()
-    add_all_build_results(all_sys)
+    matrices = [get_build_matrix(all_sys, w.builds) for w in windows]
     # Keep only systems with at least one build result, and sort by name
-    all_sys = sorted((s for s in all_sys if s.last_build_results),
+    tested = frozenset().union(*(m.get_tested_system_ids()
+                                 for m in matrices))
+    all_sys = sorted((s for s in all_sys if s.id in tested),
                      key=operator.attrgetter('name'))
-    all_results = {}
-    all_builds = {}
-    for branch in ALL_BRANCHES:
-        builds_by_id = {}
-        for system in all_sys:
-            for result in system.build_results[branch]:
-                builds_by_id[result.build.id] = result.build
-                all_results[(result.build.id, system.id)] = result
-        all_builds[branch] = [build for (build_id, build)
-                              in sorted(builds_by_id.items(),
-                                        key=operator.itemgetter(0))]
-    return render_template('all-builds.html', systems=all_sys,
-                           builds=all_builds, results=all_results,
-                           top_level="all_builds")
+    matrices = dict((w.branch, m.select_systems([s.id for s in all_sys]))
+                    for w, m in zip(windows, matrices))
+    limit = None if limit == default_limit else limit
+    if request.args.get('compact', type=int):
+        # Send only the encoded results and have the client make the tables
+        data = {'root': url_for('summary'),
+                'systems': [[s.id, s.name, s.homepage] for s in all_sys],
+                'tables': {}}
+        for w in windows:
+            builds, results = matrices[w.branch].encode()
+            data['tables'][w.branch] = {
+                'builds': [[b.id, b.imp_version or str(b.imp_date)]
+                           for b in builds],
+                'results': results}
+        return render_template('all-builds-compact.html', data=data,
+                               windows=windows, branch=branch, before=before,
+                               since=since, limit=limit,
+                               top_level="all_builds")
+    return stream_page('all-builds.html', systems=all_sys, windows=windows,
+                       matrices=matrices, limit=limit,
+                       top_level="all_builds")
 
 
 @app.route('/<int:system_id>')
+@conditional_get(build_data_version)
 def system_by_id(system_id):
     all_sys = get_all_systems(system_id)
-    add_all_build_results(all_sys)
+    add_all_build_results(all_sys, latest_only=True)
     if not all_sys:
         abort(404)
     return render_template('system.html', system=all_sys[0],
@@ -93,18 +142,66 @@ def system_by_id(system_id):
 
 @app.route('/<int:system_id>/build/<int:build_id>')
 def build_by_id(system_id, build_id):
+    page = request.args.get('page', 1, type=int)
+    if page < 1:
+        abort(404)
+    # Results of completed builds never change, so serve a stored page
+    # if we have one for the current metadata and templates (only the
+    # first page of tests is stored)
+    store = get_build_page_store() if page == 1 else None
+    if store:
+        all_sys = get_all_systems(system_id)
+        if not all_sys:
+            abort(404)
+        stored = store.get(system_id, build_id,
+                           get_build_page_version(all_sys[0]))
+        if stored is not None:
+            return stored_page_response(stored)
+    return _render_build_page(system_id, build_id, page, store)
+
+
+@conditional_get(build_data_version)
+def _render_build_page(system_id, build_id, page, store):
     all_sys = get_all_systems(system_id)
     if not all_sys:
         abort(404)
-    add_all_build_results(all_sys, build_id)
+    add_all_build_results(all_sys, build_id, info=True)
     # Should be exactly one build result
     results = list(itertools.chain.from_iterable(
         all_sys[0].build_results.values()))
     if len(results) != 1:
         abort(404)
-    tests = results[0].get_tests()
-    return render_template('build.html', system=all_sys[0], result=results[0],
-                           tests=tests)
+    # Show only a preview of each test's stderr; the full output can be
+    # obtained from test_stderr()
+    per_page = app.config.get('BUILD_TESTS_PER_PAGE', 100)
+    tests = results[0].get_tests(
+        offset=(page - 1) * per_page, limit=per_page + 1,
+        stderr_limit=app.config.get('STDERR_PREVIEW_SIZE', 2000))
+    if page > 1 and not tests:
+        abort(404)
+    rendered = render_template('build.html', system=all_sys[0],
+                               result=results[0], tests=tests[:per_page],
+                               page=page, has_next=len(tests) > per_page)
+    # A build is complete once a newer build of the same branch exists
+    if store and has_newer_build(results[0].build):
+        store.put(system_id, build_id, get_build_page_version(all_sys[0]),
+                  rendered.encode('utf-8'))
+    return rendered
+
+
+@app.route('/<int:system_id>/build/<int:build_id>/test/<int:test_id>/stderr')
+def test_stderr(system_id, build_id, test_id):
+    stderr = get_test_stderr(system_id, build_id, test_id)
+    if stderr is None:
+        abort(404)
+    response = app.response_class(stderr, mimetype='text/plain')
+    response.add_etag()
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config.get('CACHE_MAX_AGE', 300)
+    # Handles Range requests, so that large logs can be read in pieces
+    return response.make_conditional(
+        request, accept_ranges=True,
+        complete_length=response.content_length)
 
 
 @app.route('/<int:system_id>/badge.svg')
@@ -115,25 +212,18 @@ def badge(system_id):
         branch = 'main'
     if branch not in ALL_BRANCHES:
         abort(400)
-    all_sys = get_all_systems(system_id)
-    add_all_build_results(all_sys)
-    if not all_sys:
+    svg = get_badge(system_id, branch)
+    if svg is None:
         abort(404)
-    branch_labels = {'main': 'stable release',
-                     'develop': 'nightly build'}
-    url = "https://img.shields.io/badge/%s-" % branch_labels[branch]
-    passes = [r for r in all_sys[0].build_results[branch] if r.passed]
-    if passes:
-        build = passes[-1].build
-        txt = build.imp_version or str(build.imp_date)
-        txt = txt.replace("/", "%2F").replace('-', '--')
-        url += "%s-brightgreen.svg" % txt
-    else:
-        url += "never-red.svg"
-    return redirect(url, code=302)
+    response = app.response_class(svg, mimetype='image/svg+xml')
+    response.add_etag()
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config.get('BADGE_CACHE_TTL', 300)
+    return response.make_conditional(request)
 
 
 @app.route('/api/list')
+@conditional_get(metadata_version)
 def list_systems():
     def make_dict(s):
         return dict((k, getattr(s, k)) for k in ('name', 'repo', 'pmid',
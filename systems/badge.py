@@ -0,0 +1,58 @@
+import time
+from flask import render_template
+from .app import app
+from .cache import LRUCache
+from .database import get_all_systems, get_last_passed_build
+
+
+BRANCH_LABELS = {'main': 'stable release',
+                 'develop': 'nightly build'}
+
+# Approximate widths, in pixels, of characters in 11px Verdana
+_NARROW_CHARS = frozenset("fijlrt.,:;!'|()[] ")
+_WIDE_CHARS = frozenset("mwMW%@")
+
+
+def _get_text_width(text):
+    return sum(4 if c in _NARROW_CHARS else 10 if c in _WIDE_CHARS else 7
+               for c in text)
+
+
+def render_badge(label, message, color):
+    """Render a badge in the style of shields.io as an SVG string"""
+    label_width = _get_text_width(label) + 10
+    message_width = _get_text_width(message) + 10
+    return render_template('badge.svg', label=label, message=message,
+                           color=color, label_width=label_width,
+                           message_width=message_width,
+                           width=label_width + message_width)
+
+
+def _make_badge(system_id, branch):
+    if not get_all_systems(system_id):
+        return None
+    build = get_last_passed_build(system_id, branch)
+    if build:
+        return render_badge(BRANCH_LABELS[branch],
+                            build.imp_version or str(build.imp_date),
+                            '#4c1')
+    else:
+        return render_badge(BRANCH_LABELS[branch], 'never', '#e05d44')
+
+
+def get_badge(system_id, branch):
+    """Get the SVG badge showing the last build of the given branch that
+       the given system passed, or None if the system does not exist.
+       Badges are cached for BADGE_CACHE_TTL seconds."""
+    cache = app.extensions.get('badge_cache')
+    if cache is None:
+        cache = LRUCache(app.config.get('BADGE_CACHE_SIZE', 1000))
+        app.extensions['badge_cache'] = cache
+    key = (system_id, branch)
+    now = time.time()
+    cached = cache.get(key)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+    svg = _make_badge(system_id, branch)
+    cache.put(key, (now + app.config.get('BADGE_CACHE_TTL', 300), svg))
+    return svg
@@ -0,0 +1,235 @@
+import collections
+import glob
+import hashlib
+import os
+import tempfile
+import threading
+
+
+def _get_umask():
+    # The umask can only be read by setting it
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+# Get the umask once, since changing it is not thread safe
+_umask = _get_umask()
+
+
+def write_file_atomic(path, data):
+    """Write bytes to a file, creating its directory if necessary, such
+       that readers (including other processes) never see partial
+       contents. The file gets the usual permissions for new files
+       (rather than the private ones of temporary files), so that it
+       can be served by a web server running as another user."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(data)
+            os.fchmod(fh.fileno(), 0o666 & ~_umask)
+        os.replace(tmpname, path)
+    except BaseException:
+        os.unlink(tmpname)
+        raise
+
+
+class LRUCache(object):
+    """A thread-safe mapping of bounded size. When full, the least recently
+       used entries are discarded first."""
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return default
+            return self._data[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+def file_stamp(fname):
+    """Return a value that changes whenever the given file is modified,
+       or None if the file does not exist"""
+    try:
+        st = os.stat(fname)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+_RAISE = object()
+
+
+class FileCache(object):
+    """Cache of the parsed contents of files on disk. Each entry is
+       revalidated against the file's modification time and size, so
+       changes made to the file (e.g. by util/update_metadata.py) are
+       picked up immediately."""
+    def __init__(self, maxsize):
+        self._cache = LRUCache(maxsize)
+
+    def __len__(self):
+        return len(self._cache)
+
+    def load(self, fname, loader, missing=_RAISE, kind=None):
+        """Return loader(fname), or a cached copy if the file is unchanged
+           since it was last loaded. If the file does not exist, return
+           `missing` (if given). `kind` distinguishes between different
+           loaders of the same file."""
+        stamp = file_stamp(fname)
+        if stamp is None and missing is not _RAISE:
+            return missing
+        key = (fname, kind)
+        cached = self._cache.get(key)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        value = loader(fname)
+        self._cache.put(key, (stamp, value))
+        return value
+
+    def clear(self):
+        self._cache.clear()
+
+
+class DiskCache(object):
+    """A cache of byte strings stored as files in a directory, which can
+       be shared between processes. When more than `maxsize` entries are
+       stored, the least recently used are removed."""
+    def __init__(self, directory, maxsize):
+        self.directory, self.maxsize = directory, maxsize
+        self._puts = 0
+
+    def _get_path(self, key):
+        h = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, h[:2], h)
+
+    def __len__(self):
+        return sum(1 for _ in self._get_all_files())
+
+    def get(self, key, default=None):
+        path = self._get_path(key)
+        try:
+            with open(path, 'rb') as fh:
+                data = fh.read()
+        except FileNotFoundError:
+            return default
+        try:
+            # Mark as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return data
+
+    def put(self, key, value):
+        write_file_atomic(self._get_path(key), value)
+        # Checking the size of the cache is expensive, so only do it
+        # occasionally
+        self._puts += 1
+        if self._puts > self.maxsize // 10:
+            self._puts = 0
+            self.prune()
+
+    def delete(self, key):
+        try:
+            os.unlink(self._get_path(key))
+        except FileNotFoundError:
+            pass
+
+    def _get_all_files(self):
+        for subdir in glob.glob(os.path.join(self.directory, '??')):
+            for fname in os.listdir(subdir):
+                if not fname.startswith('.tmp'):
+                    yield os.path.join(subdir, fname)
+
+    def prune(self):
+        """Remove the least recently used entries if the cache is full"""
+        mtimes = []
+        for fname in self._get_all_files():
+            try:
+                mtimes.append((os.stat(fname).st_mtime, fname))
+            except FileNotFoundError:
+                pass
+        if len(mtimes) > self.maxsize:
+            mtimes.sort()
+            for mtime, fname in mtimes[:len(mtimes) - self.maxsize]:
+                try:
+                    os.unlink(fname)
+                except FileNotFoundError:
+                    pass
+
+    def clear(self):
+        for fname in self._get_all_files():
+            try:
+                os.unlink(fname)
+            except FileNotFoundError:
+                pass
+
+
+class PageStore(object):
+    """Persistent storage of rendered pages, one file per page, named by
+       system and build ID so that they can be selectively removed. Each
+       page is stored with a version token, and is only returned if the
+       token is unchanged."""
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _get_path(self, system_id, build_id):
+        return os.path.join(self.directory, str(system_id),
+                            '%d.html' % build_id)
+
+    def get(self, system_id, build_id, version):
+        """Get a stored page as bytes, or None if there is no page stored
+           with the given version"""
+        try:
+            with open(self._get_path(system_id, build_id), 'rb') as fh:
+                data = fh.read()
+        except FileNotFoundError:
+            return None
+        stored_version, _, page = data.partition(b'\n')
+        if stored_version.decode('utf-8') == version:
+            return page
+
+    def put(self, system_id, build_id, version, page):
+        write_file_atomic(self._get_path(system_id, build_id),
+                          version.encode('utf-8') + b'\n' + page)
+
+    def invalidate(self, system_id=None, build_id=None):
+        """Remove stored pages, optionally only those for the given system
+           and/or build. Return the number of pages removed."""
+        pattern = self._get_path('*' if system_id is None else system_id, 0)
+        if build_id is not None:
+            pattern = os.path.join(os.path.dirname(pattern),
+                                   '%d.html' % build_id)
+        else:
+            pattern = os.path.join(os.path.dirname(pattern), '*.html')
+        removed = 0
+        for fname in glob.glob(pattern):
+            try:
+                os.unlink(fname)
+                removed += 1
+            except FileNotFoundError:
+                pass
+        return removed
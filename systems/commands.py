@@ -0,0 +1,70 @@
+import click
+from .app import app
+from . import database, export
+from .pages import get_build_page_store
+
+
+@app.cli.command('update-results')
+@click.option('--rebuild', is_flag=True,
+              help='Recalculate all results, not just those of new builds')
+def update_results_command(rebuild):
+    """Update the summary table of system results in each build.
+
+    This should be run after each build completes."""
+    added = database.update_result_summary(rebuild)
+    click.echo("Added %d results" % added)
+
+
+@app.cli.command('invalidate-build-pages')
+@click.option('--system', type=int, help='Only remove pages for this system')
+@click.option('--build', type=int, help='Only remove pages for this build')
+def invalidate_build_pages_command(system, build):
+    """Remove stored build pages, so that they are rendered again.
+
+    This is only needed if the results of a completed build are changed."""
+    store = get_build_page_store()
+    if store is None:
+        raise click.ClickException("BUILD_PAGE_CACHE_DIR is not set")
+    removed = store.invalidate(system_id=system, build_id=build)
+    click.echo("Removed %d pages" % removed)
+
+
+@app.cli.command('archive-stderr')
+@click.option('--days', type=int, default=None,
+              help='Archive output of builds older than this many days '
+                   '(default STDERR_ARCHIVE_DAYS, or 90)')
+def archive_stderr_command(days):
+    """Move the stderr of tests in old builds into compressed storage."""
+    if days is None:
+        days = app.config.get('STDERR_ARCHIVE_DAYS', 90)
+    stats = database.archive_stderr(days)
+    click.echo("Archived stderr of %d tests (%d distinct outputs)"
+               % (stats.tests, stats.blobs))
+    click.echo("Saved %d bytes (%d bytes compressed to %d)"
+               % (stats.saved, stats.raw_size, stats.stored_size))
+
+
+@app.cli.command('export-static')
+@click.argument('target', type=click.Path(file_okay=False))
+@click.option('--base-url', default='http://localhost/',
+              help='URL at which the exported site will be served')
+@click.option('--full', is_flag=True,
+              help='Export every page, not just those that changed')
+@click.option('--jobs', '-j', type=int, default=1,
+              help='Number of processes to use')
+def export_static_command(target, base_url, full, jobs):
+    """Export the site as static files in TARGET.
+
+    The files can be served by Apache (using the generated .htaccess
+    file) without the database, e.g. as a mirror. Only pages that changed
+    since the last export are regenerated."""
+    result = export.export_site(target, base_url=base_url, full=full,
+                                jobs=max(1, jobs))
+    click.echo("%s export: wrote %d files for %d pages"
+               % ("Full" if result.full else "Incremental", result.written,
+                  len(result.pages)))
+    if result.failed:
+        raise click.ClickException(
+            "Failed to export: " + ", ".join(
+                "%s (%d)" % (page.url, status)
+                for page, status in result.failed))
@@ -0,0 +1,201 @@
+import gzip
+import mimetypes
+import os
+import zlib
+from flask import request, send_from_directory
+from werkzeug.security import safe_join
+from .app import app
+from .cache import LRUCache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Types of response that are worth compressing
+COMPRESSIBLE_TYPES = frozenset(['text/html', 'text/plain', 'text/css',
+                                'text/javascript', 'application/javascript',
+                                'application/json', 'image/svg+xml'])
+
+# File extension used for precompressed static files
+STATIC_SUFFIX = {'br': '.br', 'gzip': '.gz'}
+
+
+def get_encodings():
+    """Get the content encodings we support, most preferred first"""
+    return ['br', 'gzip'] if brotli else ['gzip']
+
+
+def negotiate_encoding(encodings=None):
+    """Get the best content encoding acceptable to the client, or None"""
+    if encodings is None:
+        encodings = get_encodings()
+    return request.accept_encodings.best_match(encodings)
+
+
+def compress(data, encoding):
+    """Compress a byte string with the given content encoding"""
+    if encoding == 'br':
+        return brotli.compress(data)
+    else:
+        # Fixed mtime, so that output depends only on the input
+        return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+class _StreamCompressor(object):
+    """Compress a stream of byte strings incrementally"""
+    def __init__(self, encoding):
+        if encoding == 'br':
+            self._c = brotli.Compressor()
+            self.compress, self.finish = self._c.process, self._c.finish
+            self.flush = self._c.flush
+        else:
+            # wbits=31 gives gzip rather than zlib format
+            self._c = zlib.compressobj(9, zlib.DEFLATED, 31)
+            self.compress, self.finish = self._c.compress, self._c.flush
+            self.flush = lambda: self._c.flush(zlib.Z_SYNC_FLUSH)
+
+
+def get_compress_cache():
+    """Get the process-wide cache of compressed response bodies"""
+    cache = app.extensions.get('compress_cache')
+    if cache is None:
+        cache = LRUCache(app.config.get('COMPRESS_CACHE_SIZE', 100))
+        app.extensions['compress_cache'] = cache
+    return cache
+
+
+def _get_cache_key(etag, encoding):
+    # ETags are only unique for a given URL
+    return (request.url, etag, encoding)
+
+
+def get_cached_response(etag):
+    """Get a response using a previously compressed body of the current
+       page with the given ETag, or None"""
+    encoding = negotiate_encoding()
+    if encoding is None:
+        return None
+    cached = get_compress_cache().get(_get_cache_key(etag, encoding))
+    if cached is None:
+        return None
+    content_type, body = cached
+    response = app.response_class(body, content_type=content_type)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def _weaken_etag(response):
+    # Compressed and uncompressed bodies are different representations
+    # so cannot share a strong ETag
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag(etag, weak=True)
+
+
+def _compress_stream(response, encoding, key):
+    """Get an iterable over the compressed body of a streamed response"""
+    original = response.response
+    chunks = response.iter_encoded()
+    cache = get_compress_cache() if key else None
+
+    def generate():
+        compressed = []
+        c = _StreamCompressor(encoding)
+        try:
+            for chunk in chunks:
+                # Flush so that the client gets each chunk as it is rendered
+                data = c.compress(chunk) + c.flush()
+                compressed.append(data)
+                yield data
+            data = c.finish()
+            compressed.append(data)
+            yield data
+            if cache is not None:
+                cache.put(key, (response.content_type,
+                                b''.join(compressed)))
+        finally:
+            if hasattr(original, 'close'):
+                original.close()
+    return generate()
+
+
+@app.after_request
+def compress_response(response):
+    """Compress responses if the client supports it. Compressed bodies
+       of responses with an ETag are cached, so that each version of a
+       page is only compressed once."""
+    if response.status_code == 304 and request.endpoint != 'static':
+        # Match the headers of the (possibly compressed) full response
+        response.vary.add('Accept-Encoding')
+        if negotiate_encoding() is not None:
+            _weaken_etag(response)
+        return response
+    if (response.status_code != 200 or response.direct_passthrough
+            or response.mimetype not in COMPRESSIBLE_TYPES
+            or 'Accept-Ranges' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    if 'Content-Encoding' in response.headers:
+        # Already compressed (e.g. from get_cached_response)
+        _weaken_etag(response)
+        return response
+    if (not response.is_streamed and response.content_length
+            < app.config.get('COMPRESS_MIN_SIZE', 500)):
+        return response
+    encoding = negotiate_encoding()
+    if encoding is None:
+        return response
+    etag = response.get_etag()[0]
+    key = _get_cache_key(etag, encoding) if etag else None
+    if response.is_streamed:
+        response.response = _compress_stream(response, encoding, key)
+        response.headers.pop('Content-Length', None)
+    else:
+        cache = get_compress_cache()
+        cached = cache.get(key) if key else None
+        if cached is None:
+            body = compress(response.get_data(), encoding)
+            if key:
+                cache.put(key, (response.content_type, body))
+        else:
+            body = cached[1]
+        response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    _weaken_etag(response)
+    return response
+
+
+def static_file(filename):
+    """Serve a static file, using a precompressed copy if one is available
+       (see util/precompress.py)"""
+    path = safe_join(app.static_folder, filename)
+    try:
+        mtime = os.stat(path).st_mtime
+    except (TypeError, OSError):
+        mtime = None
+    available = []
+    if mtime is not None:
+        for encoding in get_encodings():
+            try:
+                # Ignore out of date compressed files
+                if os.stat(path + STATIC_SUFFIX[encoding]).st_mtime >= mtime:
+                    available.append(encoding)
+            except FileNotFoundError:
+                pass
+    encoding = negotiate_encoding(available) if available else None
+    if encoding is None:
+        response = send_from_directory(app.static_folder, filename)
+    else:
+        mimetype = mimetypes.guess_type(filename)[0]
+        response = send_from_directory(
+            app.static_folder, filename + STATIC_SUFFIX[encoding],
+            mimetype=mimetype or 'application/octet-stream')
+        response.headers['Content-Encoding'] = encoding
+    if available:
+        response.vary.add('Accept-Encoding')
+    return response
+
+
+app.view_functions['static'] = static_file
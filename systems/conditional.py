@@ -0,0 +1,104 @@
+import datetime
+import functools
+import glob
+import hashlib
+import os
+from flask import request, make_response
+from werkzeug.http import is_resource_modified
+from .app import app
+from .cache import file_stamp
+from .compress import get_cached_response
+from . import database
+
+
+_code_version = None
+
+
+def get_code_version():
+    """Get a token that changes whenever the application is redeployed, so
+       that pages are not considered current if their templates change"""
+    global _code_version
+    if _code_version is None:
+        top = os.path.dirname(__file__)
+        fnames = sorted(glob.glob(os.path.join(top, '*.py'))
+                        + glob.glob(os.path.join(top, 'templates', '*')))
+        _code_version = hashlib.sha1(repr(
+            [(f, file_stamp(f)) for f in fnames]).encode()).hexdigest()
+    return _code_version
+
+
+def _timestamp_to_datetime(t):
+    return datetime.datetime.fromtimestamp(t, tz=datetime.timezone.utc)
+
+
+def get_metadata_version():
+    """Get a token that changes whenever any system metadata changes, and
+       the time of the last change"""
+    top = app.config['SYSTEM_TOP']
+    stamp = file_stamp(os.path.join(top, 'index.json'))
+    if stamp is not None:
+        # util/update_metadata.py rewrites the index after updating
+        # any system
+        return stamp, _timestamp_to_datetime(stamp[0] / 1e9)
+    # No index, so check every system's files
+    stamps = sorted((f, file_stamp(f))
+                    for f in glob.glob(os.path.join(top, '*', '*')))
+    mtime = max((s[0] for f, s in stamps if s), default=None)
+    return (hashlib.sha1(repr(stamps).encode()).hexdigest(),
+            None if mtime is None else _timestamp_to_datetime(mtime / 1e9))
+
+
+def build_data_version(*args, **kwargs):
+    """Version of a page that depends on build results and metadata. No
+       modification time is given, since the database records no time at
+       which results were added to a build (build dates only have day
+       resolution), so only the ETag can be used."""
+    build_id, build_date, ntest = database.get_build_version()
+    meta, meta_time = get_metadata_version()
+    return (build_id, build_date, ntest, meta), None
+
+
+def metadata_version(*args, **kwargs):
+    """Version of a page that depends only on system metadata"""
+    meta, meta_time = get_metadata_version()
+    return (meta,), meta_time
+
+
+def conditional_get(get_version):
+    """Decorator to add conditional GET support to a view function.
+       `get_version` is called with the same arguments as the view, and
+       should cheaply return a token that changes whenever the page
+       does, plus the last modification time (or None, in which case no
+       Last-Modified header is sent). If the client already has the
+       current version, a 304 response is sent without calling the
+       view."""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            token, last_modified = get_version(*args, **kwargs)
+            etag = hashlib.sha1(repr((token, get_code_version())).encode()
+                                ).hexdigest()
+            if not is_resource_modified(request.environ, etag=etag,
+                                        last_modified=last_modified):
+                response = app.response_class(status=304)
+            else:
+                # Use an already-compressed copy of this version of the
+                # page if we have one, rather than making it again
+                response = get_cached_response(etag)
+                if response is None:
+                    response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            # The view may have set its own validators
+            if response.get_etag()[0] is None:
+                response.set_etag(etag)
+                # Note that setting None would give the current time
+                if last_modified is not None:
+                    response.last_modified = last_modified
+            if response.cache_control.max_age is None:
+                response.cache_control.public = True
+                response.cache_control.max_age = app.config.get(
+                    'CACHE_MAX_AGE', 300)
+            return response
+        return wrapper
+    return decorator
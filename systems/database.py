@@ -1,15 +1,96 @@
 import MySQLdb
 import os
+import collections
+import datetime
+import hashlib
+import itertools
+import operator
+import threading
+import time
 import json
+import zlib
 import yaml
 from flask import g
 from markupsafe import Markup
 from .prerequisites import ALL_PREREQS
+from .cache import FileCache, file_stamp
 from .app import app
 
 
 ALL_BRANCHES = ['main', 'develop']
 
+# Number of characters of each test's standard error that archive_stderr()
+# keeps uncompressed, so that previews don't need the compressed output
+STDERR_ARCHIVE_PREVIEW_SIZE = 4000
+
+_file_cache = None
+
+
+def get_file_cache():
+    """Get the process-wide cache of system metadata files"""
+    global _file_cache
+    if _file_cache is None:
+        _file_cache = FileCache(app.config.get('FILE_CACHE_SIZE', 2000))
+    return _file_cache
+
+
+def _load_json(fname):
+    with open(fname, encoding='utf-8') as fh:
+        return json.load(fh)
+
+
+def get_index():
+    """Get the consolidated index of all systems' metadata, written by
+       util/update_metadata.py, as a dict keyed by system name. This is
+       empty if no index has been written."""
+    fname = os.path.join(app.config['SYSTEM_TOP'], 'index.json')
+    return get_file_cache().load(fname, _load_json, missing={})
+
+
+def get_index_digests():
+    """Get a dict mapping system names to a digest of each system's entry
+       in the consolidated index"""
+    def make_digests(fname):
+        # Parse the file given, not a copy of the index read earlier, so
+        # that the digests match the file stamp they are cached under
+        return dict((name, hashlib.sha1(json.dumps(entry, sort_keys=True)
+                                        .encode('utf-8')).hexdigest())
+                    for name, entry in _load_json(fname).items())
+    fname = os.path.join(app.config['SYSTEM_TOP'], 'index.json')
+    return get_file_cache().load(fname, make_digests, missing={},
+                                 kind='digests')
+
+
+def _make_tag_index(tags_by_name):
+    index = {}
+    for name, tags in tags_by_name:
+        for tag in tags or []:
+            index.setdefault(tag, set()).add(name)
+    return index
+
+
+def get_tag_index(systems):
+    """Get a dict mapping each tag to the set of names of systems with that
+       tag. Where possible this is built from the consolidated index, so
+       that no per-system metadata needs to be read."""
+    def make_tag_index(fname):
+        index = _load_json(fname)
+        return (_make_tag_index((name, entry['tags'])
+                                for name, entry in index.items()),
+                frozenset(index.keys()))
+    fname = os.path.join(app.config['SYSTEM_TOP'], 'index.json')
+    tag_index, indexed = get_file_cache().load(
+        fname, make_tag_index, missing=({}, frozenset()), kind='tags')
+    # Add any systems not (yet) in the index
+    extra = _make_tag_index((s.name, s.tags) for s in systems
+                            if s.name not in indexed)
+    if extra:
+        tag_index = dict((tag, names.copy())
+                         for tag, names in tag_index.items())
+        for tag, names in extra.items():
+            tag_index.setdefault(tag, set()).update(names)
+    return tag_index
+
 
 def connect_db():
     conn = MySQLdb.connect(host=app.config['HOST'], user=app.config['USER'],
@@ -18,18 +99,105 @@ def connect_db():
     return conn
 
 
+class ConnectionPool(object):
+    """A pool of open database connections, reused across requests
+       within a single process"""
+    def __init__(self, connect, size, max_idle):
+        self.connect, self.size, self.max_idle = connect, size, max_idle
+        # Idle connections and the time they were returned to the pool,
+        # most recently used last
+        self._idle = collections.deque()
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Get a working connection from the pool, or open a new one"""
+        while True:
+            with self._lock:
+                # Drop connections that have been idle for too long, since
+                # the server may have closed them
+                cutoff = time.time() - self.max_idle
+                while self._idle and self._idle[0][1] < cutoff:
+                    self._close(self._idle.popleft()[0])
+                if not self._idle:
+                    break
+                conn, last_used = self._idle.pop()
+            try:
+                conn.ping()
+                return conn
+            except MySQLdb.Error:
+                self._close(conn)
+        return self.connect()
+
+    def put(self, conn):
+        """Return a connection to the pool, or close it if the pool is
+           already full"""
+        try:
+            # End any open transaction, so that the next user of this
+            # connection sees up-to-date data
+            conn.rollback()
+        except MySQLdb.Error:
+            self._close(conn)
+            return
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append((conn, time.time()))
+                return
+        self._close(conn)
+
+    def close(self):
+        """Close all idle connections"""
+        with self._lock:
+            while self._idle:
+                self._close(self._idle.pop()[0])
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except MySQLdb.Error:
+            pass
+
+
+def get_pool():
+    """Get the process-wide database connection pool"""
+    pool = app.extensions.get('db_pool')
+    if pool is None:
+        pool = ConnectionPool(connect_db,
+                              size=app.config.get('DB_POOL_SIZE', 5),
+                              max_idle=app.config.get('DB_POOL_MAX_IDLE',
+                                                      300))
+        app.extensions['db_pool'] = pool
+    return pool
+
+
+def forget_pool():
+    """Discard the connection pool without closing its connections. This
+       should be called in a child process after a fork, since the
+       inherited connections are still in use by the parent."""
+    app.extensions.pop('db_pool', None)
+
+
 def get_db():
-    """Open a new database connection if necessary"""
+    """Get a database connection from the pool if necessary"""
     if not hasattr(g, 'db_conn'):
-        g.db_conn = connect_db()
+        g.db_conn = get_pool().get()
     return g.db_conn
 
 
+def release_db():
+    """Return the current database connection (if any) to the pool"""
+    conn = g.pop('db_conn', None)
+    if conn is not None:
+        get_pool().put(conn)
+
+
 class Test(object):
     """Information about an individual test (see BuildResult.get_tests)"""
-    def __init__(self, name, retcode, stderr, runtime):
+    def __init__(self, name, retcode, stderr, runtime, id=None,
+                 stderr_truncated=False):
         self.name, self.retcode = name, retcode
         self.stderr, self.runtime = stderr, runtime
+        self.id, self.stderr_truncated = id, stderr_truncated
 
 
 class BuildResult(object):
@@ -38,19 +206,73 @@ class BuildResult(object):
         self.build, self.passed = build, passed
         self._system_id = system.id
 
-    def get_tests(self):
-        """Get detailed result information as a set of Test objects"""
+    def iter_tests(self, offset=0, limit=None, stderr_limit=None):
+        """Yield detailed result information as Test objects, as they are
+           read from the database. No other queries can be made on the
+           same connection until iteration is finished.
+           If `limit` is given, return at most that many tests, starting
+           at `offset` (tests are sorted by name). If `stderr_limit` is
+           given, return only the first `stderr_limit` characters of the
+           standard error of failed tests (and none for passed tests),
+           and set `stderr_truncated` if there is more; use
+           get_test_stderr() to get the full output."""
+        # Short previews of archived output can be taken from the
+        # uncompressed preview, without reading the compressed output
+        use_preview = (stderr_limit is not None
+                       and stderr_limit < STDERR_ARCHIVE_PREVIEW_SIZE)
+        archive, archive_blob = _get_stderr_archive_join(blob=not use_preview)
+        if use_preview and archive:
+            stderr = "COALESCE(sys_test.stderr,sys_stderr_archive.preview)"
+        else:
+            stderr = "sys_test.stderr"
+        if stderr_limit is None:
+            args = ()
+        else:
+            # Get one character more than needed to tell if truncated
+            stderr = ("CASE WHEN retcode=0 THEN NULL "
+                      "ELSE SUBSTR(%s,1,%%s) END" % stderr)
+            args = (stderr_limit + 1,)
+            if archive_blob != 'NULL':
+                archive_blob = ("CASE WHEN retcode=0 THEN NULL ELSE %s END"
+                                % archive_blob)
+        query = ("SELECT sys_test_name.id id,sys_test_name.name name,"
+                 "retcode," + stderr + " stderr," + archive_blob
+                 + " stderr_blob,runtime FROM sys_test INNER JOIN "
+                 "sys_test_name ON sys_test_name.id=sys_test.name "
+                 "AND sys_test_name.sys=sys_test.sys" + archive
+                 + " WHERE sys_test.build=%s AND sys_test.sys=%s "
+                 "ORDER BY sys_test_name.name")
+        args += (self.build.id, self._system_id)
+        if limit is not None:
+            query += " LIMIT %s OFFSET %s"
+            args += (limit, offset)
         conn = get_db()
-        c = MySQLdb.cursors.DictCursor(conn)
-        c.execute("SELECT sys_test_name.name name,retcode,stderr,runtime "
-                  "FROM sys_test,sys_test_name WHERE build=%s AND "
-                  "sys_test.sys=%s AND sys_test_name.id=sys_test.name AND "
-                  "sys_test_name.sys=%s",
-                  (self.build.id, self._system_id, self._system_id))
-        return [Test(**x) for x in c]
+        c = MySQLdb.cursors.SSDictCursor(conn)
+        try:
+            c.execute(query, args)
+            for x in c:
+                x = dict(x)
+                blob = x.pop('stderr_blob')
+                if blob is not None:
+                    x['stderr'] = _decompress_stderr(blob)
+                t = Test(**x)
+                if (stderr_limit is not None and t.stderr is not None
+                        and len(t.stderr) > stderr_limit):
+                    t.stderr = t.stderr[:stderr_limit]
+                    t.stderr_truncated = True
+                yield t
+        finally:
+            c.close()
+
+    def get_tests(self, offset=0, limit=None, stderr_limit=None):
+        """Get detailed result information as a list of Test objects.
+           See iter_tests() for the arguments."""
+        return list(self.iter_tests(offset, limit, stderr_limit))
 
     @property
     def _info(self):
+        # Normally filled in by add_build_info(); query for just this
+        # result only as a fallback
         if not hasattr(self, '_info_internal'):
             conn = get_db()
             c = MySQLdb.cursors.DictCursor(conn)
@@ -67,6 +289,9 @@ class BuildResult(object):
 
 class Build(object):
     """A run over all Systems with a given configuration"""
+    __slots__ = ('id', 'imp_branch', 'imp_date', 'imp_version',
+                 'imp_githash', 'modeller_version')
+
     def __init__(self, id, imp_branch, imp_date, imp_version,
                  imp_githash, modeller_version):
         self.id, self.imp_branch = id, imp_branch
@@ -87,43 +312,59 @@ class System(object):
                     for (branch, results) in self.build_results.items()
                     if results)
 
+    @property
+    def _index_entry(self):
+        """Information about this system from the index, or None if it is
+           not in the index (in which case individual files are read)"""
+        return get_index().get(self.name)
+
+    @property
+    def metadata_version(self):
+        """A token that changes whenever this system's metadata does"""
+        digest = get_index_digests().get(self.name)
+        if digest:
+            return digest
+        return tuple(file_stamp(os.path.join(app.config['SYSTEM_TOP'],
+                                             self.name, f))
+                     for f in ('metadata.yaml', 'github.json', 'pubmed.json',
+                               'thumb.png'))
+
+    def _load_file(self, filename, loader, **keys):
+        """Load a file from this system's metadata directory, via the
+           process-wide file cache"""
+        fname = os.path.join(app.config['SYSTEM_TOP'], self.name, filename)
+        return get_file_cache().load(fname, loader, **keys)
+
     @property
     def _metadata(self):
-        if not hasattr(self, '_metadata_internal'):
-            meta = os.path.join(app.config['SYSTEM_TOP'], self.name,
-                                'metadata.yaml')
-            with open(meta, encoding='utf-8') as fh:
-                self._metadata_internal = yaml.safe_load(fh)
-                if self._metadata_internal is None:
-                    raise ValueError("Empty metadata for %s" % self.name)
-        return self._metadata_internal
+        entry = self._index_entry
+        if entry:
+            return entry['metadata']
+
+        def loader(fname):
+            with open(fname, encoding='utf-8') as fh:
+                meta = yaml.safe_load(fh)
+            if meta is None:
+                raise ValueError("Empty metadata for %s" % self.name)
+            return meta
+        return self._load_file('metadata.yaml', loader)
 
     @property
     def readme(self):
-        if not hasattr(self, '_readme_internal'):
-            readme = os.path.join(app.config['SYSTEM_TOP'], self.name,
-                                  'readme.html')
-            if os.path.exists(readme):
-                with open(readme, 'rb') as fh:
-                    self._readme_internal = fh.read().decode('utf-8')
-            else:
-                self._readme_internal = ''
-        return self._readme_internal
+        def loader(fname):
+            with open(fname, 'rb') as fh:
+                return fh.read().decode('utf-8')
+        return self._load_file('readme.html', loader, missing='')
 
     @property
     def _pubmed(self):
-        if not hasattr(self, '_pubmed_internal'):
-            pubmed = os.path.join(app.config['SYSTEM_TOP'], self.name,
-                                  'pubmed.json')
-            if os.path.exists(pubmed):
-                with open(pubmed, encoding='utf-8') as fh:
-                    self._pubmed_internal = json.load(fh)
-            else:
-                self._pubmed_internal = None
-        return self._pubmed_internal
+        return self._load_file('pubmed.json', _load_json, missing=None)
 
     @property
     def pubmed_title(self):
+        entry = self._index_entry
+        if entry:
+            return entry['pubmed_title']
         p = self._pubmed
         if p:
             pmid = p['result']['uids'][0]
@@ -141,22 +382,22 @@ class System(object):
 
     @property
     def _github(self):
-        if not hasattr(self, '_github_internal'):
-            gh = os.path.join(app.config['SYSTEM_TOP'], self.name,
-                              'github.json')
-            with open(gh, encoding='utf-8') as fh:
-                j = json.load(fh)
-            # Workaround broken repo info
-            if self.name == 'fly_genome':
-                j['homepage'] = \
-                    'https://integrativemodeling.org/systems/22'
-            self._github_internal = j
-        return self._github_internal
+        entry = self._index_entry
+        j = entry['github'] if entry else self._load_file('github.json',
+                                                          _load_json)
+        # Workaround broken repo info
+        if self.name == 'fly_genome':
+            j = dict(j)
+            j['homepage'] = 'https://integrativemodeling.org/systems/22'
+        return j
 
     def has_thumbnail(self):
         """Return True iff a thumbnail for this system exists"""
-        thumb = os.path.join(app.config['SYSTEM_TOP'], self.name, 'thumb.png')
-        return os.path.exists(thumb)
+        entry = self._index_entry
+        if entry:
+            return entry['has_thumbnail']
+        return self._load_file('thumb.png', lambda fname: True,
+                               missing=False)
 
     @property
     def description(self):
@@ -212,37 +453,538 @@ def get_all_systems(id=None):
     return [System(*x) for x in c]
 
 
-def add_all_build_results(systems, build_id=None):
-    """Add BuildResult information to the given list of System objects"""
-    sys_by_id = dict((s.id, s) for s in systems)
-    build_by_id = {}
+def add_build_info(results):
+    """Fill in the sys_info fields (url, use_modeller, imp_build_type)
+       for all of the given BuildResult objects using a single query"""
+    results = [r for r in results if not hasattr(r, '_info_internal')]
+    if not results:
+        return
+    sys_ids = sorted(frozenset(r._system_id for r in results))
+    build_ids = sorted(frozenset(r.build.id for r in results))
     conn = get_db()
     c = MySQLdb.cursors.DictCursor(conn)
+    c.execute("SELECT sys,build,url,use_modeller,imp_build_type FROM "
+              "sys_info WHERE sys IN (%s) AND build IN (%s)"
+              % (','.join(['%s'] * len(sys_ids)),
+                 ','.join(['%s'] * len(build_ids))), sys_ids + build_ids)
+    info = dict(((row['sys'], row['build']),
+                 {'url': row['url'], 'use_modeller': row['use_modeller'],
+                  'imp_build_type': row['imp_build_type']}) for row in c)
+    for r in results:
+        r._info_internal = info.get((r._system_id, r.build.id))
+
+
+def get_result_summary_mark():
+    """Get the high-water mark of the sys_result summary table (the last
+       build it contains), or None if the table has not been created.
+       See update_result_summary()."""
+    if not hasattr(g, 'result_summary_mark'):
+        c = get_db().cursor()
+        try:
+            c.execute('SELECT build FROM sys_result_mark')
+            row = c.fetchone()
+            g.result_summary_mark = row[0] if row else None
+        except MySQLdb.Error:
+            g.result_summary_mark = None
+    return g.result_summary_mark
+
+
+def _aggregate_results(wheres):
+    # The result of a system is the worst return code of any of its tests
+    where = ('WHERE ' + ' AND '.join(wheres)) if wheres else ''
+    return ('SELECT sys sys_id,build build_id,MAX(retcode) retcode '
+            'FROM sys_test %s GROUP BY sys,build' % where)
+
+
+def _get_results_table(wheres, args):
+    """Get an SQL query for the result of each system in each build,
+       given conditions on the sys_test table, and its arguments"""
+    mark = get_result_summary_mark()
+    if mark is None:
+        return _aggregate_results(wheres), args
+    else:
+        # Use precalculated results, plus those for any newer builds
+        where = ''.join(' AND ' + w for w in wheres)
+        return ('SELECT sys sys_id,build build_id,retcode FROM sys_result '
+                'WHERE build<=%%s%s UNION ALL %s'
+                % (where, _aggregate_results(['build>%s'] + wheres)),
+                [mark] + args + [mark] + args)
+
+
+def _get_build_results_query(wheres, args, latest_only=False):
+    """Get an SQL query for the result of each system in each build,
+       including build information, and its arguments"""
+    results, args = _get_results_table(wheres, args)
+    query = ('SELECT r.sys_id,r.build_id,r.retcode,imp_branch,'
+             'modeller_version,imp_date,imp_version,imp_githash FROM '
+             '(%s) r INNER JOIN sys_build ON sys_build.id=r.build_id'
+             % results)
+    if latest_only:
+        # Rank results newest first, both overall and separately for
+        # passing and failing results, and keep only the top ones
+        order = 'ORDER BY imp_date DESC,build_id DESC'
+        query = ('SELECT * FROM (SELECT q.*,'
+                 'ROW_NUMBER() OVER (PARTITION BY sys_id,imp_branch '
+                 '%s) latest_rank,'
+                 'ROW_NUMBER() OVER (PARTITION BY sys_id,imp_branch,'
+                 'retcode=0 %s) pass_rank FROM (%s) q) ranked '
+                 'WHERE latest_rank=1 OR (retcode=0 AND pass_rank=1)'
+                 % (order, order, query))
+    return query + ' ORDER BY imp_date,build_id', args
+
+
+def update_result_summary(rebuild=False):
+    """Add results for all new builds to the sys_result summary table,
+       creating it if necessary. The table stores the result of each
+       system in each build, so that these need not be recalculated from
+       the much larger sys_test table. It is used for all builds up to
+       a high-water mark (stored in the sys_result_mark table); results
+       of any newer builds are still calculated from sys_test. Builds may
+       still be gaining results until a newer build of the same branch
+       exists, so the mark is kept below the newest build of each branch
+       in ALL_BRANCHES (builds of any other branches are assumed to be
+       complete). If `rebuild` is True, discard all existing results
+       first. Return the number of results added."""
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('CREATE TABLE IF NOT EXISTS sys_result (sys INT NOT NULL, '
+              'build INT NOT NULL, retcode INT NOT NULL, '
+              'PRIMARY KEY (sys, build))')
+    c.execute('CREATE TABLE IF NOT EXISTS sys_result_mark '
+              '(build INT NOT NULL)')
+    if rebuild:
+        c.execute('DELETE FROM sys_result')
+        c.execute('DELETE FROM sys_result_mark')
+    c.execute('SELECT build FROM sys_result_mark')
+    row = c.fetchone()
+    mark = row[0] if row else 0
+    c.execute('SELECT MAX(build) FROM sys_test')
+    new_mark = c.fetchone()[0]
+    c.execute('SELECT MIN(newest) FROM (SELECT MAX(id) newest FROM sys_build '
+              'WHERE imp_branch IN (%s) GROUP BY imp_branch) b'
+              % ','.join(['%s'] * len(ALL_BRANCHES)), ALL_BRANCHES)
+    newest = c.fetchone()[0]
+    if newest is not None and new_mark is not None:
+        new_mark = min(new_mark, newest - 1)
+    if new_mark is None or new_mark <= mark:
+        conn.commit()
+        return 0
+    c.execute('DELETE FROM sys_result WHERE build>%s', (mark,))
+    c.execute('INSERT INTO sys_result (sys,build,retcode) '
+              'SELECT sys,build,MAX(retcode) FROM sys_test '
+              'WHERE build>%s AND build<=%s GROUP BY sys,build',
+              (mark, new_mark))
+    added = c.rowcount
+    c.execute('DELETE FROM sys_result_mark')
+    c.execute('INSERT INTO sys_result_mark (build) VALUES (%s)', (new_mark,))
+    conn.commit()
+    return added
+
+
+def get_build_version():
+    """Get the ID and date of the newest build, plus the number of test
+       results of the newest build of each branch (which may still be
+       running, so gaining results), as a tuple"""
+    if not hasattr(g, 'build_version'):
+        c = get_db().cursor()
+        c.execute('SELECT MAX(id),MAX(imp_date),'
+                  '(SELECT COUNT(*) FROM sys_test WHERE build IN '
+                  '(SELECT MAX(id) FROM sys_build GROUP BY imp_branch)) '
+                  'FROM sys_build')
+        g.build_version = tuple(c.fetchone())
+    return g.build_version
+
+
+def get_newest_build_ids():
+    """Get the IDs of the newest build of each branch. These builds may
+       still be running, so gaining results."""
+    c = get_db().cursor()
+    c.execute('SELECT MAX(id) FROM sys_build GROUP BY imp_branch')
+    return sorted(row[0] for row in c)
+
+
+def get_build_test_counts(build_ids):
+    """Get a dict mapping (system ID, build ID) to the number of test
+       results, and the number of failed tests, of each system in each of
+       the given builds"""
+    if not build_ids:
+        return {}
+    c = get_db().cursor()
+    c.execute('SELECT sys,build,COUNT(*),SUM(retcode<>0) FROM sys_test '
+              'WHERE build IN (%s) GROUP BY sys,build'
+              % ','.join(['%s'] * len(build_ids)), list(build_ids))
+    return dict(((sys_id, build_id), (int(ntest), int(nfail)))
+                for sys_id, build_id, ntest, nfail in c)
+
+
+def has_newer_build(build):
+    """Return True iff a newer build than `build` of the same branch
+       exists"""
+    c = get_db().cursor()
+    c.execute('SELECT id FROM sys_build WHERE imp_branch=%s AND id>%s '
+              'LIMIT 1', (build.imp_branch, build.id))
+    return c.fetchone() is not None
+
+
+def get_last_passed_build(system_id, branch):
+    """Get the most recent build of the given branch that the given system
+       passed, as a Build object, or None"""
+    results, args = _get_results_table(['sys=%s'], [system_id])
+    c = MySQLdb.cursors.DictCursor(get_db())
+    c.execute('SELECT id,imp_branch,imp_date,imp_version,imp_githash,'
+              'modeller_version FROM (%s) r INNER JOIN sys_build ON '
+              'sys_build.id=r.build_id WHERE retcode=0 AND imp_branch=%%s '
+              'ORDER BY imp_date DESC,id DESC LIMIT 1' % results,
+              args + [branch])
+    row = c.fetchone()
+    return Build(**row) if row else None
+
+
+def get_test_stderr(system_id, build_id, test_id):
+    """Get the full standard error of a single test, or None if the test
+       does not exist"""
+    archive, archive_blob = _get_stderr_archive_join()
+    c = get_db().cursor()
+    c.execute("SELECT sys_test.stderr," + archive_blob + " FROM sys_test"
+              + archive + " WHERE sys_test.sys=%s AND sys_test.build=%s "
+              "AND sys_test.name=%s", (system_id, build_id, test_id))
+    row = c.fetchone()
+    if row is None:
+        return None
+    if row[1] is not None:
+        return _decompress_stderr(row[1])
+    return row[0] or ''
+
+
+def has_stderr_archive():
+    """Return True iff the stderr archive tables exist (see
+       archive_stderr())"""
+    if not hasattr(g, 'stderr_archive'):
+        c = get_db().cursor()
+        try:
+            c.execute('SELECT hash FROM sys_stderr_blob LIMIT 1')
+            c.fetchone()
+            g.stderr_archive = True
+        except MySQLdb.Error:
+            g.stderr_archive = False
+    return g.stderr_archive
+
+
+def _get_stderr_archive_join(blob=True):
+    """Get SQL to join sys_test with the stderr archive, and to select
+       the compressed archived stderr (or NULL if there is no archive,
+       or `blob` is False, in which case only sys_stderr_archive
+       is joined)"""
+    if not has_stderr_archive():
+        return '', 'NULL'
+    join = (' LEFT JOIN sys_stderr_archive ON '
+            'sys_stderr_archive.sys=sys_test.sys AND '
+            'sys_stderr_archive.build=sys_test.build AND '
+            'sys_stderr_archive.name=sys_test.name')
+    if not blob:
+        return join, 'NULL'
+    return (join + ' LEFT JOIN sys_stderr_blob ON '
+            'sys_stderr_blob.hash=sys_stderr_archive.hash',
+            'sys_stderr_blob.data')
+
+
+def _decompress_stderr(blob):
+    return zlib.decompress(blob).decode('utf-8', errors='replace')
+
+
+class ArchiveStats(object):
+    """Summary of the work done by archive_stderr()"""
+    def __init__(self):
+        self.tests = self.blobs = 0
+        self.raw_size = self.stored_size = 0
+
+    saved = property(lambda self: self.raw_size - self.stored_size)
+
+
+def archive_stderr(days):
+    """Move the standard error of all tests in builds more than `days` days
+       old out of sys_test into compressed storage. Each distinct output
+       is compressed with zlib and stored once in the sys_stderr_blob
+       table, keyed by its SHA1 hash, so that identical tracebacks from
+       different builds share storage; the sys_stderr_archive table maps
+       each test to its output, and keeps the first
+       STDERR_ARCHIVE_PREVIEW_SIZE characters uncompressed for previews
+       (see BuildResult.iter_tests). The tables are created if necessary.
+       Return an ArchiveStats object."""
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('CREATE TABLE IF NOT EXISTS sys_stderr_blob '
+              '(hash CHAR(40) NOT NULL PRIMARY KEY, '
+              'data LONGBLOB NOT NULL)')
+    c.execute('CREATE TABLE IF NOT EXISTS sys_stderr_archive '
+              '(sys INT NOT NULL, build INT NOT NULL, name INT NOT NULL, '
+              'hash CHAR(40) NOT NULL, preview TEXT NOT NULL, '
+              'PRIMARY KEY (sys, build, name))')
+    cutoff = datetime.date.today() - datetime.timedelta(days=days)
+    c.execute('SELECT DISTINCT build FROM sys_test INNER JOIN sys_build ON '
+              'sys_build.id=sys_test.build WHERE imp_date<%s '
+              'AND stderr IS NOT NULL AND name IS NOT NULL ORDER BY build',
+              (cutoff.isoformat(),))
+    builds = [row[0] for row in c]
+    stats = ArchiveStats()
+    # Process one build at a time, to limit memory use and transaction size
+    for build in builds:
+        c.execute('SELECT sys,name,stderr FROM sys_test WHERE build=%s '
+                  'AND stderr IS NOT NULL AND name IS NOT NULL', (build,))
+        for sys_id, name, stderr in list(c):
+            raw = stderr.encode('utf-8')
+            h = hashlib.sha1(raw).hexdigest()
+            c.execute('SELECT hash FROM sys_stderr_blob WHERE hash=%s', (h,))
+            if c.fetchone() is None:
+                data = zlib.compress(raw, 9)
+                c.execute('INSERT INTO sys_stderr_blob (hash,data) '
+                          'VALUES (%s,%s)', (h, data))
+                stats.blobs += 1
+                stats.stored_size += len(data)
+            c.execute('DELETE FROM sys_stderr_archive WHERE sys=%s AND '
+                      'build=%s AND name=%s', (sys_id, build, name))
+            c.execute('INSERT INTO sys_stderr_archive '
+                      '(sys,build,name,hash,preview) VALUES (%s,%s,%s,%s,%s)',
+                      (sys_id, build, name, h,
+                       stderr[:STDERR_ARCHIVE_PREVIEW_SIZE]))
+            stats.tests += 1
+            stats.raw_size += len(raw)
+        c.execute('UPDATE sys_test SET stderr=NULL WHERE build=%s '
+                  'AND name IS NOT NULL', (build,))
+        conn.commit()
+    return stats
+
+
+class BuildWindow(object):
+    """A range of consecutive builds of a single branch (see
+       get_build_window)"""
+    def __init__(self, branch, builds, has_older, has_newer):
+        self.branch, self.builds = branch, builds
+        self.has_older, self.has_newer = has_older, has_newer
+
+
+def get_build_window(branch, limit, before=None, since=None):
+    """Get at most `limit` builds of the given branch, sorted by ID, as a
+       BuildWindow. These are the newest builds with IDs less than `before`,
+       unless only `since` is given, in which case they are the oldest
+       builds with IDs greater than `since`."""
+    conn = get_db()
+    c = MySQLdb.cursors.DictCursor(conn)
+    wheres = ['imp_branch=%s']
+    args = [branch]
+    if since is not None:
+        wheres.append('id>%s')
+        args.append(since)
+    if before is not None:
+        wheres.append('id<%s')
+        args.append(before)
+    newest_first = since is None or before is not None
+    # Get one more build than needed to see if there are more
+    c.execute('SELECT id,imp_branch,imp_date,imp_version,imp_githash,'
+              'modeller_version FROM sys_build WHERE %s ORDER BY id %s '
+              'LIMIT %d' % (' AND '.join(wheres),
+                            'DESC' if newest_first else 'ASC', limit + 1),
+              args)
+    builds = [Build(**row) for row in c]
+    more = len(builds) > limit
+    builds = builds[:limit]
+    if newest_first:
+        builds.reverse()
+        return BuildWindow(branch, builds, has_older=more,
+                           has_newer=before is not None)
+    else:
+        return BuildWindow(branch, builds, has_older=True, has_newer=more)
+
+
+def iter_build_results(systems, build_id=None, latest_only=False,
+                       all_systems=False, build_ids=None):
+    """Yield BuildResult objects for the given list of System objects,
+       sorted by build date, as they are read from the database.
+       An unbuffered (server-side) cursor is used, so no other queries
+       can be made on the same connection until iteration is finished.
+       See add_all_build_results() for a description of the arguments."""
+    if not systems:
+        return
+    sys_by_id = dict((s.id, s) for s in systems)
+    build_by_id = {}
     args = []
     wheres = []
-    if len(systems) == 1:
-        wheres.append('sys=%s')
-        args.append(systems[0].id)
+    if not all_systems:
+        wheres.append('sys IN (%s)' % ','.join(['%s'] * len(sys_by_id)))
+        args.extend(sys_by_id.keys())
     if build_id:
         wheres.append('build=%s')
         args.append(build_id)
-    where = ('WHERE ' + ' AND '.join(wheres)) if wheres else ''
-    c.execute('SELECT sys sys_id,build build_id,imp_branch,modeller_version,'
-              'imp_date,imp_version,imp_githash,MAX(retcode) retcode FROM '
-              'sys_test INNERT JOIN sys_build ON sys_build.id=build '
-              '%s GROUP BY build_id,sys_id,imp_branch '
-              'ORDER BY imp_date' % where, args)
-    for row in c:
-        system = sys_by_id.get(row['sys_id'])
-        if system:
-            build = build_by_id.get(row['build_id'])
-            if build is None:
-                build = Build(
-                    id=row['build_id'], imp_branch=row['imp_branch'],
-                    imp_date=row['imp_date'], imp_version=row['imp_version'],
-                    imp_githash=row['imp_githash'],
-                    modeller_version=row['modeller_version'])
-                build_by_id[row['build_id']] = build
-            result = BuildResult(build=build, passed=(row['retcode'] == 0),
-                                 system=system)
-            system.build_results[row['imp_branch']].append(result)
+    if build_ids is not None:
+        if not build_ids:
+            return
+        wheres.append('build IN (%s)' % ','.join(['%s'] * len(build_ids)))
+        args.extend(build_ids)
+    query, args = _get_build_results_query(wheres, args, latest_only)
+    c = MySQLdb.cursors.SSDictCursor(get_db())
+    try:
+        c.execute(query, args)
+        for row in c:
+            system = sys_by_id.get(row['sys_id'])
+            if system:
+                build = build_by_id.get(row['build_id'])
+                if build is None:
+                    build = Build(
+                        id=row['build_id'], imp_branch=row['imp_branch'],
+                        imp_date=row['imp_date'],
+                        imp_version=row['imp_version'],
+                        imp_githash=row['imp_githash'],
+                        modeller_version=row['modeller_version'])
+                    build_by_id[row['build_id']] = build
+                yield BuildResult(build=build, passed=(row['retcode'] == 0),
+                                  system=system)
+    finally:
+        c.close()
+
+
+class BuildMatrix(object):
+    """The result of each of a list of systems (columns) in each of a list
+       of builds (rows), stored compactly as one byte per result: NONE if
+       the system was not tested in the build, or PASS or FAIL.
+       Use get_build_matrix() to create."""
+    NONE, PASS, FAIL = 0, 1, 2
+
+    def __init__(self, builds, system_ids, data=None):
+        self.builds, self.system_ids = builds, system_ids
+        self._build_index = dict((b.id, i) for i, b in enumerate(builds))
+        self._system_index = dict((s, i) for i, s in enumerate(system_ids))
+        if data is None:
+            data = bytearray(len(builds) * len(system_ids))
+        self._data = data
+
+    def set(self, build_id, system_id, passed):
+        i = (self._build_index[build_id] * len(self.system_ids)
+             + self._system_index[system_id])
+        self._data[i] = self.PASS if passed else self.FAIL
+
+    def get(self, build_id, system_id):
+        """Get the result (NONE, PASS or FAIL) of a system in a build"""
+        return self._data[self._build_index[build_id] * len(self.system_ids)
+                          + self._system_index[system_id]]
+
+    def row(self, index):
+        """Get the results of all systems in the index'th build, as bytes"""
+        n = len(self.system_ids)
+        return bytes(self._data[index * n:(index + 1) * n])
+
+    def column(self, system_id):
+        """Get the results of a system in every build, as bytes"""
+        return bytes(self._data[self._system_index[system_id]::
+                                len(self.system_ids) or 1])
+
+    def iter_rows(self):
+        """Yield (Build, row) for each build with at least one result,
+           where row is as for row()"""
+        for i, build in enumerate(self.builds):
+            row = self.row(i)
+            if row.strip(b'\0'):
+                yield build, row
+
+    def encode(self):
+        """Encode the results of all builds with at least one result (see
+           iter_rows()) in a compact run-length form, for rendering on
+           the client. Return the list of builds, and a string of runs of
+           identical results, in row-major order; each run is a count
+           (omitted if 1) followed by '.' (not tested), 'p' (pass) or 'f'
+           (fail)."""
+        builds, rows = [], []
+        for build, row in self.iter_rows():
+            builds.append(build)
+            rows.append(row)
+        runs = []
+        for result, group in itertools.groupby(b''.join(rows)):
+            n = sum(1 for _ in group)
+            runs.append(('%d' % n if n > 1 else '') + '.pf'[result])
+        return builds, ''.join(runs)
+
+    def last_result(self, system_id):
+        """Get the last build in which the system was tested and whether
+           it passed, as a (Build, bool) tuple, or None"""
+        column = self.column(system_id).rstrip(b'\0')
+        if column:
+            return self.builds[len(column) - 1], column[-1] == self.PASS
+        return None
+
+    def last_pass(self, system_id):
+        """Get the last Build that the system passed, or None"""
+        i = self.column(system_id).rfind(self.PASS)
+        return self.builds[i] if i >= 0 else None
+
+    def get_tested_system_ids(self):
+        """Get the set of IDs of all systems with at least one result"""
+        return frozenset(s for s in self.system_ids
+                         if self.column(s).strip(b'\0'))
+
+    def select_systems(self, system_ids):
+        """Get a new BuildMatrix containing only the given systems' columns,
+           in the given order"""
+        m = BuildMatrix(self.builds, list(system_ids))
+        n = len(m.system_ids)
+        for j, s in enumerate(m.system_ids):
+            m._data[j::n] = self.column(s)
+        return m
+
+
+def get_build_matrix(systems, builds):
+    """Get the results of the given systems in the given builds as a
+       BuildMatrix"""
+    matrix = BuildMatrix(builds, [s.id for s in systems])
+    if not builds or not systems:
+        return matrix
+    results, args = _get_results_table(
+        ['build IN (%s)' % ','.join(['%s'] * len(builds))],
+        [b.id for b in builds])
+    c = MySQLdb.cursors.SSCursor(get_db())
+    try:
+        c.execute('SELECT sys_id,build_id,retcode FROM (%s) r' % results,
+                  args)
+        system_index = matrix._system_index
+        for sys_id, build_id, retcode in c:
+            if sys_id in system_index:
+                matrix.set(build_id, sys_id, retcode == 0)
+    finally:
+        c.close()
+    return matrix
+
+
+def get_system_build_ids():
+    """Get a dict mapping the ID of each system to a sorted list of the IDs
+       of all builds in which it was tested"""
+    results, args = _get_results_table([], [])
+    c = MySQLdb.cursors.SSCursor(get_db())
+    try:
+        c.execute('SELECT sys_id,build_id FROM (%s) r ORDER BY sys_id,build_id'
+                  % results, args)
+        return dict((sys_id, [row[1] for row in rows])
+                    for sys_id, rows in itertools.groupby(
+                        c, key=operator.itemgetter(0)))
+    finally:
+        c.close()
+
+
+def add_all_build_results(systems, build_id=None, info=False,
+                          latest_only=False, all_systems=False,
+                          build_ids=None):
+    """Add BuildResult information to the given list of System objects.
+       If `info` is True, also fill in sys_info for every result.
+       If `latest_only` is True, only the most recent result and the most
+       recent passing result for each branch are added, which is all that
+       is needed for last_build_results.
+       Only results for the given systems are queried, unless `all_systems`
+       is True (the list contains every system).
+       Results can be restricted to a single build with `build_id`, or a
+       list of builds with `build_ids`."""
+    sys_by_id = dict((s.id, s) for s in systems)
+    for result in iter_build_results(systems, build_id, latest_only,
+                                     all_systems, build_ids):
+        system = sys_by_id[result._system_id]
+        system.build_results[result.build.imp_branch].append(result)
+    if info:
+        add_build_info(itertools.chain.from_iterable(
+            itertools.chain.from_iterable(s.build_results.values())
+            for s in systems))
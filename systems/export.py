@@ -0,0 +1,275 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import shutil
+from urllib.parse import urlsplit, urlencode, quote, quote_plus
+from flask import g, render_template, url_for
+from .app import app
+from .cache import write_file_atomic
+from .conditional import get_code_version
+from . import database
+
+
+MANIFEST = '.export-manifest.json'
+
+# Version of the manifest format; a full export is done if it changes
+MANIFEST_VERSION = 1
+
+# Tags that can be used unchanged in filenames and rewrite rules. This must
+# match the generic tag rule in export.htaccess.
+_SAFE_TAG = re.compile(r'[A-Za-z0-9][A-Za-z0-9_.-]*$')
+
+
+class Page(object):
+    """A single page to export: the URL to request, and the file (relative
+       to the target directory) to write it to. If `build` is True, the
+       page is a build page, so any further pages of its tests, and the
+       full stderr of any tests that are truncated, are also exported."""
+    def __init__(self, url, filename, build=False):
+        self.url, self.filename, self.build = url, filename, build
+
+
+class ExportResult(object):
+    """Summary of the work done by export_site(): the Pages that were
+       exported, the number of files written, a list of (Page, HTTP status)
+       for any failures, and whether a full export was done"""
+    def __init__(self, pages, written, failed, full):
+        self.pages, self.written, self.failed = pages, written, failed
+        self.full = full
+
+
+def _metadata_hash(system):
+    return hashlib.sha1(repr(system.metadata_version).encode()).hexdigest()
+
+
+def _get_tag_filename(tag):
+    """Get the name of the file, relative to the tag directory, for the
+       summary page of a tag. Tags containing characters that are not safe
+       in filenames or rewrite rules are hex-encoded; the leading
+       underscore means these cannot clash with safe tags."""
+    if _SAFE_TAG.match(tag):
+        return tag + '.html'
+    else:
+        return '_%s.html' % tag.encode('utf-8').hex()
+
+
+def _get_tag_rules(systems):
+    """Get a (query regex, filename) pair for each tag that needs its own
+       rewrite rule (see _get_tag_filename)"""
+    rules = []
+    for tag in sorted(database.get_tag_index(systems).keys()):
+        if not _SAFE_TAG.match(tag):
+            # Match the tag however the client chose to encode it
+            encoded = sorted(set((quote(tag, safe=''), quote_plus(tag))))
+            rules.append(('|'.join(re.escape(e) for e in encoded),
+                          _get_tag_filename(tag)))
+    return rules
+
+
+def _get_global_pages(systems):
+    pages = [Page('/', 'index.html'),
+             Page('/all-builds', 'all-builds.html'),
+             Page('/all-builds?compact=1', 'all-builds-compact.html'),
+             Page('/api/list', 'api/list.json')]
+    for tag in sorted(database.get_tag_index(systems).keys()):
+        pages.append(Page('/?' + urlencode({'tag': tag}),
+                          'tag/' + _get_tag_filename(tag)))
+    return pages
+
+
+def _get_system_pages(system):
+    pages = [Page('/%d' % system.id, '%d.html' % system.id)]
+    for branch in database.ALL_BRANCHES:
+        pages.append(Page('/%d/badge.svg?branch=%s' % (system.id, branch),
+                          '%d/badge-%s.svg' % (system.id, branch)))
+    return pages
+
+
+def _get_build_page(system_id, build_id):
+    return Page('/%d/build/%d' % (system_id, build_id),
+                '%d/build/%d.html' % (system_id, build_id), build=True)
+
+
+def _get_running_results(manifest):
+    """Get the number of test results, and of failures, of each system in
+       the newest build of each branch, which may still be gaining results,
+       as stored in the manifest. Also get the same for any build that was
+       one of these in the old manifest, since it may have gained results
+       since the last export."""
+    old_ids = frozenset(int(build_id)
+                        for builds in manifest.get('running', {}).values()
+                        for build_id in builds)
+    newest_ids = database.get_newest_build_ids()
+    counts = database.get_build_test_counts(sorted(old_ids
+                                                   | frozenset(newest_ids)))
+    running = {}
+    for (sys_id, build_id), count in counts.items():
+        running.setdefault(str(sys_id), {})[str(build_id)] = list(count)
+    new_running = dict((sid, dict((bid, count)
+                                  for bid, count in builds.items()
+                                  if int(bid) in newest_ids))
+                       for sid, builds in running.items())
+    return running, dict((sid, builds)
+                         for sid, builds in new_running.items() if builds)
+
+
+def plan_export(manifest, base_url, full=False):
+    """Get the list of Pages that need to be exported, given the manifest
+       of the previous export, plus the new manifest. Everything is
+       exported if `full` is True, or if the code or base URL changed.
+       Otherwise, only pages affected by new builds, by new results of
+       builds that may still have been running at the last export, or by
+       changes to system metadata are exported."""
+    systems = database.get_all_systems()
+    build_ids = database.get_system_build_ids()
+    running, new_running = _get_running_results(manifest)
+    new_manifest = {'version': MANIFEST_VERSION, 'code': get_code_version(),
+                    'base_url': base_url,
+                    'metadata': dict((str(s.id), _metadata_hash(s))
+                                     for s in systems),
+                    'builds': dict((str(s.id), build_ids.get(s.id, []))
+                                   for s in systems),
+                    'running': new_running}
+    full = full or any(manifest.get(k) != new_manifest[k]
+                       for k in ('version', 'code', 'base_url'))
+    if full:
+        manifest = {}
+    old_meta = manifest.get('metadata', {})
+    old_builds = manifest.get('builds', {})
+    old_running = manifest.get('running', {})
+    pages = []
+    if (new_manifest['metadata'] != old_meta
+            or new_manifest['builds'] != old_builds
+            or new_running != old_running):
+        pages.extend(_get_global_pages(systems))
+    for s in systems:
+        sid = str(s.id)
+        meta_changed = new_manifest['metadata'][sid] != old_meta.get(sid)
+        # Builds with results that are new, or changed since the last export
+        changed_builds = (
+            frozenset(new_manifest['builds'][sid])
+            - frozenset(old_builds.get(sid, []))) | frozenset(
+                int(bid) for bid, count in running.get(sid, {}).items()
+                if count != old_running.get(sid, {}).get(bid))
+        if meta_changed or changed_builds:
+            pages.extend(_get_system_pages(s))
+        # Build pages also show system metadata, but are otherwise
+        # unchanged once the build has finished
+        for build_id in new_manifest['builds'][sid]:
+            if meta_changed or build_id in changed_builds:
+                pages.append(_get_build_page(s.id, build_id))
+    return pages, full, new_manifest
+
+
+def _get_build_subpages(page):
+    """Get Pages for any further pages of tests of a build, and for the
+       full stderr of all tests that are truncated on these pages"""
+    _, system_id, _, build_id = page.url.split('/')
+    all_sys = database.get_all_systems(int(system_id))
+    database.add_all_build_results(all_sys, int(build_id))
+    pages = []
+    ntest = 0
+    for results in all_sys[0].build_results.values() if all_sys else []:
+        for r in results:
+            for t in r.iter_tests(
+                    stderr_limit=app.config.get('STDERR_PREVIEW_SIZE', 2000)):
+                ntest += 1
+                if t.stderr_truncated:
+                    pages.append(Page(
+                        '%s/test/%d/stderr' % (page.url, t.id),
+                        '%s/build/%s/test/%d.txt'
+                        % (system_id, build_id, t.id)))
+    per_page = app.config.get('BUILD_TESTS_PER_PAGE', 100)
+    for n in range(2, (ntest + per_page - 1) // per_page + 1):
+        pages.append(Page('%s?page=%d' % (page.url, n),
+                          '%s/build/%s/page-%d.html'
+                          % (system_id, build_id, n)))
+    return pages
+
+
+def _export_pages(target, base_url, pages):
+    """Render each Page and write it under the target directory. Return
+       the number of files written, and a list of (Page, HTTP status) for
+       each page that could not be rendered."""
+    client = app.test_client()
+    written = 0
+    failed = []
+    todo = list(pages)
+    while todo:
+        page = todo.pop(0)
+        fname = os.path.join(target, page.filename)
+        # Use a new context for each page, so nothing is shared between them
+        with app.app_context():
+            # Let templates leave out links that the export can't serve
+            g.exporting = True
+            rv = client.get(page.url, base_url=base_url)
+            data = rv.get_data()
+            if rv.status_code == 200:
+                write_file_atomic(fname, data)
+                written += 1
+                if page.build:
+                    todo.extend(_get_build_subpages(page))
+            else:
+                # e.g. a badge for a branch without builds
+                if os.path.exists(fname):
+                    os.unlink(fname)
+                if rv.status_code != 404:
+                    failed.append((page, rv.status_code))
+    return written, failed
+
+
+def _init_worker():
+    # Connections inherited from the parent cannot be used by this process
+    database.forget_pool()
+
+
+def _export_pages_worker(args):
+    return _export_pages(*args)
+
+
+def export_site(target, base_url='http://localhost/', full=False, jobs=1):
+    """Export the entire site as static files in the given directory, so
+       that it can be served without the database. Only pages that changed
+       since the last export are rendered (see plan_export()), using `jobs`
+       processes in parallel. Return an ExportResult."""
+    manifest_file = os.path.join(target, MANIFEST)
+    try:
+        with open(manifest_file) as fh:
+            manifest = json.load(fh)
+    except FileNotFoundError:
+        manifest = {}
+    pages, full, new_manifest = plan_export(manifest, base_url, full)
+    tag_rules = _get_tag_rules(database.get_all_systems())
+    # Don't hold a connection while the pages are rendered
+    database.release_db()
+
+    if jobs > 1 and len(pages) > 1:
+        # Build pages are the most numerous, and also need the most work,
+        # so split pages between processes round-robin
+        chunks = [(target, base_url, pages[i::jobs]) for i in range(jobs)]
+        # Children need a copy of the application's state
+        ctx = multiprocessing.get_context('fork')
+        with ctx.Pool(jobs, initializer=_init_worker) as pool:
+            results = pool.map(_export_pages_worker, chunks)
+        written = sum(r[0] for r in results)
+        failed = [f for r in results for f in r[1]]
+    else:
+        written, failed = _export_pages(target, base_url, pages)
+
+    if app.static_folder and os.path.isdir(app.static_folder):
+        shutil.copytree(app.static_folder, os.path.join(target, 'static'),
+                        dirs_exist_ok=True)
+    with app.test_request_context(base_url=base_url):
+        htaccess = render_template('export.htaccess',
+                                   root=urlsplit(url_for('summary')).path,
+                                   tag_rules=tag_rules)
+    write_file_atomic(os.path.join(target, '.htaccess'),
+                      htaccess.encode('utf-8'))
+    # If anything failed, keep the old manifest so that it is tried again
+    if not failed:
+        write_file_atomic(manifest_file,
+                          json.dumps(new_manifest).encode('utf-8'))
+    return ExportResult(pages=pages, written=written, failed=failed,
+                        full=full)
@@ -0,0 +1,54 @@
+from flask import request
+from markupsafe import Markup
+from .app import app
+from .cache import LRUCache, DiskCache
+from .conditional import get_code_version
+
+
+def get_fragment_cache():
+    """Get the cache of rendered page fragments, or None if disabled.
+       The FRAGMENT_CACHE setting selects the backend: 'memory' (the
+       default) for a cache private to each process, or 'disk' for one
+       stored in FRAGMENT_CACHE_DIR and shared by all processes."""
+    if 'fragment_cache' not in app.extensions:
+        backend = app.config.get('FRAGMENT_CACHE', 'memory')
+        size = app.config.get('FRAGMENT_CACHE_SIZE', 1000)
+        if backend == 'memory':
+            cache = LRUCache(size)
+        elif backend == 'disk':
+            cache = DiskCache(app.config['FRAGMENT_CACHE_DIR'], size)
+        elif backend is None:
+            cache = None
+        else:
+            raise ValueError("Unknown FRAGMENT_CACHE backend %s" % backend)
+        app.extensions['fragment_cache'] = cache
+    return app.extensions['fragment_cache']
+
+
+def cached_fragment(key, render):
+    """Get a rendered HTML fragment from the cache, or call render() to
+       make it if it is not cached. `key` must uniquely identify the
+       fragment and change whenever its contents do."""
+    cache = get_fragment_cache()
+    if cache is None:
+        return render()
+    # Links in the fragment depend on where the app is mounted, and any
+    # template change invalidates all fragments
+    key = (key, request.script_root, get_code_version())
+    html = cache.get(key)
+    if html is None:
+        html = str(render())
+        cache.put(key, html.encode('utf-8'))
+    else:
+        html = html.decode('utf-8')
+    return Markup(html)
+
+
+@app.template_global()
+def system_summary(system):
+    """Render a single system's summary, as shown on the summary page"""
+    key = ('system_summary', system.id, system.metadata_version,
+           tuple(sorted((branch, r.build.id, r.passed)
+                        for branch, r in system.last_build_results.items())))
+    macros = app.jinja_env.get_template('macros.html').module
+    return cached_fragment(key, lambda: macros.show_system_summary(system))
@@ -0,0 +1,33 @@
+import hashlib
+from flask import request
+from .app import app
+from .cache import PageStore
+from .conditional import get_code_version
+
+
+def get_build_page_store():
+    """Get the persistent store of rendered build pages, or None if
+       BUILD_PAGE_CACHE_DIR is not set"""
+    if 'build_page_store' not in app.extensions:
+        directory = app.config.get('BUILD_PAGE_CACHE_DIR')
+        app.extensions['build_page_store'] = \
+            PageStore(directory) if directory else None
+    return app.extensions['build_page_store']
+
+
+def get_build_page_version(system):
+    """Get a token that changes whenever the page of a completed build of
+       the given system does. Build results no longer change, but the page
+       also shows system metadata and depends on the templates and where
+       the app is mounted."""
+    return hashlib.sha1(repr((system.metadata_version, request.script_root,
+                              get_code_version())).encode()).hexdigest()
+
+
+def stored_page_response(page):
+    """Make a response for a stored build page"""
+    response = app.response_class(page, mimetype='text/html')
+    response.add_etag()
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config.get('CACHE_MAX_AGE', 300)
+    return response.make_conditional(request)
@@ -3,20 +3,51 @@
 import sqlite3
 
 
+class Error(Exception):
+    pass
+
+
+class OperationalError(Error):
+    pass
+
+
+class ProgrammingError(Error):
+    pass
+
+
 class MockCursor(object):
     def __init__(self, conn):
+        self.conn = conn
         self.sql, self.db = conn.sql, conn.db
         self.dbcursor = self.db.cursor()
 
     def execute(self, statement, args=()):
+        # Like MySQL, don't allow other queries while an unbuffered
+        # cursor still has results to read
+        if self.conn.unbuffered_cursor not in (None, self):
+            raise ProgrammingError("Commands out of sync; you can't run "
+                                   "this command now")
         self.sql.append(statement)
         # sqlite uses ? as a placeholder; MySQL uses %s
-        self.dbcursor.execute(statement.replace('%s', '?'), args)
+        try:
+            self.dbcursor.execute(statement.replace('%s', '?'), args)
+        except sqlite3.OperationalError as exc:
+            raise OperationalError(*exc.args)
+
+    @property
+    def rowcount(self):
+        return self.dbcursor.rowcount
+
+    def fetchone(self):
+        return self.dbcursor.fetchone()
 
     def __iter__(self):
         fa = self.dbcursor.fetchall()
         return fa.__iter__()
 
+    def close(self):
+        pass
+
 
 class DictCursor(MockCursor):
     def __init__(self, conn):
@@ -29,22 +60,68 @@ class DictCursor(MockCursor):
             self.db.row_factory = self._oldrf
 
 
+class SSCursor(MockCursor):
+    """Unbuffered cursor; rows are only read as they are iterated over"""
+    def execute(self, statement, args=()):
+        super(SSCursor, self).execute(statement, args)
+        self.conn.unbuffered_cursor = self
+
+    def fetchone(self):
+        row = self.dbcursor.fetchone()
+        if row is None:
+            self.close()
+        return row
+
+    def __iter__(self):
+        while True:
+            row = self.fetchone()
+            if row is None:
+                return
+            yield row
+
+    def close(self):
+        if self.conn.unbuffered_cursor is self:
+            self.conn.unbuffered_cursor = None
+
+
+class SSDictCursor(SSCursor):
+    def __init__(self, conn):
+        super(SSDictCursor, self).__init__(conn)
+        self.dbcursor.row_factory = sqlite3.Row
+
+
 class MockConnection(object):
     def __init__(self, db, *args, **keys):
         self.args = args
         self.keys = keys
         self.db = sqlite3.connect(":memory:")
         self.sql = []
+        self.closed = False
+        self.unbuffered_cursor = None
         # Use the database 'name' argument as a set of sqlite3 statements
         # to initialize it
         c = self.db.cursor()
         for d in db:
             c.execute(d)
+        self.db.commit()
 
     def cursor(self):
         return MockCursor(self)
 
+    def ping(self):
+        if self.closed:
+            raise OperationalError("MySQL server has gone away")
+
+    def commit(self):
+        self.db.commit()
+
+    def rollback(self):
+        if self.closed:
+            raise OperationalError("MySQL server has gone away")
+        self.db.rollback()
+
     def close(self):
+        self.closed = True
         self.db.close()
 
 
@@ -52,9 +129,11 @@ def connect(*args, **keys):
     return MockConnection(*args, **keys)
 
 
-# Mock for 'MySQLdb.cursors.DictCursor'
+# Mock for 'MySQLdb.cursors.DictCursor' etc.
 class cursors(object):
     pass
 
 
 cursors.DictCursor = DictCursor
+cursors.SSCursor = SSCursor
+cursors.SSDictCursor = SSDictCursor
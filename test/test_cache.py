@@ -0,0 +1,110 @@
+import utils
+import os
+import tempfile
+
+utils.set_search_paths(__file__)
+from systems import cache
+
+
+def test_write_file_atomic():
+    """Test write_file_atomic()"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = os.path.join(tmpdir, 'sub', 'foo')
+        cache.write_file_atomic(fname, b'foo')
+        cache.write_file_atomic(fname, b'bar')
+        with open(fname, 'rb') as fh:
+            assert fh.read() == b'bar'
+        # No temporary files should be left behind
+        assert os.listdir(os.path.join(tmpdir, 'sub')) == ['foo']
+        # File should get the usual permissions, not mkstemp's private ones
+        assert (os.stat(fname).st_mode & 0o777
+                == 0o666 & ~cache._get_umask())
+
+
+def test_lru_cache():
+    """Test the LRUCache class"""
+    c = cache.LRUCache(maxsize=2)
+    c.put('a', 1)
+    c.put('b', 2)
+    assert c.get('a') == 1
+    # 'b' is now the least recently used entry, so should be evicted
+    c.put('c', 3)
+    assert len(c) == 2
+    assert c.get('b') is None
+    assert c.get('b', 'default') == 'default'
+    assert c.get('a') == 1
+    assert c.get('c') == 3
+    c.clear()
+    assert len(c) == 0
+
+
+def test_file_cache():
+    """Test the FileCache class"""
+    calls = []
+
+    def loader(fname):
+        calls.append(fname)
+        with open(fname) as fh:
+            return fh.read()
+    c = cache.FileCache(maxsize=10)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = os.path.join(tmpdir, 'test')
+        assert c.load(fname, loader, missing='missing') == 'missing'
+        assert calls == []
+        with open(fname, 'w') as fh:
+            fh.write('foo')
+        assert c.load(fname, loader) == 'foo'
+        assert c.load(fname, loader) == 'foo'
+        assert len(calls) == 1
+        # Different kinds of loaders are cached separately
+        assert c.load(fname, lambda f: 'bar', kind='bar') == 'bar'
+        assert c.load(fname, loader) == 'foo'
+        # Changes to the file should be picked up
+        with open(fname, 'w') as fh:
+            fh.write('foobar')
+        assert c.load(fname, loader) == 'foobar'
+        assert len(calls) == 2
+        c.clear()
+        assert len(c) == 0
+
+
+def test_disk_cache():
+    """Test the DiskCache class"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        c = cache.DiskCache(tmpdir, maxsize=2)
+        assert c.get('a') is None
+        c.put('a', b'1')
+        c.put(('b', 2), b'2')
+        assert c.get('a') == b'1'
+        assert c.get(('b', 2)) == b'2'
+        assert len(c) == 2
+        # Make 'a' the least recently used
+        os.utime(c._get_path('a'), (0, 0))
+        c.put('c', b'3')
+        assert len(c) == 2
+        assert c.get('a') is None
+        c.delete('c')
+        c.delete('c')
+        assert c.get('c', 'default') == 'default'
+        c.clear()
+        assert len(c) == 0
+
+
+def test_page_store():
+    """Test the PageStore class"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        s = cache.PageStore(tmpdir)
+        assert s.get(1, 2, 'v1') is None
+        s.put(1, 2, 'v1', b'page12\nline2')
+        s.put(1, 3, 'v1', b'page13')
+        s.put(2, 3, 'v1', b'page23')
+        assert s.get(1, 2, 'v1') == b'page12\nline2'
+        # Page should not be returned if its version changed
+        assert s.get(1, 2, 'v2') is None
+        assert s.invalidate(build_id=3) == 2
+        assert s.get(1, 3, 'v1') is None
+        assert s.get(1, 2, 'v1') == b'page12\nline2'
+        s.put(2, 3, 'v1', b'page23')
+        assert s.invalidate(system_id=1) == 1
+        assert s.invalidate(system_id=2, build_id=3) == 1
+        assert s.invalidate() == 0
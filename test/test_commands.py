@@ -0,0 +1,155 @@
+import datetime
+import utils
+
+utils.set_search_paths(__file__)
+import systems
+
+sys2 = utils.MockSystem(name="sys2", repo="repo2", title="sys2 title",
+                        pmid=None, prereqs=["modeller", "python/scikit"],
+                        description="sys2 desc", homepage="sys2 home",
+                        tags=["foo", "baz"],
+                        authors=["Smith J", "Jones A", "Jones B"],
+                        journal="Nature", volume="99", pubdate="2014 Dec",
+                        accessions=[], has_thumbnail=True,
+                        github_url='ghurl', github_branch='ghbranch')
+sys2.add_build('main', 1, imp_date="2019-06-15", imp_version="2.11.0",
+               imp_githash="2a", retcode=0, url='url1', use_modeller=True,
+               imp_build_type='fast')
+sys2.add_build('develop', 2, imp_date="2019-06-15", imp_version=None,
+               imp_githash="3a", retcode=0, url='url2', use_modeller=True,
+               imp_build_type='debug')
+sys2.add_build('develop', 3, imp_date="2019-07-15", imp_version=None,
+               imp_githash="4a", retcode=1, url='url3', use_modeller=False,
+               imp_build_type='release')
+
+
+def get_results(system):
+    return dict((branch, [(r.build.id, r.passed) for r in results])
+                for branch, results in system.build_results.items())
+
+
+def add_build(build_id, branch, retcode=None, add_build=True):
+    """Add a new build, and/or a test result for it"""
+    conn = systems.database.get_db()
+    c = conn.cursor()
+    if add_build:
+        c.execute('INSERT INTO sys_build (id, imp_date, imp_githash, '
+                  'imp_branch) VALUES (%s, "2019-07-16", "5a", %s)',
+                  (build_id, branch))
+    if retcode is not None:
+        c.execute('INSERT INTO sys_test (build, sys, retcode) '
+                  'VALUES (%s, 0, %s)', (build_id, retcode))
+    conn.commit()
+
+
+def test_update_results():
+    """Test the update-results command"""
+    with utils.mock_systems(systems.app, [sys2]):
+        runner = systems.app.test_cli_runner()
+        with systems.app.app_context():
+            s, = systems.get_all_systems()
+            systems.add_all_build_results([s])
+            expected = get_results(s)
+            assert systems.database.get_result_summary_mark() is None
+
+        # The newest build of each branch may still be running, so its
+        # results should not be stored
+        r = runner.invoke(args=['update-results'])
+        assert r.exit_code == 0
+        assert 'Added 0 results' in r.output
+        with systems.app.app_context():
+            assert systems.database.get_result_summary_mark() is None
+            add_build(4, 'main')
+            add_build(5, 'develop')
+
+        r = runner.invoke(args=['update-results'])
+        assert r.exit_code == 0
+        assert 'Added 3 results' in r.output
+        r = runner.invoke(args=['update-results'])
+        assert 'Added 0 results' in r.output
+
+        with systems.app.app_context():
+            assert systems.database.get_result_summary_mark() == 3
+            conn = systems.database.get_db()
+            s, = systems.get_all_systems()
+            systems.add_all_build_results([s])
+            assert 'FROM sys_result' in conn.sql[-1]
+            assert get_results(s) == dict(expected, main=[(1, True)])
+            # Results from builds newer than the high-water mark should
+            # still be read from sys_test
+            add_build(4, 'main', retcode=0, add_build=False)
+            s, = systems.get_all_systems()
+            systems.add_all_build_results([s], latest_only=True)
+            assert get_results(s) == {'main': [(4, True)],
+                                      'develop': [(2, True), (3, False)]}
+
+        # Build 4 is still the newest main build, so may gain more results
+        r = runner.invoke(args=['update-results'])
+        assert 'Added 0 results' in r.output
+        with systems.app.app_context():
+            add_build(4, 'main', retcode=1, add_build=False)
+            s, = systems.get_all_systems()
+            systems.add_all_build_results([s], latest_only=True)
+            assert get_results(s)['main'] == [(1, True), (4, False)]
+            add_build(6, 'main')
+            add_build(7, 'develop')
+        r = runner.invoke(args=['update-results'])
+        assert 'Added 1 results' in r.output
+        with systems.app.app_context():
+            assert systems.database.get_result_summary_mark() == 4
+        r = runner.invoke(args=['update-results', '--rebuild'])
+        assert 'Added 4 results' in r.output
+
+
+def test_archive_stderr():
+    """Test the archive-stderr command"""
+    with utils.mock_systems(systems.app, [sys2]):
+        runner = systems.app.test_cli_runner()
+        with systems.app.app_context():
+            conn = systems.database.get_db()
+            c = conn.cursor()
+            c.execute('INSERT INTO sys_test_name (sys, id, name) '
+                      'VALUES (0, 1, "test1")')
+            c.execute('UPDATE sys_test SET name=1, runtime=1, retcode=1, '
+                      'stderr="%s"' % ("Traceback\n" * 100))
+            c.execute('UPDATE sys_test SET stderr="new" WHERE build=3')
+            # Build 3 is too recent to be archived
+            c.execute('UPDATE sys_build SET imp_date=%s WHERE id=3',
+                      (datetime.date.today().isoformat(),))
+            conn.commit()
+            assert not systems.database.has_stderr_archive()
+
+        r = runner.invoke(args=['archive-stderr', '--days', '30'])
+        assert r.exit_code == 0
+        assert 'Archived stderr of 2 tests (1 distinct outputs)' in r.output
+        assert 'Saved ' in r.output
+        r = runner.invoke(args=['archive-stderr'])
+        assert 'Archived stderr of 0 tests' in r.output
+
+        with systems.app.app_context():
+            assert systems.database.has_stderr_archive()
+            conn = systems.database.get_db()
+            c = conn.cursor()
+            c.execute('SELECT build FROM sys_test WHERE stderr IS NULL '
+                      'ORDER BY build')
+            assert [x[0] for x in c] == [1, 2]
+            s, = systems.get_all_systems()
+            systems.add_all_build_results([s])
+            for r in s.build_results['main'] + s.build_results['develop']:
+                t, = r.get_tests()
+                expected = 'new' if r.build.id == 3 else "Traceback\n" * 100
+                assert t.stderr == expected
+                assert systems.database.get_test_stderr(
+                    0, r.build.id, 1) == expected
+            # Short previews don't need the compressed output
+            conn.sql[:] = []
+            t, = s.build_results['main'][0].get_tests(stderr_limit=20)
+            assert t.stderr == "Traceback\nTraceback\n"
+            assert t.stderr_truncated
+            assert 'sys_stderr_blob' not in conn.sql[-1]
+            # Longer previews do
+            limit = systems.database.STDERR_ARCHIVE_PREVIEW_SIZE
+            t, = s.build_results['main'][0].get_tests(stderr_limit=limit)
+            assert t.stderr == "Traceback\n" * 100
+            assert not t.stderr_truncated
+            assert 'sys_stderr_blob' in conn.sql[-1]
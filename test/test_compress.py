@@ -0,0 +1,149 @@
+import utils
+import gzip
+import os
+import sys
+import tempfile
+import pytest
+
+utils.set_search_paths(__file__)
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'util'))
+import precompress
+import systems
+from systems import compress
+
+sys1 = utils.MockSystem(name="sys1", repo="repo1", title="sys1 title",
+                        pmid="1234", prereqs=["modeller", "python/scikit"],
+                        description="sys1 desc", homepage="sys1 home",
+                        tags=["foo", "bar"], authors=["Smith J"],
+                        journal="Nature", volume="99", pubdate="2014 Dec",
+                        accessions=[], github_url='ghurl',
+                        github_branch='ghbranch')
+sys1.add_build('main', 1, imp_date="2019-06-15", imp_version="2.11.0",
+               imp_githash="2a", retcode=0, url='url1', use_modeller=True,
+               imp_build_type='fast')
+
+
+@pytest.fixture
+def no_brotli(monkeypatch):
+    monkeypatch.setattr(compress, 'brotli', None)
+
+
+def test_negotiate_encoding(no_brotli):
+    """Test negotiate_encoding()"""
+    app = systems.app
+    with app.test_request_context(headers={'Accept-Encoding': 'gzip'}):
+        assert compress.negotiate_encoding() == 'gzip'
+        assert compress.negotiate_encoding([]) is None
+    with app.test_request_context(headers={'Accept-Encoding': 'gzip;q=0'}):
+        assert compress.negotiate_encoding() is None
+    with app.test_request_context():
+        assert compress.negotiate_encoding() is None
+
+
+def test_compress_pages(no_brotli):
+    """Test compression of pages"""
+    with utils.mock_systems(systems.app, [sys1]):
+        c = systems.app.test_client()
+        gz = {'Accept-Encoding': 'gzip'}
+        for url in ('/', '/all-builds', '/0'):
+            plain = c.get(url)
+            assert 'Content-Encoding' not in plain.headers
+            assert 'Accept-Encoding' in plain.vary
+            rv = c.get(url, headers=gz)
+            assert rv.status_code == 200
+            assert rv.headers['Content-Encoding'] == 'gzip'
+            assert 'Accept-Encoding' in rv.vary
+            assert gzip.decompress(rv.data) == plain.data
+            # Compressed page should have a weak version of the same ETag
+            etag, weak = rv.get_etag()
+            assert weak
+            assert plain.get_etag() == (etag, False)
+            rv = c.get(url, headers=dict(gz, **{'If-None-Match':
+                                                rv.headers['ETag']}))
+            assert rv.status_code == 304
+
+        # Compressed body should be cached and reused without making
+        # the page again
+        rv = c.get('/0', headers=gz)
+        with systems.app.app_context():
+            nqueries = len(systems.database.get_db().sql)
+        rv2 = c.get('/0', headers=gz)
+        assert rv2.data == rv.data
+        assert rv2.headers['Content-Encoding'] == 'gzip'
+        assert rv2.get_etag() == rv.get_etag()
+        with systems.app.app_context():
+            # Only the queries for the page version should be needed
+            assert len(systems.database.get_db().sql) == nqueries + 1
+
+        # New results change the page version, so the cached compressed
+        # body should not be used
+        with systems.app.app_context():
+            conn = systems.database.get_db()
+            c2 = conn.cursor()
+            c2.execute('INSERT INTO sys_test (build, sys, retcode) '
+                       'VALUES (1, 0, 1)')
+            conn.commit()
+        plain = c.get('/0')
+        rv3 = c.get('/0', headers=gz)
+        assert rv3.get_etag()[0] != rv.get_etag()[0]
+        assert gzip.decompress(rv3.data) == plain.data
+        assert gzip.decompress(rv3.data) != gzip.decompress(rv.data)
+
+        # Errors and small responses are not compressed
+        rv = c.get('/99', headers=gz)
+        assert rv.status_code == 404
+        assert 'Content-Encoding' not in rv.headers
+        rv = c.get('/api/list', headers=gz)
+        assert rv.status_code == 200
+        assert 'Content-Encoding' not in rv.headers
+        systems.app.config['COMPRESS_MIN_SIZE'] = 0
+        try:
+            rv = c.get('/api/list', headers=gz)
+            assert rv.headers['Content-Encoding'] == 'gzip'
+            assert b'"sys1"' in gzip.decompress(rv.data)
+        finally:
+            del systems.app.config['COMPRESS_MIN_SIZE']
+
+
+def test_static_precompressed(no_brotli, monkeypatch):
+    """Test serving of precompressed static files"""
+    monkeypatch.setattr(precompress, 'brotli', None)
+    app = systems.app
+    old_static = app.static_folder
+    with tempfile.TemporaryDirectory() as tmpdir:
+        app.static_folder = tmpdir
+        try:
+            with open(os.path.join(tmpdir, 'test.css'), 'w') as fh:
+                fh.write('body {}\n' * 100)
+            c = app.test_client()
+            gz = {'Accept-Encoding': 'gzip'}
+            # No compressed version yet
+            rv = c.get('/static/test.css', headers=gz)
+            assert 'Content-Encoding' not in rv.headers
+            assert rv.data == b'body {}\n' * 100
+            rv.close()
+            written = precompress.precompress(tmpdir)
+            assert os.path.join(tmpdir, 'test.css.gz') in written
+            # Files already compressed are skipped
+            assert precompress.precompress(tmpdir) == []
+            rv = c.get('/static/test.css', headers=gz)
+            assert rv.headers['Content-Encoding'] == 'gzip'
+            assert rv.mimetype == 'text/css'
+            assert 'Accept-Encoding' in rv.vary
+            assert gzip.decompress(rv.data) == b'body {}\n' * 100
+            rv.close()
+            rv = c.get('/static/test.css')
+            assert 'Content-Encoding' not in rv.headers
+            assert rv.data == b'body {}\n' * 100
+            rv.close()
+            # Out of date compressed files are ignored
+            os.utime(os.path.join(tmpdir, 'test.css.gz'), (0, 0))
+            rv = c.get('/static/test.css', headers=gz)
+            assert 'Content-Encoding' not in rv.headers
+            rv.close()
+            rv = c.get('/static/../test.css', headers=gz)
+            assert rv.status_code == 404
+            rv = c.get('/static/missing.css', headers=gz)
+            assert rv.status_code == 404
+        finally:
+            app.static_folder = old_static
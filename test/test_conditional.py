@@ -0,0 +1,103 @@
+import utils
+import os
+
+utils.set_search_paths(__file__)
+import systems
+from systems import conditional
+
+sys1 = utils.MockSystem(name="sys1", repo="repo1", title="sys1 title",
+                        pmid="1234", prereqs=["modeller", "python/scikit"],
+                        description="sys1 desc", homepage="sys1 home",
+                        tags=["foo", "bar"], authors=["Smith J"],
+                        journal="Nature", volume="99", pubdate="2014 Dec",
+                        accessions=[], github_url='ghurl',
+                        github_branch='ghbranch')
+sys1.add_build('main', 1, imp_date="2019-06-15", imp_version="2.11.0",
+               imp_githash="2a", retcode=0, url='url1', use_modeller=True,
+               imp_build_type='fast')
+
+
+def test_metadata_version():
+    """Test get_metadata_version()"""
+    with utils.mock_systems(systems.app, [sys1]):
+        with systems.app.app_context():
+            v1, t1 = conditional.get_metadata_version()
+            assert t1 is not None
+            assert conditional.get_metadata_version()[0] == v1
+            meta = os.path.join(systems.app.config['SYSTEM_TOP'], 'sys1',
+                                'metadata.yaml')
+            with open(meta, 'a') as fh:
+                fh.write('\n')
+            v2, t2 = conditional.get_metadata_version()
+            assert v2 != v1
+            # Index file takes precedence over individual files
+            index = os.path.join(systems.app.config['SYSTEM_TOP'],
+                                 'index.json')
+            with open(index, 'w') as fh:
+                fh.write('{}')
+            v3, t3 = conditional.get_metadata_version()
+            with open(meta, 'a') as fh:
+                fh.write('\n')
+            assert conditional.get_metadata_version()[0] == v3
+
+
+def test_conditional_get():
+    """Test conditional GET of pages"""
+    with utils.mock_systems(systems.app, [sys1]):
+        c = systems.app.test_client()
+        for url in ('/', '/all-builds', '/0', '/0/build/1', '/api/list'):
+            rv = c.get(url)
+            assert rv.status_code == 200
+            assert len(rv.data) > 0
+            etag = rv.headers['ETag']
+            # Pages showing build results only use ETags
+            if url == '/api/list':
+                assert rv.last_modified is not None
+            else:
+                assert rv.last_modified is None
+            assert rv.cache_control.public
+            assert rv.cache_control.max_age == 300
+            rv = c.get(url, headers={'If-None-Match': etag})
+            assert rv.status_code == 304
+            assert rv.data == b''
+            assert rv.headers['ETag'] == etag
+            rv = c.get(url, headers={'If-None-Match': '"other"'})
+            assert rv.status_code == 200
+            assert len(rv.data) > 0
+            rv = c.get(url, headers={'If-Modified-Since':
+                                     'Thu, 01 Jan 2099 00:00:00 GMT'})
+            assert rv.status_code == (304 if url == '/api/list' else 200)
+        # Errors should not be cached
+        rv = c.get('/99')
+        assert rv.status_code == 404
+        assert 'ETag' not in rv.headers
+
+        rv = c.get('/')
+        etag = rv.headers['ETag']
+        # Make sure the streamed page is complete, so that its database
+        # connection is returned to the pool
+        assert b'sys1' in rv.data
+        with systems.app.app_context():
+            conn = systems.database.get_db()
+            c2 = conn.cursor()
+            c2.execute('INSERT INTO sys_build (id, imp_date, imp_githash, '
+                       'imp_branch) VALUES (2, "2019-07-16", "5a", '
+                       '"develop")')
+            conn.commit()
+        # A new build should change the page
+        rv = c.get('/', headers={'If-None-Match': etag})
+        assert rv.status_code == 200
+        assert rv.headers['ETag'] != etag
+
+        # New results for the newest build should also change the page
+        etag = rv.headers['ETag']
+        assert b'sys1' in rv.data
+        with systems.app.app_context():
+            conn = systems.database.get_db()
+            c2 = conn.cursor()
+            c2.execute('INSERT INTO sys_test (build, sys, retcode) '
+                       'VALUES (2, 0, 0)')
+            conn.commit()
+        rv = c.get('/', headers={'If-None-Match': etag})
+        assert rv.status_code == 200
+        assert rv.headers['ETag'] != etag
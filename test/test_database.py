@@ -1,7 +1,11 @@
 import utils
+import os
+import json
+import pytest
 
 utils.set_search_paths(__file__)
 import systems
+import MySQLdb
 
 sys1 = utils.MockSystem(name="sys1", repo="repo1", title="sys1 title",
                         pmid="1234", prereqs=["modeller", "python/scikit"],
@@ -86,3 +90,298 @@ def test_system_class():
             assert s3.module_prereqs == ['imp', 'modeller', 'python2/scikit']
             # protobuf must use Python 2
             assert s4.module_prereqs == ['imp', 'modeller', 'python2/protobuf']
+
+
+def test_system_file_cache():
+    """Test that system metadata is cached and revalidated"""
+    with utils.mock_systems(systems.app, [sys1]):
+        with systems.app.app_context():
+            s, = systems.get_all_systems()
+            assert s.title == 'sys1 title'
+            assert s.has_thumbnail() is False
+            # Other System objects should share the cache
+            s_new, = systems.get_all_systems()
+            meta = os.path.join(systems.app.config['SYSTEM_TOP'], 'sys1',
+                                'metadata.yaml')
+            assert s_new._metadata is s._metadata
+            # Updated files should be reread
+            with open(meta, 'w') as fh:
+                fh.write('title: new title\n')
+            assert s.title == 'new title'
+            thumb = os.path.join(systems.app.config['SYSTEM_TOP'], 'sys1',
+                                 'thumb.png')
+            open(thumb, 'w').close()
+            assert s.has_thumbnail() is True
+
+
+def test_add_build_info():
+    """Test batch loading of sys_info for build results"""
+    with utils.mock_systems(systems.app, [sys1, sys2]):
+        with systems.app.app_context():
+            all_sys = systems.get_all_systems()
+            systems.database.add_all_build_results(all_sys, info=True)
+            conn = systems.database.get_db()
+            nqueries = len(conn.sql)
+            results = all_sys[1].build_results
+            assert [r.url for r in results['develop']] == ['url2', 'url3']
+            assert results['main'][0].imp_build_type == 'fast'
+            assert results['main'][0].use_modeller == 1
+            # No further queries should have been needed
+            assert len(conn.sql) == nqueries
+
+            # Check fallback to querying individual results
+            all_sys = systems.get_all_systems()
+            systems.database.add_all_build_results(all_sys)
+            result = all_sys[1].build_results['develop'][-1]
+            assert result.url == 'url3'
+            assert result.use_modeller == 0
+            assert len(conn.sql) == nqueries + 3
+
+
+def test_connection_pool():
+    """Test reuse of database connections across requests"""
+    with utils.mock_systems(systems.app, [sys1]):
+        c = systems.app.test_client()
+        c.get('/api/list')
+        pool = systems.database.get_pool()
+        assert len(pool._idle) == 1
+        conn = pool._idle[0][0]
+        rv = c.get('/api/list')
+        assert b'"name": "sys1"' in rv.data
+        assert len(pool._idle) == 1
+        assert pool._idle[0][0] is conn
+        # Dead connections should be replaced
+        conn.close()
+        c.get('/api/list')
+        assert len(pool._idle) == 1
+        assert pool._idle[0][0] is not conn
+
+
+def test_connection_pool_limits():
+    """Test size and idle time limits of the connection pool"""
+    with utils.mock_systems(systems.app, [sys1]):
+        with systems.app.app_context():
+            pool = systems.database.ConnectionPool(
+                systems.database.connect_db, size=1, max_idle=60)
+            conn1 = pool.get()
+            conn2 = pool.get()
+            assert conn1 is not conn2
+            pool.put(conn1)
+            # Pool is full, so this connection should be closed
+            pool.put(conn2)
+            assert conn2.closed
+            assert pool.get() is conn1
+            pool.put(conn1)
+            # Connections idle for too long should be closed
+            pool._idle[0] = (conn1, pool._idle[0][1] - 100)
+            conn3 = pool.get()
+            assert conn3 is not conn1
+            assert conn1.closed
+            # Connections that cannot be rolled back should be closed
+            conn3.close()
+            pool.put(conn3)
+            assert len(pool._idle) == 0
+            pool.put(pool.get())
+            pool.close()
+            assert len(pool._idle) == 0
+
+
+def test_latest_only():
+    """Test loading only the latest build results"""
+    sys5 = utils.MockSystem(name="sys5", repo="repo5", title="sys5 title",
+                            pmid=None, prereqs=[], description="sys5 desc",
+                            homepage="sys5 home", tags=[], authors=[],
+                            journal=None, volume=None, pubdate=None,
+                            accessions=[], github_url='ghurl',
+                            github_branch='ghbranch')
+    for build_id, date, retcode in ((4, "2019-08-01", 0),
+                                    (5, "2019-08-02", 0),
+                                    (6, "2019-08-03", 1),
+                                    (7, "2019-08-04", 1)):
+        sys5.add_build('develop', build_id, imp_date=date, imp_version=None,
+                       imp_githash="5a", retcode=retcode, url='url',
+                       use_modeller=False, imp_build_type='release')
+    with utils.mock_systems(systems.app, [sys2, sys5]):
+        with systems.app.app_context():
+            all_sys = systems.get_all_systems()
+            systems.database.add_all_build_results(all_sys, latest_only=True)
+            s2, s5 = all_sys
+            assert [r.build.id for r in s2.build_results['main']] == [1]
+            assert [r.build.id for r in s2.build_results['develop']] == [2, 3]
+            assert [r.build.id for r in s5.build_results['develop']] == [5, 7]
+            assert [r.passed for r in s5.build_results['develop']] \
+                == [True, False]
+            assert s5.last_build_results['develop'].build.id == 7
+            assert s5.build_results['main'] == []
+
+
+def test_tag_index():
+    """Test the inverted tag index"""
+    with utils.mock_systems(systems.app, [sys1, sys2]):
+        with systems.app.app_context():
+            all_sys = systems.get_all_systems()
+            assert systems.get_tag_index(all_sys) == {
+                'foo': {'sys1', 'sys2'}, 'bar': {'sys1'}, 'baz': {'sys2'}}
+            # Systems in the index should not need their metadata read
+            index = os.path.join(systems.app.config['SYSTEM_TOP'],
+                                 'index.json')
+            with open(index, 'w') as fh:
+                json.dump({'sys1': {'tags': ['foo', 'new']}}, fh)
+            assert systems.get_tag_index(all_sys) == {
+                'foo': {'sys1', 'sys2'}, 'new': {'sys1'}, 'baz': {'sys2'}}
+            assert systems.get_tag_index(all_sys[:1]) == {
+                'foo': {'sys1'}, 'new': {'sys1'}}
+
+
+def test_index_replaced(monkeypatch):
+    """Test values derived from an index replaced while being read"""
+    with utils.mock_systems(systems.app, [sys1]):
+        with systems.app.app_context():
+            all_sys = systems.get_all_systems()
+            index = os.path.join(systems.app.config['SYSTEM_TOP'],
+                                 'index.json')
+            with open(index, 'w') as fh:
+                json.dump({'sys1': {'tags': ['old']}}, fh)
+            old_index = systems.database.get_index()
+            with open(index, 'w') as fh:
+                json.dump({'sys1': {'tags': ['new']}}, fh)
+            # Simulate the index being replaced just after it was read
+            monkeypatch.setattr(systems.database, 'get_index',
+                                lambda: old_index)
+            assert systems.get_tag_index(all_sys) == {'new': {'sys1'}}
+            digests = systems.database.get_index_digests()
+            monkeypatch.undo()
+            systems.database.get_file_cache().clear()
+            assert systems.database.get_index_digests() == digests
+
+
+def test_build_results_subset():
+    """Test loading build results for only a subset of systems"""
+    with utils.mock_systems(systems.app, [sys1, sys2, sys3]):
+        with systems.app.app_context():
+            s1, s2, s3 = systems.get_all_systems()
+            systems.database.add_all_build_results([s2, s3])
+            conn = systems.database.get_db()
+            assert 'WHERE sys IN (%s,%s)' in conn.sql[-1]
+            assert len(s2.build_results['develop']) == 2
+            # Nothing to do for an empty list
+            systems.database.add_all_build_results([])
+            assert 'WHERE sys IN (%s,%s)' in conn.sql[-1]
+
+
+def test_build_matrix():
+    """Test BuildMatrix and get_build_matrix()"""
+    with utils.mock_systems(systems.app, [sys1, sys2]):
+        with systems.app.app_context():
+            all_sys = systems.get_all_systems()
+            window = systems.database.get_build_window('develop', 10)
+            assert [b.id for b in window.builds] == [2, 3]
+            m = systems.database.get_build_matrix(all_sys, window.builds)
+            assert m.system_ids == [0, 1]
+            assert m.get_tested_system_ids() == frozenset([1])
+            assert m.get(2, 0) == m.NONE
+            assert m.get(2, 1) == m.PASS
+            assert m.get(3, 1) == m.FAIL
+            assert m.column(1) == bytes([m.PASS, m.FAIL])
+            assert m.row(0) == bytes([m.NONE, m.PASS])
+            rows = list(m.iter_rows())
+            assert [(b.id, r) for b, r in rows] == [
+                (2, bytes([m.NONE, m.PASS])), (3, bytes([m.NONE, m.FAIL]))]
+            build, passed = m.last_result(1)
+            assert build.id == 3
+            assert not passed
+            assert m.last_pass(1).id == 2
+            assert m.last_result(0) is None
+            assert m.last_pass(0) is None
+            builds, results = m.encode()
+            assert [b.id for b in builds] == [2, 3]
+            assert results == '.p.f'
+            assert m.select_systems([0]).encode() == ([], '')
+            m2 = m.select_systems([1])
+            assert m2.system_ids == [1]
+            assert m2.column(1) == m.column(1)
+            assert [r for b, r in m2.iter_rows()] == [bytes([m.PASS]),
+                                                      bytes([m.FAIL])]
+            assert list(m.select_systems([]).iter_rows()) == []
+            builds = [systems.database.Build(
+                id=i, imp_branch='develop', imp_date=None, imp_version=None,
+                imp_githash=None, modeller_version=None) for i in range(3)]
+            m = systems.database.BuildMatrix(builds, [5, 6, 7])
+            for build in m.builds:
+                for s in (5, 6, 7):
+                    m.set(build.id, s, s != 7)
+            assert m.encode()[1] == '2pf2pf2pf'
+            m = systems.database.get_build_matrix(all_sys, [])
+            assert list(m.iter_rows()) == []
+            # Builds should not take up much space
+            with pytest.raises(AttributeError):
+                build.foo = 'bar'
+
+
+def test_iter_build_results():
+    """Test reading build results with an unbuffered cursor"""
+    with utils.mock_systems(systems.app, [sys1, sys2]):
+        with systems.app.app_context():
+            all_sys = systems.get_all_systems()
+            results = systems.database.iter_build_results(all_sys)
+            r = next(results)
+            assert r.build.id in (1, 2)
+            # Other queries cannot be made until all results are read
+            with pytest.raises(MySQLdb.ProgrammingError):
+                systems.get_all_systems()
+            assert len(list(results)) == 2
+            assert len(systems.get_all_systems()) == 2
+            # Closing the generator early should free the connection
+            results = systems.database.iter_build_results(all_sys)
+            next(results)
+            results.close()
+            assert len(systems.get_all_systems()) == 2
+
+
+def test_get_tests():
+    """Test BuildResult.get_tests()"""
+    with utils.mock_systems(systems.app, [sys2]):
+        with systems.app.app_context():
+            conn = systems.database.get_db()
+            c = conn.cursor()
+            c.execute('INSERT INTO sys_test_name (sys, id, name) '
+                      'VALUES (0, 1, "test1")')
+            c.execute('UPDATE sys_test SET name=1, stderr="err", '
+                      'runtime=10 WHERE build=3')
+            s, = systems.get_all_systems()
+            systems.add_all_build_results([s], build_id=3)
+            t, = s.build_results['develop'][0].get_tests()
+            assert t.name == 'test1'
+            assert t.retcode == 1
+            assert t.stderr == 'err'
+            assert t.runtime == 10
+
+
+def test_get_tests_paged():
+    """Test BuildResult.get_tests() with pagination and truncated stderr"""
+    with utils.mock_systems(systems.app, [sys2]):
+        with systems.app.app_context():
+            conn = systems.database.get_db()
+            c = conn.cursor()
+            c.execute('DELETE FROM sys_test')
+            for i in range(5):
+                c.execute('INSERT INTO sys_test_name (sys, id, name) '
+                          'VALUES (0, %d, "test%d")' % (i + 10, i))
+                c.execute('INSERT INTO sys_test (build, sys, name, retcode, '
+                          'stderr, runtime) VALUES (3, 0, %d, %d, "%s", 1)'
+                          % (i + 10, i % 2, "x" * (i + 3)))
+            conn.commit()
+            s, = systems.get_all_systems()
+            systems.add_all_build_results([s], build_id=3)
+            r = s.build_results['develop'][0]
+            tests = r.get_tests(offset=1, limit=3, stderr_limit=4)
+            assert [t.name for t in tests] == ['test1', 'test2', 'test3']
+            assert [t.id for t in tests] == [11, 12, 13]
+            # Passed tests have no stderr
+            assert [t.stderr for t in tests] == ['xxxx', None, 'xxxx']
+            assert ([t.stderr_truncated for t in tests]
+                    == [False, False, True])
+            assert len(r.get_tests(offset=4, limit=3)) == 1
+            assert (systems.database.get_test_stderr(0, 3, 13)
+                    == 'xxxxxx')
+            assert systems.database.get_test_stderr(0, 3, 99) is None
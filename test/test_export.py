@@ -0,0 +1,213 @@
+import utils
+import json
+import os
+import tempfile
+
+utils.set_search_paths(__file__)
+import systems
+from systems import export
+
+sys1 = utils.MockSystem(name="sys1", repo="repo1", title="sys1 title",
+                        pmid="1234", prereqs=["modeller", "python/scikit"],
+                        description="sys1 desc", homepage="sys1 home",
+                        tags=["foo", "bar"], authors=["Smith J"],
+                        journal="Nature", volume="99", pubdate="2014 Dec",
+                        accessions=[], github_url='ghurl',
+                        github_branch='ghbranch')
+sys1.add_build('main', 1, imp_date="2019-06-15", imp_version="2.11.0",
+               imp_githash="2a", retcode=0, url='url1', use_modeller=True,
+               imp_build_type='fast')
+sys2 = utils.MockSystem(name="sys2", repo="repo2", title="sys2 title",
+                        pmid=None, prereqs=["modeller"],
+                        description="sys2 desc", homepage="sys2 home",
+                        tags=["foo", "baz"], authors=["Smith J"],
+                        journal="Nature", volume="99", pubdate="2014 Dec",
+                        accessions=[], github_url='ghurl',
+                        github_branch='ghbranch')
+sys2.add_build('develop', 2, imp_date="2019-06-16", imp_version=None,
+               imp_githash="3a", retcode=1, url='url2', use_modeller=True,
+               imp_build_type='debug')
+
+
+def read(target, fname):
+    with open(os.path.join(target, fname), 'rb') as fh:
+        return fh.read()
+
+
+def check_export(jobs):
+    with tempfile.TemporaryDirectory() as target:
+        with utils.mock_systems(systems.app, [sys1, sys2]):
+            runner = systems.app.test_cli_runner()
+            r = runner.invoke(args=['export-static', target,
+                                    '--jobs', str(jobs)])
+            assert r.exit_code == 0, r.output
+            assert 'Full export: wrote 15 files for 15 pages' in r.output
+            assert b'sys1 title' in read(target, 'index.html')
+            assert b'sys2 title' in read(target, 'tag/baz.html')
+            assert b'sys1 title' not in read(target, 'tag/baz.html')
+            assert b'buildbox' in read(target, 'all-builds.html')
+            assert b'allbuilds.js' in read(target, 'all-builds-compact.html')
+            assert len(json.loads(read(target, 'api/list.json'))) == 2
+            assert b'sys1 desc' in read(target, '0.html')
+            assert b'<svg' in read(target, '0/badge-main.svg')
+            # No develop builds for sys1
+            assert b'never' in read(target, '0/badge-develop.svg')
+            assert b'does not work' in read(target, '1/build/2.html')
+            assert b'RewriteRule' in read(target, '.htaccess')
+            manifest = json.loads(read(target, export.MANIFEST))
+            assert manifest['builds'] == {'0': [1], '1': [2]}
+            assert manifest['running'] == {'0': {'1': [1, 0]},
+                                           '1': {'2': [1, 1]}}
+
+            # Nothing changed, so nothing to do
+            r = runner.invoke(args=['export-static', target])
+            assert 'Incremental export: wrote 0 files for 0 pages' in r.output
+
+            # New result for a build that may still be running
+            with systems.app.app_context():
+                conn = systems.database.get_db()
+                c = conn.cursor()
+                c.execute('INSERT INTO sys_test (build, sys, retcode) '
+                          'VALUES (1, 0, 1)')
+                conn.commit()
+            r = runner.invoke(args=['export-static', target])
+            assert ('Incremental export: wrote 11 files for 11 pages'
+                    in r.output)
+            assert b'does not work' in read(target, '0/build/1.html')
+            manifest = json.loads(read(target, export.MANIFEST))
+            assert manifest['running']['0'] == {'1': [2, 1]}
+
+            # Changed metadata for sys2 only
+            meta = os.path.join(systems.app.config['SYSTEM_TOP'], 'sys2',
+                                'metadata.yaml')
+            with open(meta, 'a') as fh:
+                fh.write('\n')
+            with systems.app.app_context():
+                pages, full, _ = export.plan_export(manifest,
+                                                    'http://localhost/')
+            assert not full
+            urls = [p.url for p in pages]
+            assert '/1' in urls
+            assert '/1/build/2' in urls
+            assert '/0' not in urls
+            assert '/0/build/1' not in urls
+            assert '/' in urls
+            # A different base URL needs a full export
+            with systems.app.app_context():
+                pages, full, _ = export.plan_export(manifest,
+                                                    'http://localhost/sys/')
+            assert full
+
+
+def test_export():
+    """Test the export-static command"""
+    check_export(jobs=1)
+
+
+def test_export_parallel():
+    """Test the export-static command with multiple processes"""
+    check_export(jobs=2)
+
+
+def test_export_stderr():
+    """Test export of full stderr of tests"""
+    with tempfile.TemporaryDirectory() as target:
+        with utils.mock_systems(systems.app, [sys1, sys2]):
+            with systems.app.app_context():
+                conn = systems.database.get_db()
+                c = conn.cursor()
+                c.execute('INSERT INTO sys_test_name (sys, id, name) '
+                          'VALUES (1, 4, "test1")')
+                c.execute('UPDATE sys_test SET name=4, runtime=1, '
+                          'stderr="%s" WHERE sys=1' % ("x" * 50))
+                conn.commit()
+            systems.app.config['STDERR_PREVIEW_SIZE'] = 10
+            try:
+                with systems.app.app_context():
+                    result = export.export_site(target)
+            finally:
+                del systems.app.config['STDERR_PREVIEW_SIZE']
+            assert result.failed == []
+            assert len(result.pages) == 15
+            assert result.written == 16
+            assert read(target, '1/build/2/test/4.txt') == b'x' * 50
+
+
+def test_export_unsafe_tags():
+    """Test export of tags that are not safe to use in filenames"""
+    sys3 = utils.MockSystem(name="sys3", repo="repo3", title="sys3 title",
+                            pmid=None, prereqs=[], description="sys3 desc",
+                            homepage="sys3 home", tags=["x&y", "a/b", "ok"],
+                            authors=[], journal="Nature", volume="99",
+                            pubdate="2014 Dec", accessions=[],
+                            github_url='ghurl', github_branch='ghbranch')
+    with tempfile.TemporaryDirectory() as target:
+        with utils.mock_systems(systems.app, [sys1, sys3]):
+            with systems.app.app_context():
+                r = export.export_site(target)
+            assert r.failed == []
+            urls = [p.url for p in r.pages]
+            assert '/?tag=x%26y' in urls
+            assert '/?tag=a%2Fb' in urls
+            assert sorted(os.listdir(os.path.join(target, 'tag'))) == [
+                '_612f62.html', '_782679.html', 'bar.html', 'foo.html',
+                'ok.html']
+            assert b'sys3 title' in read(target, 'tag/_782679.html')
+            assert b'sys1 title' not in read(target, 'tag/_782679.html')
+            htaccess = read(target, '.htaccess').decode()
+            assert ('RewriteCond %{QUERY_STRING} (^|&)tag=(a%2Fb)(&|$) [NC]\n'
+                    'RewriteRule ^$ tag/_612f62.html [L]' in htaccess)
+            assert ('RewriteCond %{QUERY_STRING} (^|&)tag=(x%26y)(&|$) [NC]\n'
+                    'RewriteRule ^$ tag/_782679.html [L]' in htaccess)
+
+
+def test_export_subpages():
+    """Test export of further pages of tests, and of build windows"""
+    with tempfile.TemporaryDirectory() as target:
+        with utils.mock_systems(systems.app, [sys1, sys2]):
+            with systems.app.app_context():
+                conn = systems.database.get_db()
+                c = conn.cursor()
+                for i in range(5):
+                    c.execute('INSERT INTO sys_test_name (sys, id, name) '
+                              'VALUES (1, %s, %s)', (i, 'test%d' % i))
+                c.execute('DELETE FROM sys_test WHERE sys=1')
+                for i in range(5):
+                    c.execute('INSERT INTO sys_test (build, sys, name, '
+                              'retcode, stderr, runtime) VALUES '
+                              '(2, 1, %s, 1, %s, 1)', (i, "x" * 50))
+                # Add a second develop build, so there is an older window
+                c.execute('INSERT INTO sys_build (id, imp_date, imp_githash, '
+                          'imp_version, imp_branch) VALUES (3, "2019-06-17",'
+                          ' "4a", "2.12.0", "develop")')
+                c.execute('INSERT INTO sys_test (build, sys, retcode) '
+                          'VALUES (3, 1, 0)')
+                c.execute('INSERT INTO sys_info (sys, build, url, '
+                          'use_modeller, imp_build_type) VALUES '
+                          '(1, 3, "url3", 1, "debug")')
+                conn.commit()
+            config = {'STDERR_PREVIEW_SIZE': 10, 'BUILD_TESTS_PER_PAGE': 2,
+                      'ALL_BUILDS_LIMIT': 1}
+            systems.app.config.update(config)
+            try:
+                with systems.app.app_context():
+                    result = export.export_site(target)
+                client = systems.app.test_client()
+                assert b'Older builds' in client.get('/all-builds').data
+                assert b'More tests' in client.get('/1/build/2').data
+            finally:
+                for key in config:
+                    del systems.app.config[key]
+            assert result.failed == []
+            build_dir = os.path.join(target, '1', 'build', '2')
+            assert sorted(os.listdir(build_dir)) == [
+                'page-2.html', 'page-3.html', 'test']
+            assert len(os.listdir(os.path.join(build_dir, 'test'))) == 5
+            assert b'test4' in read(build_dir, 'page-3.html')
+            assert b'More tests' in read(build_dir, 'page-2.html')
+            assert b'Older builds' not in read(target, 'all-builds.html')
+            assert b'Older builds' not in read(target,
+                                               'all-builds-compact.html')
+            assert ('RewriteRule ^([0-9]+)/build/([0-9]+)$ '
+                    '$1/build/$2/page-%2.html [L]'
+                    in read(target, '.htaccess').decode())
@@ -0,0 +1,67 @@
+import utils
+import os
+import tempfile
+
+utils.set_search_paths(__file__)
+import systems
+
+sys1 = utils.MockSystem(name="sys1", repo="repo1", title="sys1 title",
+                        pmid="1234", prereqs=["modeller", "python/scikit"],
+                        description="sys1 desc", homepage="sys1 home",
+                        tags=["foo", "bar"], authors=["Smith J"],
+                        journal="Nature", volume="99", pubdate="2014 Dec",
+                        accessions=[], github_url='ghurl',
+                        github_branch='ghbranch')
+sys1.add_build('main', 1, imp_date="2019-06-15", imp_version="2.11.0",
+               imp_githash="2a", retcode=0, url='url1', use_modeller=True,
+               imp_build_type='fast')
+
+
+def check_cached_summary(c):
+    rv = c.get('/')
+    assert b'sys1 title' in rv.data
+    cache = systems.fragments.get_fragment_cache()
+    assert len(cache) == 1
+    # Second request should use the cached fragment
+    rv = c.get('/')
+    assert b'sys1 title' in rv.data
+    assert len(cache) == 1
+    # Metadata change should result in a new fragment
+    meta = os.path.join(systems.app.config['SYSTEM_TOP'], 'sys1',
+                        'metadata.yaml')
+    with open(meta, 'w') as fh:
+        fh.write('title: new title\n')
+    rv = c.get('/')
+    assert b'new title' in rv.data
+    assert len(cache) == 2
+
+
+def test_memory_cache():
+    """Test the summary page with in-memory fragment cache"""
+    with utils.mock_systems(systems.app, [sys1]):
+        check_cached_summary(systems.app.test_client())
+
+
+def test_disk_cache():
+    """Test the summary page with on-disk fragment cache"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with utils.mock_systems(systems.app, [sys1]):
+            systems.app.config['FRAGMENT_CACHE'] = 'disk'
+            systems.app.config['FRAGMENT_CACHE_DIR'] = tmpdir
+            try:
+                check_cached_summary(systems.app.test_client())
+            finally:
+                del systems.app.config['FRAGMENT_CACHE']
+
+
+def test_no_cache():
+    """Test the summary page with fragment cache disabled"""
+    with utils.mock_systems(systems.app, [sys1]):
+        systems.app.config['FRAGMENT_CACHE'] = None
+        try:
+            c = systems.app.test_client()
+            rv = c.get('/')
+            assert b'sys1 title' in rv.data
+            assert systems.fragments.get_fragment_cache() is None
+        finally:
+            del systems.app.config['FRAGMENT_CACHE']
@@ -1,4 +1,6 @@
 import utils
+import flask
+import json
 
 utils.set_search_paths(__file__)
 import systems
@@ -34,7 +36,15 @@ def test_summary_all_tags():
     """Test the summary page with all tags shown"""
     with utils.mock_systems(systems.app, [sys1, sys2]):
         c = systems.app.test_client()
-        rv = c.get('/')
+        rendered = []
+
+        def record(sender, template, context, **extra):
+            rendered.append(template.name)
+        with flask.template_rendered.connected_to(record, systems.app):
+            rv = c.get('/')
+            assert rv.is_streamed
+            rv.get_data()
+        assert 'summary.html' in rendered
         assert b'<a class="sysmore" href="sys1 home">[more...]</a>' in rv.data
         assert b'<a class="sysmore" href="sys2 home">[more...]</a>' in rv.data
         assert b'<a class="tag" href="?tag=foo">foo</a>' in rv.data
@@ -62,6 +72,8 @@ def test_all_builds():
     with utils.mock_systems(systems.app, [sys1, sys2]):
         c = systems.app.test_client()
         rv = c.get('/all-builds')
+        # Page should be streamed
+        assert rv.is_streamed
         assert (b'<a class="buildbox build_fail" title="Build failed"'
                 in rv.data)
         assert b'<a class="buildbox build_ok" title="Build OK"' in rv.data
@@ -82,6 +94,60 @@ def test_build_ok():
         c = systems.app.test_client()
         rv = c.get('/1/build/1')
         assert b'has been verified to work with:' in rv.data
+        assert b'<a href="url1">these input files</a>' in rv.data
+        assert b'(fast build)' in rv.data
+
+
+def test_build_tests():
+    """Test the list of tests on the build information page"""
+    with utils.mock_systems(systems.app, [sys1, sys2]):
+        with systems.app.app_context():
+            conn = systems.database.get_db()
+            c = conn.cursor()
+            c.execute('DELETE FROM sys_test WHERE sys=1 AND build=3')
+            for i in range(3):
+                c.execute('INSERT INTO sys_test_name (sys, id, name) '
+                          'VALUES (1, %d, "test%d")' % (i, i))
+                c.execute('INSERT INTO sys_test (build, sys, name, retcode, '
+                          'stderr, runtime) VALUES (3, 1, %d, 1, "%s", 1)'
+                          % (i, "0123456789" * (i + 1)))
+            conn.commit()
+        systems.app.config['BUILD_TESTS_PER_PAGE'] = 2
+        systems.app.config['STDERR_PREVIEW_SIZE'] = 15
+        try:
+            c = systems.app.test_client()
+            rv = c.get('/1/build/3')
+            assert b'<pre>0123456789</pre>' in rv.data
+            assert b'<pre>012345678901234</pre>' in rv.data
+            assert b'/1/build/3/test/0/stderr' not in rv.data
+            assert b'/1/build/3/test/1/stderr' in rv.data
+            assert b'test2' not in rv.data
+            assert b'/1/build/3?page=2' in rv.data
+            rv = c.get('/1/build/3?page=2')
+            assert b'test2' in rv.data
+            assert b'test1' not in rv.data
+            assert b'/1/build/3?page=3' not in rv.data
+            assert b'href="/1/build/3"' in rv.data
+            rv = c.get('/1/build/3?page=3')
+            assert rv.status_code == 404
+            rv = c.get('/1/build/3?page=0')
+            assert rv.status_code == 404
+        finally:
+            del systems.app.config['BUILD_TESTS_PER_PAGE']
+            del systems.app.config['STDERR_PREVIEW_SIZE']
+
+        rv = c.get('/1/build/3/test/2/stderr')
+        assert rv.status_code == 200
+        assert rv.mimetype == 'text/plain'
+        assert rv.data == b'0123456789' * 3
+        assert rv.headers['Accept-Ranges'] == 'bytes'
+        rv = c.get('/1/build/3/test/2/stderr',
+                   headers={'Range': 'bytes=25-'})
+        assert rv.status_code == 206
+        assert rv.data == b'56789'
+        assert rv.headers['Content-Range'] == 'bytes 25-29/30'
+        rv = c.get('/1/build/3/test/9/stderr')
+        assert rv.status_code == 404
 
 
 def test_unknown_build():
@@ -136,8 +202,20 @@ def test_badge_ok():
     with utils.mock_systems(systems.app, [sys2]):
         c = systems.app.test_client()
         rv = c.get('/0/badge.svg?branch=main')
-        assert b'stable release-2.11.0-brightgreen.svg' in rv.data
-        assert rv.status_code == 302
+        assert rv.status_code == 200
+        assert rv.mimetype == 'image/svg+xml'
+        assert b'aria-label="stable release: 2.11.0"' in rv.data
+        assert b'fill="#4c1"' in rv.data
+        # Badge should be cached
+        with systems.app.app_context():
+            nqueries = len(systems.database.get_db().sql)
+        rv2 = c.get('/0/badge.svg?branch=main')
+        assert rv2.data == rv.data
+        with systems.app.app_context():
+            assert len(systems.database.get_db().sql) == nqueries
+        rv = c.get('/0/badge.svg?branch=main',
+                   headers={'If-None-Match': rv.headers['ETag']})
+        assert rv.status_code == 304
 
 
 def test_badge_ok_master():
@@ -145,8 +223,8 @@ def test_badge_ok_master():
     with utils.mock_systems(systems.app, [sys2]):
         c = systems.app.test_client()
         rv = c.get('/0/badge.svg?branch=master')
-        assert b'stable release-2.11.0-brightgreen.svg' in rv.data
-        assert rv.status_code == 302
+        assert b'aria-label="stable release: 2.11.0"' in rv.data
+        assert rv.status_code == 200
 
 
 def test_badge_failed():
@@ -154,8 +232,9 @@ def test_badge_failed():
     with utils.mock_systems(systems.app, [sys1]):
         c = systems.app.test_client()
         rv = c.get('/0/badge.svg?branch=develop')
-        assert b'nightly build-never-red.svg' in rv.data
-        assert rv.status_code == 302
+        assert b'aria-label="nightly build: never"' in rv.data
+        assert b'fill="#e05d44"' in rv.data
+        assert rv.status_code == 200
 
 
 def test_badge_bad():
@@ -185,3 +264,90 @@ def test_badge_old_master():
         rv = c.get('/?sysstat=0&branch=master')
         assert b'"/0/badge.svg?branch=main"' in rv.data
         assert rv.status_code == 301
+
+
+def test_all_builds_compact():
+    """Test the compact all-builds page"""
+    with utils.mock_systems(systems.app, [sys1, sys2]):
+        with systems.app.app_context():
+            conn = systems.database.get_db()
+            c = conn.cursor()
+            c.execute('UPDATE sys_build SET imp_version=NULL '
+                      'WHERE imp_version="None"')
+            conn.commit()
+        c = systems.app.test_client()
+        rv = c.get('/all-builds?compact=1&branch=develop&limit=1')
+        assert rv.status_code == 200
+        assert b'buildbox' not in rv.data
+        assert b'/static/allbuilds.js' in rv.data
+        # Non-JS clients are sent to the plain page
+        assert (b'url=/all-builds?branch=develop&amp;limit=1">'
+                in rv.data)
+        assert (b'<a href="/all-builds?branch=develop&amp;before=3&amp;'
+                b'limit=1&amp;compact=1">' in rv.data)
+        start = rv.data.index(b'id="allbuilds_data">') + 20
+        end = rv.data.index(b'</script>', start)
+        data = json.loads(rv.data[start:end])
+        assert data == {'root': '/',
+                        'systems': [[1, 'sys2', 'sys2 home']],
+                        'tables': {'develop': {
+                            'builds': [[3, '2019-07-15']],
+                            'results': 'f'}}}
+        rv = c.get('/all-builds?compact=1')
+        assert b'id="allbuilds_main"' in rv.data
+        assert b'id="allbuilds_develop"' in rv.data
+
+
+def test_all_builds_window():
+    """Test windowing of the all-builds page"""
+    with utils.mock_systems(systems.app, [sys1, sys2]):
+        c = systems.app.test_client()
+        rv = c.get('/all-builds?branch=develop&limit=1')
+        assert b'/1/build/3' in rv.data
+        assert b'/1/build/2' not in rv.data
+        assert b'/1/build/1' not in rv.data
+        assert (b'<a href="/all-builds?branch=develop&amp;before=3&amp;'
+                b'limit=1">&laquo; Older builds</a>' in rv.data)
+        assert b'Newer builds' not in rv.data
+
+        rv = c.get('/all-builds?branch=develop&limit=1&before=3')
+        assert b'/1/build/2' in rv.data
+        assert b'/1/build/3' not in rv.data
+        assert b'Older builds' not in rv.data
+        assert (b'<a href="/all-builds?branch=develop&amp;since=2&amp;'
+                b'limit=1">Newer builds &raquo;</a>' in rv.data)
+
+        rv = c.get('/all-builds?branch=develop&limit=1&since=2')
+        assert b'/1/build/3' in rv.data
+        assert b'/1/build/2' not in rv.data
+        assert b'Older builds' in rv.data
+        assert b'Newer builds' not in rv.data
+
+        rv = c.get('/all-builds?branch=develop&since=3')
+        assert b'Older builds' not in rv.data
+
+        rv = c.get('/all-builds?branch=foo')
+        assert rv.status_code == 400
+
+
+def test_badge_nightly():
+    """Test badge for a nightly build without a version number"""
+    with utils.mock_systems(systems.app, [sys2]):
+        c = systems.app.test_client()
+        systems.app.config['BADGE_CACHE_TTL'] = 0
+        with systems.app.app_context():
+            conn = systems.database.get_db()
+            conn.cursor().execute('UPDATE sys_build SET imp_version=NULL')
+            conn.commit()
+        try:
+            rv = c.get('/0/badge.svg?branch=develop')
+            assert b'aria-label="nightly build: 2019-06-15"' in rv.data
+            assert rv.cache_control.max_age == 0
+            with systems.app.app_context():
+                nqueries = len(systems.database.get_db().sql)
+            # Expired badge should be regenerated
+            c.get('/0/badge.svg?branch=develop')
+            with systems.app.app_context():
+                assert len(systems.database.get_db().sql) > nqueries
+        finally:
+            del systems.app.config['BADGE_CACHE_TTL']
@@ -0,0 +1,87 @@
+import utils
+import os
+import tempfile
+
+utils.set_search_paths(__file__)
+import systems
+
+sys1 = utils.MockSystem(name="sys1", repo="repo1", title="sys1 title",
+                        pmid="1234", prereqs=["modeller", "python/scikit"],
+                        description="sys1 desc", homepage="sys1 home",
+                        tags=["foo", "bar"], authors=["Smith J"],
+                        journal="Nature", volume="99", pubdate="2014 Dec",
+                        accessions=[], github_url='ghurl',
+                        github_branch='ghbranch')
+sys1.add_build('main', 1, imp_date="2019-06-15", imp_version="2.11.0",
+               imp_githash="2a", retcode=0, url='url1', use_modeller=True,
+               imp_build_type='fast')
+sys1.add_build('develop', 2, imp_date="2019-06-15", imp_version=None,
+               imp_githash="3a", retcode=0, url='url2', use_modeller=True,
+               imp_build_type='debug')
+sys1.add_build('develop', 3, imp_date="2019-07-15", imp_version=None,
+               imp_githash="4a", retcode=1, url='url3', use_modeller=False,
+               imp_build_type='release')
+
+
+def test_build_page_store():
+    """Test storage of completed build pages"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with utils.mock_systems(systems.app, [sys1]):
+            systems.app.config['BUILD_PAGE_CACHE_DIR'] = tmpdir
+            try:
+                c = systems.app.test_client()
+                rv = c.get('/0/build/2')
+                assert b'has been verified to work with:' in rv.data
+                assert os.path.exists(os.path.join(tmpdir, '0', '2.html'))
+                # Stored page should be served without getting build
+                # results; only the system needs to be looked up
+                with systems.app.app_context():
+                    nqueries = len(systems.database.get_db().sql)
+                rv2 = c.get('/0/build/2')
+                assert rv2.data == rv.data
+                # Pages can still change (e.g. with system metadata) so
+                # should be revalidated
+                assert not rv2.cache_control.immutable
+                assert rv2.cache_control.max_age == 300
+                with systems.app.app_context():
+                    assert len(systems.database.get_db().sql) == nqueries + 1
+                rv = c.get('/0/build/2',
+                           headers={'If-None-Match': rv2.headers['ETag']})
+                assert rv.status_code == 304
+
+                # Changed metadata should not use the stored page
+                meta = os.path.join(systems.app.config['SYSTEM_TOP'],
+                                    'sys1', 'metadata.yaml')
+                with open(meta) as fh:
+                    contents = fh.read()
+                with open(meta, 'w') as fh:
+                    fh.write(contents.replace('sys1 title', 'new title'))
+                rv = c.get('/0/build/2')
+                assert b'new title' in rv.data
+                assert b'new title' in c.get('/0/build/2').data
+
+                # Most recent builds of each branch may not be complete
+                for build_id in (1, 3):
+                    rv = c.get('/0/build/%d' % build_id)
+                    assert rv.status_code == 200
+                    assert not rv.cache_control.immutable
+                    assert rv.cache_control.max_age == 300
+                assert os.listdir(os.path.join(tmpdir, '0')) == ['2.html']
+
+                runner = systems.app.test_cli_runner()
+                r = runner.invoke(args=['invalidate-build-pages',
+                                        '--system', '0', '--build', '9'])
+                assert 'Removed 0 pages' in r.output
+                r = runner.invoke(args=['invalidate-build-pages'])
+                assert 'Removed 1 pages' in r.output
+            finally:
+                del systems.app.config['BUILD_PAGE_CACHE_DIR']
+
+
+def test_invalidate_no_store():
+    """Test invalidate-build-pages command without a store"""
+    with utils.mock_systems(systems.app, [sys1]):
+        runner = systems.app.test_cli_runner()
+        r = runner.invoke(args=['invalidate-build-pages'])
+        assert r.exit_code != 0
+        assert 'BUILD_PAGE_CACHE_DIR is not set' in r.output
@@ -0,0 +1,660 @@
+import utils
+import base64
+import collections
+import gzip
+import pytest
+import tempfile
+import urllib.error
+import urllib.parse
+import os
+import sys
+import json
+import threading
+import time
+from pathlib import Path
+
+utils.set_search_paths(__file__)
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'util'))
+import update_metadata
+import systems
+
+sys1 = utils.MockSystem(name="sys1", repo="repo1", title="sys1 title",
+                        pmid="1234", prereqs=["modeller", "python/scikit"],
+                        description="sys1 desc", homepage="sys1 home",
+                        tags=["foo", "bar"], authors=["Smith J"],
+                        journal="Nature", volume="99", pubdate="2014 Dec",
+                        accessions=['PDBDEV_00000001', 'foo'],
+                        github_url='ghurl', github_branch='ghbranch',
+                        readme='foobar')
+sys2 = utils.MockSystem(name="sys2", repo="repo2", title="sys2 title",
+                        pmid=None, prereqs=["modeller", "python/scikit"],
+                        description="sys2 desc", homepage="sys2 home",
+                        tags=["foo", "baz"],
+                        authors=["Smith J", "Jones A", "Jones B"],
+                        journal="Nature", volume="99", pubdate="2014 Dec",
+                        accessions=[], has_thumbnail=True,
+                        github_url='ghurl', github_branch='ghbranch')
+
+
+def test_format_citation():
+    """Test format_citation()"""
+    authors = [{'name': 'Smith J', 'authtype': 'Author'},
+               {'name': 'Jones A', 'authtype': 'Author'},
+               {'name': 'Some Consortium', 'authtype': 'CollectiveName'}]
+    pub = {'result': {'uids': ['1234'],
+                      '1234': {'pubdate': '2014 Dec', 'source': 'Nature',
+                               'authors': authors, 'volume': '99'}}}
+    assert (update_metadata.format_citation(pub)
+            == 'Smith J, Jones A. Nature 99, 2014')
+    authors.insert(0, {'name': 'Doe J', 'authtype': 'Author'})
+    assert (update_metadata.format_citation(pub)
+            == 'Doe J, Smith J et al. Nature 99, 2014')
+
+
+def test_write_index():
+    """Test writing and reading the consolidated index"""
+    with utils.mock_systems(systems.app, [sys1, sys2]):
+        root = Path(systems.app.config['SYSTEM_TOP'])
+        u = update_metadata.FileUpdater(root=root, auth=None)
+        u.write_index(['sys1', 'sys2', 'not_downloaded'])
+        with open(root / 'index.json') as fh:
+            index = json.load(fh)
+        assert sorted(index.keys()) == ['sys1', 'sys2']
+        assert index['sys1']['pubmed_title'] == 'Smith J. Nature 99, 2014'
+        assert index['sys1']['tags'] == ['foo', 'bar']
+        assert index['sys1']['has_thumbnail'] is False
+        assert index['sys2']['pubmed_title'] is None
+        assert index['sys2']['has_thumbnail'] is True
+        assert index['sys2']['github']['homepage'] == 'sys2 home'
+        # No temporary files should be left behind
+        assert sorted(os.listdir(root)) == ['index.json', 'sys1', 'sys2']
+
+        # Web server should use the index rather than the individual files
+        os.unlink(root / 'sys1' / 'metadata.yaml')
+        os.unlink(root / 'sys2' / 'thumb.png')
+        with systems.app.app_context():
+            s1, s2 = systems.get_all_systems()
+            assert s1.title == 'sys1 title'
+            assert s1.pubmed_title == 'Smith J. Nature 99, 2014'
+            assert s1.homepage == 'sys1 home'
+            assert s2.has_thumbnail() is True
+            assert s2.pubmed_title is None
+
+
+def test_host_limiter():
+    """Test HostLimiter"""
+    limiter = update_metadata.HostLimiter(max_per_host=2)
+    lock = threading.Lock()
+    active = collections.Counter()
+    peak = collections.Counter()
+
+    def fetch(url):
+        host = url.split('/')[2]
+        with limiter.limit(url):
+            with lock:
+                active[host] += 1
+                peak[host] = max(peak[host], active[host])
+            time.sleep(0.02)
+            with lock:
+                active[host] -= 1
+
+    urls = ['https://a.org/%d' % i for i in range(6)] \
+        + ['https://b.org/%d' % i for i in range(2)]
+    threads = [threading.Thread(target=fetch, args=(url,)) for url in urls]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert peak == {'a.org': 2, 'b.org': 2}
+
+
+def test_update_all():
+    """Test updating many systems in parallel"""
+    class MockUpdater(update_metadata.FileUpdater):
+        def __init__(self):
+            super().__init__(root=None, auth=None)
+            self.lock = threading.Lock()
+            self.active = self.peak = 0
+
+        def update(self, name, repo):
+            with self.lock:
+                self.active += 1
+                self.peak = max(self.peak, self.active)
+            time.sleep(0.02)
+            with self.lock:
+                self.active -= 1
+            if repo == 'bad':
+                raise ValueError("Could not parse repo %s" % repo)
+
+    u = MockUpdater()
+    report = u.update_all([('sys%d' % i, 'bad' if i == 2 else 'good')
+                           for i in range(8)], workers=4)
+    assert u.peak == 4
+    assert report.updated == ['sys0', 'sys1', 'sys3', 'sys4', 'sys5',
+                              'sys6', 'sys7']
+    assert list(report.failures.keys()) == ['sys2']
+    assert 'ValueError: Could not parse repo bad' in report.failures['sys2']
+    text = report.format()
+    assert text.startswith('Updated 7 systems, 1 failed')
+    assert 'sys2 failed:' in text
+
+
+def make_pubmed_json(pmid):
+    return {'result': {'uids': [pmid],
+                       pmid: {'pubdate': '2014 Dec', 'source': 'Nature',
+                              'volume': '99',
+                              'authors': [{'name': 'Smith J',
+                                           'authtype': 'Author'}]}}}
+
+
+def make_contents_json(contents):
+    return json.dumps({'encoding': 'base64',
+                       'content': base64.b64encode(contents).decode()})
+
+
+def make_listing_json(shas):
+    return json.dumps([{'name': name, 'type': 'file', 'sha': sha}
+                       for name, sha in sorted(shas.items())])
+
+
+def test_http_client():
+    """Test HTTPClient"""
+    with utils.MockWebServer() as server:
+        delays = []
+        client = update_metadata.HTTPClient()
+        client._sleep = delays.append
+        server.add('/gzip', gzip.compress(b'hello'),
+                   headers={'Content-Encoding': 'gzip'})
+        server.add('/plain', 'world')
+        assert client.get(server.url + '/gzip').read() == b'hello'
+        r = client.get(server.url + '/plain')
+        assert r.status == 200
+        assert r.read() == b'world'
+        # Connection should have been reused
+        assert len(set(req[4] for req in server.requests)) == 1
+        assert server.requests[0][2]['Accept-Encoding'] == 'gzip'
+
+        # Server errors should be retried with backoff
+        server.add('/flaky', status=503)
+        server.add('/flaky', status=502)
+        server.add('/flaky', 'ok')
+        assert client.get(server.url + '/flaky').read() == b'ok'
+        assert delays == [1.0, 2.0]
+
+        # Rate limits should be retried after the time given
+        del delays[:]
+        server.add('/limited', 'You have exceeded a secondary rate limit',
+                   status=403, headers={'Retry-After': '7'})
+        server.add('/limited', 'ok')
+        assert client.get(server.url + '/limited').read() == b'ok'
+        assert delays == [7]
+
+        # Redirects should be followed
+        server.add('/moved', status=301, headers={'Location': '/plain'})
+        assert client.get(server.url + '/moved').read() == b'world'
+
+        # Other errors should not be retried
+        del delays[:]
+        server.add('/forbidden', 'no', status=403)
+        with pytest.raises(urllib.error.HTTPError) as exc:
+            client.get(server.url + '/forbidden')
+        assert exc.value.code == 403
+        with pytest.raises(urllib.error.HTTPError) as exc:
+            client.get(server.url + '/missing')
+        assert exc.value.code == 404
+        assert delays == []
+
+        # Give up eventually
+        client.retries = 2
+        server.add('/broken', status=500)
+        with pytest.raises(urllib.error.HTTPError) as exc:
+            client.get(server.url + '/broken')
+        assert exc.value.code == 500
+        assert delays == [1.0, 2.0]
+        client.close()
+        # A new connection should be made if the old one was closed
+        assert client.get(server.url + '/plain').read() == b'world'
+
+
+def test_update_system():
+    """Test updating a single system from GitHub and PubMed stand-ins"""
+    with utils.MockWebServer() as server:
+        root = '/repos/salilab/foo'
+        server.add(root, json.dumps({'description': 'foo desc',
+                                     'homepage': 'foo home'}),
+                   headers={'Last-Modified': 'Mon, 01 Jun 2020 00:00:00 GMT'})
+        server.add(root + '/readme', '<a href="doc.md">doc</a>',
+                   headers={'ETag': '"readme1"'})
+        server.add(root + '/contents/metadata',
+                   make_listing_json({'metadata.yaml': 'sha1'}),
+                   headers={'ETag': '"listing1"'})
+        server.add(root + '/contents/metadata/metadata.yaml',
+                   make_contents_json(b'title: foo\npmid: 1234\n'))
+        server.add('/esummary.fcgi',
+                   gzip.compress(json.dumps(
+                       make_pubmed_json('1234')).encode()),
+                   headers={'Content-Encoding': 'gzip'})
+        with tempfile.TemporaryDirectory() as tmpdir:
+            u = update_metadata.FileUpdater(
+                root=Path(tmpdir), auth={'password': 'secret'},
+                github_api=server.url, eutils_api=server.url)
+
+            def update():
+                report = u.update_all([('foo', 'https://github.com/'
+                                               'salilab/foo')], workers=1)
+                assert report.failures == {}
+            update()
+            d = Path(tmpdir) / 'foo'
+            with open(d / 'github.json') as fh:
+                g = json.load(fh)
+            assert g['homepage'] == 'foo home'
+            assert g['Last-Modified'] == 'Mon, 01 Jun 2020 00:00:00 GMT'
+            with open(d / 'readme.html') as fh:
+                assert fh.read() == ('<a href="https://github.com/salilab/'
+                                     'foo/tree/main/doc.md">doc</a>')
+            with open(d / 'metadata.yaml') as fh:
+                assert fh.read() == 'title: foo\npmid: 1234\n'
+            with open(d / 'pubmed.json') as fh:
+                assert json.load(fh) == make_pubmed_json('1234')
+            assert not os.path.exists(d / 'thumb.png')
+            assert (server.requests[0][2]['Authorization']
+                    == 'Bearer secret')
+            assert [r[1].split('?')[0] for r in server.requests] == [
+                root, root + '/readme', root + '/contents/metadata',
+                root + '/contents/metadata/metadata.yaml', '/esummary.fcgi']
+            assert server.requests[-1][1].endswith('&id=1234')
+            # All requests should have used a single connection
+            assert len(set(req[4] for req in server.requests)) == 1
+
+            # Nothing changed, so only the repository should be checked
+            server.clear(root)
+            server.add(root, status=304)
+            server.add(root + '/commits/HEAD', status=304)
+            nreq = len(server.requests)
+            update()
+            assert [r[1] for r in server.requests[nreq:]] == [
+                root, root + '/commits/HEAD']
+            assert (server.requests[-1][2]['If-Modified-Since']
+                    == 'Mon, 01 Jun 2020 00:00:00 GMT')
+
+            # Repository changed, but readme and metadata files did not
+            server.clear(root)
+            server.add(root, json.dumps({'description': 'new desc'}),
+                       headers={'Last-Modified':
+                                'Tue, 02 Jun 2020 00:00:00 GMT'})
+            server.clear(root + '/readme')
+            server.add(root + '/readme', status=304)
+            server.clear(root + '/contents/metadata')
+            server.add(root + '/contents/metadata', status=304)
+            nreq = len(server.requests)
+            update()
+            reqs = server.requests[nreq:]
+            assert [r[1] for r in reqs] == [
+                root, root + '/readme', root + '/contents/metadata']
+            assert reqs[1][2]['If-None-Match'] == '"readme1"'
+            assert reqs[2][2]['If-None-Match'] == '"listing1"'
+            with open(d / 'readme.html') as fh:
+                assert 'doc.md' in fh.read()
+
+            # New metadata.yaml with the same PubMed ID, plus a thumbnail
+            server.clear(root + '/contents/metadata')
+            server.add(root + '/contents/metadata',
+                       make_listing_json({'metadata.yaml': 'sha2',
+                                          'thumb.png': 'sha3'}),
+                       headers={'ETag': '"listing2"'})
+            server.clear(root + '/contents/metadata/metadata.yaml')
+            server.add(root + '/contents/metadata/metadata.yaml',
+                       make_contents_json(b'title: bar\npmid: 1234\n'))
+            server.add(root + '/contents/metadata/thumb.png',
+                       make_contents_json(b'PNG'))
+            nreq = len(server.requests)
+            update()
+            assert [r[1] for r in server.requests[nreq + 3:]] == [
+                root + '/contents/metadata/metadata.yaml',
+                root + '/contents/metadata/thumb.png']
+            with open(d / 'metadata.yaml') as fh:
+                assert fh.read() == 'title: bar\npmid: 1234\n'
+            with open(d / 'thumb.png', 'rb') as fh:
+                assert fh.read() == b'PNG'
+
+            # Changed PubMed ID, so PubMed should be queried again; the
+            # unchanged thumbnail should not be fetched
+            server.clear(root + '/contents/metadata')
+            server.add(root + '/contents/metadata',
+                       make_listing_json({'metadata.yaml': 'sha4',
+                                          'thumb.png': 'sha3'}))
+            server.clear(root + '/contents/metadata/metadata.yaml')
+            server.add(root + '/contents/metadata/metadata.yaml',
+                       make_contents_json(b'title: bar\npmid: 5678\n'))
+            server.clear('/esummary.fcgi')
+            server.add('/esummary.fcgi',
+                       json.dumps(make_pubmed_json('5678')))
+            nreq = len(server.requests)
+            update()
+            assert [r[1].split('?')[0] for r in server.requests[nreq + 3:]] \
+                == [root + '/contents/metadata/metadata.yaml',
+                    '/esummary.fcgi']
+            assert server.requests[-1][1].endswith('&id=5678')
+            with open(d / 'pubmed.json') as fh:
+                assert json.load(fh) == make_pubmed_json('5678')
+
+            # Missing local files should be fetched again, even if unchanged
+            os.unlink(d / 'readme.html')
+            os.unlink(d / 'thumb.png')
+            server.clear(root + '/readme')
+            server.add(root + '/readme', 'new readme')
+            nreq = len(server.requests)
+            update()
+            reqs = server.requests[nreq:]
+            assert 'If-None-Match' not in reqs[1][2]
+            assert 'If-None-Match' not in reqs[2][2]
+            assert reqs[-1][1] == root + '/contents/metadata/thumb.png'
+            with open(d / 'readme.html') as fh:
+                assert fh.read() == 'new readme'
+
+
+def test_update_pubmed(monkeypatch):
+    """Test batched PubMed lookups and the PubMed cache"""
+    def esummary(method, path, headers, body):
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(path).query)
+        pmids = query['id'][0].split(',')
+        if '7' in pmids:
+            return 400, {}, 'bad request'
+        result = {'uids': pmids}
+        for pmid in pmids:
+            result[pmid] = ({'error': 'cannot get document summary'}
+                            if pmid == '999'
+                            else make_pubmed_json(pmid)['result'][pmid])
+        return 200, {}, json.dumps({'result': result})
+
+    monkeypatch.setattr(update_metadata, 'PUBMED_BATCH_SIZE', 2)
+    with utils.MockWebServer() as server:
+        server.add('/esummary.fcgi', esummary)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            root = Path(tmpdir)
+            u = update_metadata.FileUpdater(root=root, auth=None,
+                                            eutils_api=server.url)
+            pmids = {'sys1': '1', 'sys2': '2', 'sys3': '1', 'sys4': '3',
+                     'sys5': '4'}
+            for name, pmid in pmids.items():
+                (root / name).mkdir()
+                u.update_metadata(name, 'title: %s\npmid: %s\n'
+                                  % (name, pmid))
+            # No PubMed ID
+            u.update_metadata('sys6', 'title: sys6\n')
+            assert u.update_pubmed() == {}
+            # 4 unique IDs should be fetched in 2 batches
+            assert [r[1].split('&id=')[1] for r in server.requests] == [
+                '1,2', '3,4']
+            for name, pmid in pmids.items():
+                with open(root / name / 'pubmed.json') as fh:
+                    assert json.load(fh) == make_pubmed_json(pmid)
+            assert not os.path.exists(root / 'sys6' / 'pubmed.json')
+
+            # Unchanged IDs should not be looked up again
+            u.update_metadata('sys1', 'pmid: 1\n')
+            assert u.pubmed_queue == {}
+            # Cached IDs should not be fetched again
+            u.update_metadata('sys1', 'pmid: 2\n')
+            u.update_metadata('sys2', 'pmid: 999\n')
+            nreq = len(server.requests)
+            failures = u.update_pubmed()
+            assert list(failures.keys()) == ['sys2']
+            assert 'No PubMed summary found for 999' in failures['sys2']
+            assert [r[1].split('&id=')[1]
+                    for r in server.requests[nreq:]] == ['999']
+            with open(root / 'sys1' / 'pubmed.json') as fh:
+                assert json.load(fh) == make_pubmed_json('2')
+            # Failed lookup should leave the old summary in place
+            with open(root / 'sys2' / 'pubmed.json') as fh:
+                assert json.load(fh) == make_pubmed_json('2')
+
+            # Expired entries should be fetched again
+            u.pubmed_ttl = 0.
+            u.update_metadata('sys1', 'pmid: 3\n')
+            nreq = len(server.requests)
+            assert u.update_pubmed() == {}
+            assert [r[1].split('&id=')[1]
+                    for r in server.requests[nreq:]] == ['3']
+            cache = update_metadata.PubMedCache(
+                root / update_metadata.PUBMED_CACHE_FILE, ttl=60.)
+            assert cache.get('4') is None
+
+            # A failed batch should not affect the others
+            u.pubmed_ttl = 60.
+            u.update_metadata('sys1', 'pmid: 5\n')
+            u.update_metadata('sys2', 'pmid: 6\n')
+            u.update_metadata('sys3', 'pmid: 7\n')
+            nreq = len(server.requests)
+            failures = u.update_pubmed()
+            assert [r[1].split('&id=')[1]
+                    for r in server.requests[nreq:]] == ['5,6', '7']
+            assert list(failures.keys()) == ['sys3']
+            assert 'HTTP Error 400' in failures['sys3']
+            for name, pmid in (('sys1', '5'), ('sys2', '6')):
+                with open(root / name / 'pubmed.json') as fh:
+                    assert json.load(fh) == make_pubmed_json(pmid)
+            cache = update_metadata.PubMedCache(
+                root / update_metadata.PUBMED_CACHE_FILE, ttl=60.)
+            assert cache.get('5') is not None
+            assert cache.get('7') is None
+
+
+def make_graphql_repo(name, yaml_sha, yaml_text, thumb_sha=None,
+                      pushed='2020-06-01T00:00:00Z'):
+    entries = [{'name': 'metadata.yaml', 'type': 'blob', 'oid': yaml_sha,
+                'object': {'text': yaml_text, 'isBinary': False,
+                           'isTruncated': False}}]
+    if thumb_sha:
+        entries.append({'name': 'thumb.png', 'type': 'blob',
+                        'oid': thumb_sha,
+                        'object': {'text': None, 'isBinary': True,
+                                   'isTruncated': False}})
+    return {'description': '%s desc' % name, 'homepageUrl': '%s home' % name,
+            'url': 'https://github.com/salilab/%s' % name,
+            'pushedAt': pushed, 'defaultBranchRef': {'name': 'main'},
+            'metadata': {'entries': entries}}
+
+
+def test_update_graphql(monkeypatch):
+    """Test updating systems using a GraphQL stand-in"""
+    repos = {'foo': make_graphql_repo('foo', 'sha1', 'title: foo\n'),
+             'bar': make_graphql_repo('bar', 'sha2', 'title: bar\n',
+                                      thumb_sha='sha3'),
+             'baz': make_graphql_repo('baz', 'sha4', 'title: baz\n')}
+    queries = []
+
+    def graphql(method, path, headers, body):
+        assert method == 'POST'
+        assert headers['Authorization'] == 'Bearer secret'
+        j = json.loads(body)
+        assert '...repoFields' in j['query']
+        variables = j['variables']
+        queries.append(variables)
+        data, errors = {}, []
+        for i in range(len(variables) // 2):
+            assert variables['owner%d' % i] == 'salilab'
+            info = repos.get(variables['name%d' % i])
+            data['r%d' % i] = info
+            if info is None:
+                errors.append({'type': 'NOT_FOUND', 'path': ['r%d' % i],
+                               'message': 'Could not resolve to a '
+                                          'Repository'})
+        return 200, {}, json.dumps({'data': data, 'errors': errors})
+
+    systems = [(name, 'https://github.com/salilab/' + name)
+               for name in ('foo', 'bar', 'missing', 'baz')]
+    systems.append(('bad', 'not-a-github-url'))
+    with utils.MockWebServer() as server:
+        server.add('/graphql', graphql)
+        for name in ('foo', 'bar', 'baz'):
+            server.add('/repos/salilab/%s/readme' % name, '%s readme' % name,
+                       headers={'ETag': '"%s"' % name})
+        server.add('/repos/salilab/bar/contents/metadata/thumb.png',
+                   make_contents_json(b'PNG'))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            root = Path(tmpdir)
+            u = update_metadata.FileUpdater(
+                root=root, auth={'password': 'secret'},
+                github_api=server.url, eutils_api=server.url)
+            monkeypatch.setattr(update_metadata, 'GRAPHQL_PAGE_SIZE', 2)
+            report = u.update_all(systems, workers=2, graphql=True)
+            assert sorted(report.updated) == ['bar', 'baz', 'foo']
+            assert sorted(report.failures.keys()) == ['bad', 'missing']
+            assert ('Could not resolve to a Repository'
+                    in report.failures['missing'])
+            assert 'Could not parse repo' in report.failures['bad']
+            # Four repositories should be queried in two pages
+            assert len(queries) == 2
+            # Only readmes and the thumbnail should use the REST API
+            assert sorted(r[1] for r in server.requests
+                          if r[1] != '/graphql') == [
+                '/repos/salilab/bar/contents/metadata/thumb.png',
+                '/repos/salilab/bar/readme', '/repos/salilab/baz/readme',
+                '/repos/salilab/foo/readme']
+            with open(root / 'foo' / 'github.json') as fh:
+                g = json.load(fh)
+            assert g['description'] == 'foo desc'
+            assert g['homepage'] == 'foo home'
+            assert g['html_url'] == 'https://github.com/salilab/foo'
+            assert g['default_branch'] == 'main'
+            with open(root / 'foo' / 'metadata.yaml') as fh:
+                assert fh.read() == 'title: foo\n'
+            with open(root / 'foo' / 'readme.html') as fh:
+                assert fh.read() == 'foo readme'
+            with open(root / 'bar' / 'thumb.png', 'rb') as fh:
+                assert fh.read() == b'PNG'
+            # Output should be usable by the REST updater and the index
+            assert u.get_timestamp(root / 'foo' / 'github.json') is None
+            u.write_index(['foo', 'bar', 'baz'])
+            with open(root / 'index.json') as fh:
+                index = json.load(fh)
+            assert index['bar']['has_thumbnail'] is True
+            assert index['foo']['github']['homepage'] == 'foo home'
+
+            # Nothing changed, so only GraphQL queries should be made
+            nreq = len(server.requests)
+            report = u.update_all(systems[:2], workers=2, graphql=True)
+            assert report.failures == {}
+            assert [r[1] for r in server.requests[nreq:]] == ['/graphql']
+
+            # Missing local files should be fetched even if unchanged
+            os.unlink(root / 'bar' / 'thumb.png')
+            nreq = len(server.requests)
+            report = u.update_all(systems[:2], workers=2, graphql=True)
+            assert report.failures == {}
+            assert '/repos/salilab/bar/contents/metadata/thumb.png' in [
+                r[1] for r in server.requests[nreq:]]
+            assert os.path.exists(root / 'bar' / 'thumb.png')
+
+            # Only metadata.yaml changed, so it should be taken from the
+            # query; the readme is checked but the thumbnail is not fetched
+            repos['bar'] = make_graphql_repo('bar', 'sha5', 'title: new\n',
+                                             thumb_sha='sha3',
+                                             pushed='2020-06-02T00:00:00Z')
+            server.clear('/repos/salilab/bar/readme')
+            server.add('/repos/salilab/bar/readme', status=304)
+            nreq = len(server.requests)
+            report = u.update_all(systems[:2], workers=2, graphql=True)
+            assert report.failures == {}
+            reqs = server.requests[nreq:]
+            assert [r[1] for r in reqs] == ['/graphql',
+                                            '/repos/salilab/bar/readme']
+            assert reqs[1][2]['If-None-Match'] == '"bar"'
+            with open(root / 'bar' / 'metadata.yaml') as fh:
+                assert fh.read() == 'title: new\n'
+            with open(root / 'bar' / 'readme.html') as fh:
+                assert fh.read() == 'bar readme'
+
+
+def test_update_partial_failure():
+    """Test that a failed update is retried in full next time"""
+    with utils.MockWebServer() as server:
+        root = '/repos/salilab/foo'
+        server.add(root, json.dumps({'description': 'foo desc'}),
+                   headers={'Last-Modified': 'Mon, 01 Jun 2020 00:00:00 GMT'})
+        server.add(root + '/readme', status=403)
+        server.add(root + '/readme', 'foo readme')
+        with tempfile.TemporaryDirectory() as tmpdir:
+            u = update_metadata.FileUpdater(
+                root=Path(tmpdir), auth={'password': 'secret'},
+                github_api=server.url, eutils_api=server.url)
+            with pytest.raises(urllib.error.HTTPError):
+                u.update('foo', 'https://github.com/salilab/foo')
+            # Repository should not be marked as up to date
+            assert not os.path.exists(Path(tmpdir) / 'foo' / 'github.json')
+            nreq = len(server.requests)
+            u.update('foo', 'https://github.com/salilab/foo')
+            assert 'If-Modified-Since' not in server.requests[nreq][2]
+            with open(Path(tmpdir) / 'foo' / 'readme.html') as fh:
+                assert fh.read() == 'foo readme'
+            with open(Path(tmpdir) / 'foo' / 'github.json') as fh:
+                assert json.load(fh)['description'] == 'foo desc'
+
+
+def test_update_missing_files():
+    """Test that missing local files are fetched for unchanged repos"""
+    def repo_info(method, path, headers, body):
+        if headers.get('If-Modified-Since'):
+            return 304, {}, ''
+        return (200, {'Last-Modified': 'Mon, 01 Jun 2020 00:00:00 GMT'},
+                json.dumps({'description': 'foo desc'}))
+
+    with utils.MockWebServer() as server:
+        root = '/repos/salilab/foo'
+        server.add(root, repo_info)
+        server.add(root + '/commits/HEAD', status=304)
+        server.add(root + '/readme', 'foo readme')
+        server.add(root + '/contents/metadata',
+                   make_listing_json({'thumb.png': 'sha1'}))
+        server.add(root + '/contents/metadata/thumb.png',
+                   make_contents_json(b'PNG'))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            d = Path(tmpdir) / 'foo'
+            u = update_metadata.FileUpdater(
+                root=Path(tmpdir), auth={'password': 'secret'},
+                github_api=server.url, eutils_api=server.url)
+            u.update('foo', 'https://github.com/salilab/foo')
+            assert os.path.exists(d / 'thumb.png')
+            nreq = len(server.requests)
+            u.update('foo', 'https://github.com/salilab/foo')
+            assert [r[1] for r in server.requests[nreq:]] == [
+                root, root + '/commits/HEAD']
+            for fname in ('thumb.png', 'readme.html'):
+                os.unlink(d / fname)
+                u.update('foo', 'https://github.com/salilab/foo')
+                assert os.path.exists(d / fname)
+
+
+def test_update_pubmed_retry():
+    """Test that failed PubMed lookups are retried for unchanged repos"""
+    def repo_info(method, path, headers, body):
+        if headers.get('If-Modified-Since'):
+            return 304, {}, ''
+        return (200, {'Last-Modified': 'Mon, 01 Jun 2020 00:00:00 GMT'},
+                json.dumps({'description': 'foo desc'}))
+
+    with utils.MockWebServer() as server:
+        root = '/repos/salilab/foo'
+        server.add(root, repo_info)
+        server.add(root + '/commits/HEAD', status=304)
+        server.add(root + '/readme', 'foo readme')
+        server.add(root + '/contents/metadata',
+                   make_listing_json({'metadata.yaml': 'sha1'}))
+        server.add(root + '/contents/metadata/metadata.yaml',
+                   make_contents_json(b'pmid: 1234\n'))
+        server.add('/esummary.fcgi', json.dumps(
+            {'result': {'uids': ['1234'], '1234': {'error': 'not found'}}}))
+        server.add('/esummary.fcgi', json.dumps(make_pubmed_json('1234')))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            u = update_metadata.FileUpdater(
+                root=Path(tmpdir), auth={'password': 'secret'},
+                github_api=server.url, eutils_api=server.url)
+            systems = [('foo', 'https://github.com/salilab/foo')]
+            report = u.update_all(systems, workers=1)
+            assert list(report.failures.keys()) == ['foo']
+            report = u.update_all(systems, workers=1)
+            assert report.failures == {}
+            assert server.requests[-1][1].endswith('&id=1234')
+            with open(Path(tmpdir) / 'foo' / 'pubmed.json') as fh:
+                assert json.load(fh) == make_pubmed_json('1234')
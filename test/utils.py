@@ -103,6 +103,18 @@ class MockSystem(object):
                           build['imp_build_type']))
 
 
+def reset_app_state(app):
+    """Close any pooled connections and discard cached data, since they
+       refer to mock systems which are about to change"""
+    pool = app.extensions.pop('db_pool', None)
+    if pool is not None:
+        pool.close()
+    app.extensions.pop('fragment_cache', None)
+    app.extensions.pop('badge_cache', None)
+    app.extensions.pop('build_page_store', None)
+    app.extensions.pop('compress_cache', None)
+
+
 @contextlib.contextmanager
 def mock_systems(app, systems):
     systop = tempfile.mkdtemp()
@@ -130,5 +142,85 @@ def mock_systems(app, systems):
         s.make_readme(os.path.join(systop, s.name, 'readme.html'))
     app.config['DATABASE'] = dbsetup
     app.config['SYSTEM_TOP'] = systop
+    reset_app_state(app)
     yield
+    reset_app_state(app)
     shutil.rmtree(systop, ignore_errors=True)
+
+
+class MockWebServer(object):
+    """A local HTTP server, standing in for GitHub or PubMed, that replays
+       canned responses. Use as a context manager; `url` is the root URL
+       of the server, and `requests` records each request made as
+       a (method, path, headers, body, client port) tuple."""
+    def __init__(self):
+        self._responses = {}
+        self.requests = []
+
+    def add(self, path, body=b'', status=200, headers={}):
+        """Add a response for the given path (including any query string,
+           or without it to match any query). `body` may be a callable,
+           which is passed (method, path, headers, body) and should return
+           a (status, headers, body) tuple. Multiple responses added for the
+           same path are returned in order (the last one is repeated)."""
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self._responses.setdefault(path, []).append((status, headers, body))
+
+    def clear(self, path):
+        """Remove all responses for the given path"""
+        self._responses.pop(path, None)
+
+    def _get_response(self, method, path, headers, body):
+        responses = (self._responses.get(path)
+                     or self._responses.get(path.split('?')[0]))
+        if not responses:
+            return 404, {}, b'Not found'
+        status, rheaders, rbody = (responses.pop(0) if len(responses) > 1
+                                   else responses[0])
+        if callable(rbody):
+            status, rheaders, rbody = rbody(method, path, headers, body)
+            if isinstance(rbody, str):
+                rbody = rbody.encode('utf-8')
+        return status, rheaders, rbody
+
+    def __enter__(self):
+        import http.server
+        import threading
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def _handle(self):
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length) if length else b''
+                server.requests.append((self.command, self.path,
+                                        self.headers, body,
+                                        self.client_address[1]))
+                status, headers, rbody = server._get_response(
+                    self.command, self.path, self.headers, body)
+                self.send_response(status)
+                for k, v in headers.items():
+                    self.send_header(k, v)
+                self.send_header('Content-Length', str(len(rbody)))
+                self.end_headers()
+                self.wfile.write(rbody)
+
+            do_GET = do_POST = _handle
+
+            def log_message(self, *args):
+                pass
+
+        self._httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                      Handler)
+        self._httpd.daemon_threads = True
+        self.url = 'http://127.0.0.1:%d' % self._httpd.server_address[1]
+        self._thread = threading.Thread(target=self._httpd.serve_forever)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        self._thread.join()
@@ -0,0 +1,65 @@
+#!/usr/bin/python3
+
+"""
+Write compressed copies of static files (.gz, plus .br if the brotli
+module is available) alongside the originals, so that they can be sent
+to clients that support compression without compressing them on each
+request.
+
+Usage: precompress.py [directory]   (default: static)
+
+Only files that are new or have changed since they were last compressed
+are processed. This is run by 'make install'.
+"""
+
+import glob
+import gzip
+import os
+import sys
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+PATTERNS = ['*.css', '*.js']
+
+
+def get_compressors():
+    c = [('.gz', lambda data: gzip.compress(data, compresslevel=9, mtime=0))]
+    if brotli:
+        c.append(('.br', brotli.compress))
+    return c
+
+
+def precompress(directory):
+    """Compress all static files in the given directory that need it.
+       Return the names of all compressed files written."""
+    written = []
+    for pattern in PATTERNS:
+        for fname in sorted(glob.glob(os.path.join(directory, pattern))):
+            mtime = os.stat(fname).st_mtime
+            data = None
+            for suffix, compress in get_compressors():
+                out = fname + suffix
+                if (os.path.exists(out)
+                        and os.stat(out).st_mtime >= mtime):
+                    continue
+                if data is None:
+                    with open(fname, 'rb') as fh:
+                        data = fh.read()
+                with open(out, 'wb') as fh:
+                    fh.write(compress(data))
+                written.append(out)
+    return written
+
+
+def main():
+    directory = sys.argv[1] if len(sys.argv) > 1 else 'static'
+    for fname in precompress(directory):
+        print("Wrote %s" % fname)
+
+
+if __name__ == '__main__':
+    main()
@@ -20,38 +20,409 @@ only by the user, of the format:
 where "github" gives the personal access token for access to the GitHub API;
 "sql" contains connection parameters to the MySQL database with systems
 information; and "system_top" is the filesystem location where the metadata
-will be stored.
+will be stored. Optional "github_api", "github_graphql" and "eutils_api" keys
+override the URLs of the GitHub REST and GraphQL APIs and the NCBI E-utilities
+API.
+
+Systems are updated in parallel (see --workers and --per-host). If any
+system cannot be updated, the others are still updated, and a summary of
+the failures is printed at the end.
+
+ETags and git blob SHAs of what was last fetched for each system are kept
+in a .fetch_state.json file in its directory, so that the readme and
+metadata files are only downloaded when they change. PubMed summaries are
+only fetched when a system's PubMed ID changes; those of all systems are
+fetched together, in batches, after the systems are updated, and are
+cached (keyed by PubMed ID) in a .pubmed_cache.json file in "system_top"
+(see --pubmed-ttl).
+
+With --graphql, repository information and the contents of metadata.yaml
+for all systems are obtained with a few GitHub GraphQL queries; the REST
+API is then used only for changed readmes and thumbnails.
 """
 
-import urllib.request
+import urllib.error
+import urllib.parse
+import argparse
 import base64
+import collections
+import concurrent.futures
+import contextlib
+import gzip
+import http.client
+import io
 import json
+import os
 import re
+import sys
+import tempfile
+import threading
+import time
+import traceback
 import MySQLdb
 import yaml
 from pathlib import Path
 
 
+GITHUB_API = 'https://api.github.com'
+EUTILS_API = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils'
+
+# File in each system's directory recording what was last fetched
+STATE_FILE = '.fetch_state.json'
+
+# File in the top directory caching PubMed summaries, keyed by PubMed ID
+PUBMED_CACHE_FILE = '.pubmed_cache.json'
+
+# Time in seconds for which cached PubMed summaries are used
+PUBMED_CACHE_TTL = 7 * 24 * 60 * 60
+
+# Maximum number of PubMed IDs to look up in a single esummary request
+PUBMED_BATCH_SIZE = 200
+
+# Maximum number of repositories to query in a single GraphQL request
+GRAPHQL_PAGE_SIZE = 50
+
+# Information requested for each repository in a GraphQL query. The
+# object IDs of the metadata files are their git blob SHAs, as also
+# reported by the REST API.
+GRAPHQL_REPO_FRAGMENT = """
+fragment repoFields on Repository {
+  description
+  homepageUrl
+  url
+  pushedAt
+  defaultBranchRef { name }
+  metadata: object(expression: "HEAD:metadata") {
+    ... on Tree {
+      entries {
+        name
+        type
+        oid
+        object { ... on Blob { text isBinary isTruncated } }
+      }
+    }
+  }
+}
+"""
+
+
+class Response(io.BytesIO):
+    """A complete HTTP response, with the body already read (and
+       decompressed if necessary). It can be read like a file."""
+    def __init__(self, url, status, headers, body):
+        super().__init__(body)
+        self.url, self.status, self.headers = url, status, headers
+
+    def info(self):
+        return self.headers
+
+
+class HostLimiter:
+    """Limit the number of concurrent requests made to each host"""
+    def __init__(self, max_per_host):
+        self.max_per_host = max_per_host
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def limit(self, url):
+        host = urllib.parse.urlsplit(url).netloc
+        with self._lock:
+            sem = self._semaphores.get(host)
+            if sem is None:
+                sem = threading.BoundedSemaphore(self.max_per_host)
+                self._semaphores[host] = sem
+        with sem:
+            yield
+
+
+class HTTPClient:
+    """A simple thread-safe HTTP client, which keeps connections to each
+       host open for reuse by later requests, limits the number of
+       concurrent requests to each host (see HostLimiter), accepts
+       gzip-compressed responses, and retries requests that fail due to
+       server errors or rate limits."""
+    redirect_codes = frozenset([301, 302, 303, 307, 308])
+
+    def __init__(self, max_per_host=4, retries=4, backoff=1.0,
+                 timeout=60):
+        self.limiter = HostLimiter(max_per_host)
+        self.retries, self.backoff, self.timeout = retries, backoff, timeout
+        self._idle = collections.defaultdict(list)
+        self._lock = threading.Lock()
+        self._sleep = time.sleep
+
+    def _get_connection(self, scheme, netloc):
+        with self._lock:
+            idle = self._idle[(scheme, netloc)]
+            if idle:
+                return idle.pop()
+        cls = (http.client.HTTPSConnection if scheme == 'https'
+               else http.client.HTTPConnection)
+        return cls(netloc, timeout=self.timeout)
+
+    def _put_connection(self, scheme, netloc, conn):
+        with self._lock:
+            self._idle[(scheme, netloc)].append(conn)
+
+    def close(self):
+        """Close all idle connections"""
+        with self._lock:
+            for conns in self._idle.values():
+                for conn in conns:
+                    conn.close()
+            self._idle.clear()
+
+    def _request_once(self, method, url, headers, body):
+        """Make a single request, reusing a connection if possible.
+           Return a Response."""
+        u = urllib.parse.urlsplit(url)
+        path = u.path or '/'
+        if u.query:
+            path += '?' + u.query
+        headers = dict(headers)
+        headers.setdefault('Accept-Encoding', 'gzip')
+        headers.setdefault('User-Agent', 'IMP systems updater')
+        # An idle connection may have been closed by the server, so try
+        # once more on a fresh connection if it fails
+        for attempt in range(2):
+            conn = self._get_connection(u.scheme, u.netloc)
+            fresh = conn.sock is None
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                resp = conn.getresponse()
+                body = resp.read()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                if fresh or attempt > 0:
+                    raise
+                continue
+            if resp.will_close:
+                conn.close()
+            else:
+                self._put_connection(u.scheme, u.netloc, conn)
+            if resp.headers.get('Content-Encoding') == 'gzip':
+                body = gzip.decompress(body)
+            return Response(url, resp.status, resp.headers, body)
+
+    def _get_retry_delay(self, response, attempt):
+        """Get the time to wait before retrying a request that got the
+           given response, or None if it should not be retried"""
+        if response.status >= 500:
+            pass
+        elif response.status in (403, 429) and (
+                'Retry-After' in response.headers
+                or response.headers.get('X-RateLimit-Remaining') == '0'
+                or b'rate limit' in response.getvalue().lower()):
+            # GitHub primary or secondary rate limit
+            pass
+        else:
+            return None
+        retry_after = response.headers.get('Retry-After')
+        if retry_after and retry_after.isdigit():
+            return int(retry_after)
+        return self.backoff * 2 ** attempt
+
+    def get(self, url, headers={}):
+        """Get the given URL and return a Response (see request())"""
+        return self.request('GET', url, headers)
+
+    def request(self, method, url, headers={}, body=None):
+        """Make an HTTP request and return a Response. Redirects are
+           followed, and server errors and rate limits are retried. Raise
+           urllib.error.HTTPError for any other non-2xx response
+           (including 304)."""
+        for redirect in range(5):
+            with self.limiter.limit(url):
+                for attempt in range(self.retries + 1):
+                    response = self._request_once(method, url, headers,
+                                                  body)
+                    delay = self._get_retry_delay(response, attempt)
+                    if delay is None or attempt == self.retries:
+                        break
+                    self._sleep(delay)
+            if (response.status in self.redirect_codes
+                    and 'Location' in response.headers):
+                url = urllib.parse.urljoin(url, response.headers['Location'])
+                continue
+            break
+        if response.status >= 300:
+            raise urllib.error.HTTPError(
+                url, response.status,
+                http.client.responses.get(response.status, ''),
+                response.headers, response)
+        return response
+
+
+class UpdateReport:
+    """Summary of an update of many systems (see FileUpdater.update_all)"""
+    def __init__(self):
+        self.updated = []
+        # Map from system name to traceback
+        self.failures = collections.OrderedDict()
+
+    def format(self):
+        lines = ["Updated %d systems, %d failed"
+                 % (len(self.updated), len(self.failures))]
+        for name, tb in self.failures.items():
+            lines.append("\n%s failed:\n%s" % (name, tb.rstrip()))
+        return "\n".join(lines)
+
+
+def write_file_atomic(fname, contents):
+    """Write a file such that readers never see partial contents"""
+    fd, tmpname = tempfile.mkstemp(dir=fname.parent, prefix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as fh:
+            fh.write(contents)
+        os.chmod(tmpname, 0o644)
+        os.replace(tmpname, fname)
+    except BaseException:
+        os.unlink(tmpname)
+        raise
+
+
+class PubMedCache:
+    """Summaries of PubMed entries, keyed by PubMed ID, stored in a JSON
+       file so that they are shared between systems and between runs.
+       Entries older than `ttl` seconds are ignored."""
+    def __init__(self, fname, ttl=PUBMED_CACHE_TTL):
+        self.fname, self.ttl = fname, ttl
+        try:
+            with open(fname) as fh:
+                self._entries = json.load(fh)
+        except FileNotFoundError:
+            self._entries = {}
+
+    def get(self, pmid):
+        """Get the summary for a PubMed ID, or None if not cached"""
+        entry = self._entries.get(pmid)
+        if entry and time.time() - entry['time'] < self.ttl:
+            return entry['summary']
+
+    def put(self, pmid, summary):
+        self._entries[pmid] = {'time': time.time(), 'summary': summary}
+
+    def save(self):
+        now = time.time()
+        entries = dict((pmid, entry) for pmid, entry in self._entries.items()
+                       if now - entry['time'] < self.ttl)
+        write_file_atomic(self.fname, json.dumps(entries, sort_keys=True))
+
+
+def parse_github_url(repo):
+    """Get the owner and name of a GitHub repository from its URL"""
+    m = re.match(r'https://github\.com/([^/]+)/([^/]+)', repo)
+    if not m:
+        raise ValueError("Could not parse repo %s" % repo)
+    return m.group(1), m.group(2)
+
+
+class GraphQLError(Exception):
+    """An error reported by the GitHub GraphQL API"""
+    pass
+
+
+class GitHubGraphQL:
+    """Get information about many GitHub repositories at once, using the
+       GitHub GraphQL API"""
+    def __init__(self, auth, client=None, url=GITHUB_API + '/graphql',
+                 page_size=None):
+        self.auth, self.url = auth, url
+        self.page_size = page_size or GRAPHQL_PAGE_SIZE
+        self.client = client or HTTPClient()
+
+    def query(self, query, variables):
+        """Run a GraphQL query and return the parsed response"""
+        headers = {'Authorization': 'Bearer ' + self.auth['password'],
+                   'Content-Type': 'application/json'}
+        body = json.dumps({'query': query, 'variables': variables})
+        response = self.client.request('POST', self.url, headers,
+                                       body.encode('utf-8'))
+        return json.load(response)
+
+    def _get_page(self, repos):
+        """Get information on a list of (owner, name) pairs with
+           a single query, using an alias for each repository"""
+        params, fields, variables = [], [], {}
+        for i, (owner, name) in enumerate(repos):
+            params.append('$owner%d: String!, $name%d: String!' % (i, i))
+            fields.append('r%d: repository(owner: $owner%d, name: $name%d) '
+                          '{ ...repoFields }' % (i, i, i))
+            variables['owner%d' % i] = owner
+            variables['name%d' % i] = name
+        query = ('query(%s) {\n  %s\n}\n%s'
+                 % (', '.join(params), '\n  '.join(fields),
+                    GRAPHQL_REPO_FRAGMENT))
+        j = self.query(query, variables)
+        errors = {}
+        for error in j.get('errors', []):
+            path = error.get('path') or ['']
+            errors[path[0]] = error['message']
+        data = j.get('data')
+        if data is None:
+            raise GraphQLError('; '.join(errors.values()))
+        results = []
+        for i in range(len(repos)):
+            info = data.get('r%d' % i)
+            if info is None:
+                info = GraphQLError(errors.get('r%d' % i, 'No data returned'))
+            results.append(info)
+        return results
+
+    def get_repos(self, repos):
+        """Get information on each of a list of repository URLs. Return
+           a dict keyed by URL; each value is either a dict of information
+           (see GRAPHQL_REPO_FRAGMENT) or, if the information could not be
+           obtained, the exception raised."""
+        results = {}
+        todo = []
+        for repo in repos:
+            try:
+                todo.append((repo, parse_github_url(repo)))
+            except ValueError as exc:
+                results[repo] = exc
+        for i in range(0, len(todo), self.page_size):
+            page = todo[i:i + self.page_size]
+            try:
+                infos = self._get_page([r[1] for r in page])
+            except Exception as exc:
+                infos = [exc] * len(page)
+            for (repo, _), info in zip(page, infos):
+                results[repo] = info
+        return results
+
+
 class GitHubRepo:
-    def __init__(self, repo, auth):
+    def __init__(self, repo, auth, client=None, api_root=GITHUB_API):
         self.auth = auth
-        m = re.match(r'https://github\.com/([^/]+)/([^/]+)', repo)
-        if not m:
-            raise ValueError("Could not parse repo %s" % repo)
-        self.owner = m.group(1)
-        self.repo = m.group(2)
+        self.client = client or HTTPClient()
+        self.owner, self.repo = parse_github_url(repo)
         # Note: this assumes that the main branch is the default
         self.url_root = 'https://github.com/%s/%s/tree/main/' \
                         % (self.owner, self.repo)
-        self.api_root = 'https://api.github.com/repos/%s/%s' \
-                        % (self.owner, self.repo)
+        self.api_root = '%s/repos/%s/%s' % (api_root, self.owner, self.repo)
 
     def get_default_headers(self):
         """Get headers needed for every API request"""
         headers = {'Authorization': 'Bearer ' + self.auth['password']}
         return headers
 
-    def get_readme(self):
+    def _get_conditional(self, url, headers, etag):
+        """Get a URL, unless it matches the given ETag. Return the Response,
+           or None if it hasn't changed."""
+        if etag:
+            headers['If-None-Match'] = etag
+        try:
+            return self.client.get(url, headers)
+        except urllib.error.HTTPError as exc:
+            if exc.code == 304:
+                return None
+            raise
+
+    def get_readme(self, etag=None):
+        """Get the readme as HTML, and its ETag. If it hasn't changed since
+           the given ETag, return None,etag instead."""
         def make_url_absolute(m):
             url = m.group(1)
             if not url.startswith('//') and ':' not in url:
@@ -61,27 +432,46 @@ class GitHubRepo:
         headers = self.get_default_headers()
         headers['Accept'] = 'application/vnd.github.VERSION.html'
         try:
-            req = urllib.request.Request(self.api_root + '/readme',
-                                         None, headers)
-            response = urllib.request.urlopen(req)
+            response = self._get_conditional(self.api_root + '/readme',
+                                             headers, etag)
+            if response is None:
+                return None, etag
             urls_fixed = re.subn('<a href="([^"]+)">', make_url_absolute,
                                  response.read().decode('utf-8'))
-            return urls_fixed[0]
+            return urls_fixed[0], response.info()['ETag']
         except urllib.error.HTTPError as exc:
             if exc.code == 404:
-                return ''
+                return '', None
             else:
                 raise
 
+    def get_directory(self, dirname, etag=None):
+        """Get the git blob SHA of each file in a directory, as a dict
+           keyed by filename, and the ETag of the listing. If it hasn't
+           changed since the given ETag, return None,etag instead."""
+        try:
+            response = self._get_conditional(
+                self.api_root + '/contents/' + dirname,
+                self.get_default_headers(), etag)
+        except urllib.error.HTTPError as exc:
+            if exc.code == 404:
+                return {}, None
+            else:
+                raise
+        if response is None:
+            return None, etag
+        return (dict((f['name'], f['sha']) for f in json.load(response)
+                     if f['type'] == 'file'),
+                response.info()['ETag'])
+
     def get_last_commit_time(self, last_modified):
         """Get the time of the last commit, or None if there has been none
            since last time."""
         headers = self.get_default_headers()
         headers['If-Modified-Since'] = last_modified
-        req = urllib.request.Request(self.api_root + '/commits/HEAD',
-                                     None, headers)
         try:
-            response = urllib.request.urlopen(req)
+            response = self.client.get(self.api_root + '/commits/HEAD',
+                                       headers)
         except urllib.error.HTTPError as exc:
             if exc.code == 304:
                 return None
@@ -96,9 +486,8 @@ class GitHubRepo:
         headers = self.get_default_headers()
         if last_modified:
             headers['If-Modified-Since'] = last_modified
-        req = urllib.request.Request(self.api_root, None, headers)
         try:
-            response = urllib.request.urlopen(req)
+            response = self.client.get(self.api_root, headers)
         except urllib.error.HTTPError as exc:
             if exc.code == 304:
                 if last_modified:
@@ -116,10 +505,9 @@ class GitHubRepo:
 
     def get_file(self, filename, binary=False):
         headers = self.get_default_headers()
-        req = urllib.request.Request(self.api_root + '/contents/' + filename,
-                                     None, headers)
         try:
-            response = urllib.request.urlopen(req)
+            response = self.client.get(self.api_root + '/contents/' + filename,
+                                       headers)
         except urllib.error.HTTPError as exc:
             if exc.code == 404:
                 return None
@@ -132,67 +520,344 @@ class GitHubRepo:
                 contents = contents.decode()
             return contents
         elif contents['encoding'] == 'none' and contents['content'] == '':
-            req = urllib.request.Request(
-                contents['download_url'], None, headers)
-            response = urllib.request.urlopen(req)
+            response = self.client.get(contents['download_url'], headers)
             return response.read()
         else:
             raise ValueError("Unknown encoding: %s" % contents['encoding'])
 
 
 class FileUpdater:
-    def __init__(self, root, auth):
+    def __init__(self, root, auth, client=None, github_api=GITHUB_API,
+                 eutils_api=EUTILS_API, pubmed_ttl=PUBMED_CACHE_TTL,
+                 github_graphql=None):
         self.root, self.auth = root, auth
+        self.client = client or HTTPClient()
+        self.github_api, self.eutils_api = github_api, eutils_api
+        self.github_graphql = github_graphql or github_api + '/graphql'
+        self.pubmed_ttl = pubmed_ttl
+        # Map from system name to PubMed ID, for systems whose PubMed
+        # summary needs updating (see update_pubmed)
+        self.pubmed_queue = {}
+        self._pubmed_lock = threading.Lock()
 
     def get_timestamp(self, fname):
         try:
-            return json.load(open(fname))['Last-Modified']
+            # Not set if last updated with GraphQL
+            return json.load(open(fname)).get('Last-Modified')
         except IOError:
             return None
 
     def write_file(self, fname, contents, binary=False):
-        if not fname.parent.exists():
-            fname.parent.mkdir()
+        fname.parent.mkdir(exist_ok=True)
         with open(fname, 'wb' if binary else 'w') as fh:
             fh.write(contents)
 
+    def write_file_atomic(self, fname, contents):
+        write_file_atomic(fname, contents)
+
     def get_filename(self, name, filename):
         return self.root / name / filename
 
     def update(self, name, repo):
-        g = GitHubRepo(repo, self.auth)
+        g = GitHubRepo(repo, self.auth, self.client, self.github_api)
         g_json = self.get_filename(name, 'github.json')
-        last_modified = self.get_timestamp(g_json)
+        state = self.read_state(name)
+        # Refetch everything if any local files are missing
+        last_modified = (self.get_timestamp(g_json)
+                         if self.have_all_files(name, state) else None)
 
         info, new_last_modified = g.get_info(last_modified)
         if not info:
             # Skip update if the repo hasn't changed. This should help us to
             # avoid hitting GitHub's rate limits.
+            self.check_pubmed(name)
             return
         info = json.loads(info)
         info['Last-Modified'] = new_last_modified
 
+        self.update_readme(g, name, state)
+
+        # Only fetch files whose git blob SHA changed
+        have_files = self.have_all_files(name, state)
+        listing, etag = g.get_directory(
+            'metadata', state.get('metadata_etag') if have_files else None)
+        if listing is not None:
+            state['metadata_etag'] = etag
+            self.update_metadata_files(g, name, state, listing)
+        self.write_state(name, state)
+        # Write this last, since it marks the system as up to date; if
+        # anything above failed, everything is tried again next time
         self.write_file(g_json, json.dumps(info))
-        self.write_file(self.get_filename(name, 'readme.html'), g.get_readme())
+        self.check_pubmed(name)
+
+    def update_graphql(self, name, repo, info):
+        """Update a single system, given the information about its
+           repository obtained from GitHubGraphQL. Only the readme and
+           thumbnail (if changed) are fetched with the REST API."""
+        if isinstance(info, Exception):
+            raise info
+        g = GitHubRepo(repo, self.auth, self.client, self.github_api)
+        g_json = self.get_filename(name, 'github.json')
+        github = {'description': info['description'],
+                  'homepage': info['homepageUrl'],
+                  'html_url': info['url'],
+                  'default_branch': (info['defaultBranchRef'] or {}).get(
+                      'name'),
+                  'pushed_at': info['pushedAt']}
+        try:
+            with open(g_json) as fh:
+                old_github = json.load(fh)
+        except FileNotFoundError:
+            old_github = {}
+        state = self.read_state(name)
+        if (all(old_github.get(k) == v for k, v in github.items())
+                and self.have_all_files(name, state)):
+            # Skip update if the repo hasn't changed
+            self.check_pubmed(name)
+            return
+        self.update_readme(g, name, state)
+
+        listing, contents = {}, {}
+        for entry in (info['metadata'] or {}).get('entries', []):
+            if entry['type'] != 'blob':
+                continue
+            listing[entry['name']] = entry['oid']
+            blob = entry['object'] or {}
+            if (blob.get('text') is not None and not blob.get('isBinary')
+                    and not blob.get('isTruncated')):
+                contents[entry['name']] = blob['text']
+        # The directory may have changed since the REST listing was fetched
+        state.pop('metadata_etag', None)
+        self.update_metadata_files(g, name, state, listing, contents)
+        self.write_state(name, state)
+        # Write this last (see update())
+        self.write_file(g_json, json.dumps(github))
+        self.check_pubmed(name)
+
+    def have_all_files(self, name, state):
+        """Return True iff all files previously fetched for the system
+           (see read_state()) are present"""
+        return all(self.get_filename(name, f).exists()
+                   for f in ['readme.html'] + list(state.get('sha', {})))
+
+    def update_readme(self, g, name, state):
+        """Fetch the readme if it changed"""
+        readme = self.get_filename(name, 'readme.html')
+        contents, etag = g.get_readme(
+            state.get('readme_etag') if readme.exists() else None)
+        if contents is not None:
+            self.write_file(readme, contents)
+            state['readme_etag'] = etag
+
+    def update_metadata_files(self, g, name, state, listing, contents={}):
+        """Fetch metadata files whose git blob SHA changed. `listing` maps
+           each filename in the metadata directory to its SHA; the
+           contents of any of them that are already known can be given in
+           `contents` so that they are not fetched."""
+        shas = state.setdefault('sha', {})
         for f, binary in (('metadata.yaml', False), ('thumb.png', True)):
             fname = self.get_filename(name, f)
-            contents = g.get_file('metadata/' + f, binary)
-            if contents is not None:
-                if f == 'metadata.yaml':
-                    self.update_metadata(name, contents)
-                self.write_file(fname, contents, binary)
+            sha = listing.get(f)
+            if sha is None or (sha == shas.get(f) and fname.exists()):
+                continue
+            data = contents.get(f)
+            if data is None:
+                data = g.get_file('metadata/' + f, binary)
+            if data is not None:
+                self.write_file(fname, data, binary)
+                shas[f] = sha
+
+    def check_pubmed(self, name):
+        """Queue the system's PubMed ID for update_pubmed() if it changed.
+           This is checked for every system, even if its repository is
+           unchanged, in case an earlier lookup failed."""
+        fname = self.get_filename(name, 'metadata.yaml')
+        if fname.exists():
+            with open(fname, encoding='utf-8') as fh:
+                self.update_metadata(name, fh.read())
+
+    def read_state(self, name):
+        """Get information about what was last fetched for a system (ETags,
+           git blob SHAs and PubMed ID), so that unchanged files are not
+           fetched again"""
+        try:
+            with open(self.get_filename(name, STATE_FILE)) as fh:
+                return json.load(fh)
+        except FileNotFoundError:
+            return {}
+
+    def write_state(self, name, state):
+        self.write_file_atomic(self.get_filename(name, STATE_FILE),
+                               json.dumps(state, sort_keys=True))
 
     def update_metadata(self, name, contents):
+        """Handle new metadata.yaml contents. If the system's PubMed ID
+           changed, it is queued so that the PubMed summary is fetched
+           by the next call to update_pubmed()."""
         meta = yaml.safe_load(contents)
-        if 'pmid' in meta:
-            url = ('http://eutils.ncbi.nlm.nih.gov/entrez/eutils/esummary.fcgi'
-                   '?db=pubmed&retmode=json&rettype=abstract&id=%s'
-                   % str(meta['pmid']))
-            response = urllib.request.urlopen(url).read()
-            # Make sure it is valid JSON:
-            j = json.loads(response)
-            fname = self.get_filename(name, 'pubmed.json')
-            self.write_file(fname, json.dumps(j))
+        if meta and 'pmid' in meta:
+            pmid = str(meta['pmid'])
+            if pmid != self.get_pubmed_id(name):
+                with self._pubmed_lock:
+                    self.pubmed_queue[name] = pmid
+
+    def get_pubmed_id(self, name):
+        """Get the PubMed ID of the system's stored summary, or None"""
+        try:
+            with open(self.get_filename(name, 'pubmed.json')) as fh:
+                return json.load(fh)['result']['uids'][0]
+        except FileNotFoundError:
+            return None
+
+    def fetch_pubmed(self, pmids):
+        """Get the esummary records of the given PubMed IDs, as a dict keyed
+           by ID, using as few requests as possible. A failed request does
+           not affect the other batches; also return a dict of error
+           message for each ID in a failed batch."""
+        records = {}
+        errors = {}
+        for i in range(0, len(pmids), PUBMED_BATCH_SIZE):
+            batch = pmids[i:i + PUBMED_BATCH_SIZE]
+            url = ('%s/esummary.fcgi?db=pubmed&retmode=json&rettype=abstract'
+                   '&id=%s' % (self.eutils_api, ','.join(batch)))
+            try:
+                result = json.load(self.client.get(url))['result']
+            except Exception as exc:
+                error = format_exception(exc)
+                errors.update((pmid, error) for pmid in batch)
+                continue
+            for pmid in batch:
+                if pmid in result and 'error' not in result[pmid]:
+                    records[pmid] = result[pmid]
+        return records, errors
+
+    def update_pubmed(self):
+        """Write the PubMed summary of every queued system. Summaries are
+           looked up in a cache first, and only those not in the cache are
+           fetched, in batches, with one lookup for each PubMed ID even if
+           it is used by several systems. Return a dict of system name to
+           error message for any systems that could not be updated."""
+        with self._pubmed_lock:
+            queue, self.pubmed_queue = self.pubmed_queue, {}
+        if not queue:
+            return {}
+        cache = PubMedCache(self.root / PUBMED_CACHE_FILE, self.pubmed_ttl)
+        records = {}
+        for pmid in set(queue.values()):
+            records[pmid] = cache.get(pmid)
+        to_fetch = sorted(pmid for pmid, r in records.items() if r is None)
+        errors = {}
+        if to_fetch:
+            fetched, errors = self.fetch_pubmed(to_fetch)
+            for pmid, record in fetched.items():
+                records[pmid] = record
+                cache.put(pmid, record)
+            cache.save()
+        failures = {}
+        for name, pmid in sorted(queue.items()):
+            if records[pmid] is None:
+                failures[name] = errors.get(
+                    pmid, "No PubMed summary found for %s" % pmid)
+            else:
+                self.write_file_atomic(
+                    self.get_filename(name, 'pubmed.json'),
+                    json.dumps({'result': {'uids': [pmid],
+                                           pmid: records[pmid]}}))
+        return failures
+
+    def update_all(self, systems, workers, graphql=False):
+        """Update each of a list of (name, repo) systems, using up to
+           `workers` threads in parallel. A failure to update one system
+           does not affect the others. If `graphql` is True, information
+           on all repositories is first obtained with a few GraphQL
+           queries (see update_graphql()). Return an UpdateReport."""
+        report = UpdateReport()
+        if graphql:
+            q = GitHubGraphQL(self.auth, self.client, self.github_graphql)
+            infos = q.get_repos([repo for name, repo in systems])
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers) as executor:
+            futures = []
+            for name, repo in systems:
+                if graphql:
+                    future = executor.submit(self.update_graphql, name=name,
+                                             repo=repo, info=infos[repo])
+                else:
+                    future = executor.submit(self.update, name=name,
+                                             repo=repo)
+                futures.append((name, future))
+            for name, future in futures:
+                exc = future.exception()
+                if exc is None:
+                    report.updated.append(name)
+                else:
+                    report.failures[name] = format_exception(exc)
+        # Look up PubMed IDs of all updated systems together
+        for name, msg in sorted(self.update_pubmed().items()):
+            report.updated.remove(name)
+            report.failures[name] = msg
+        return report
+
+    def get_index_entry(self, name):
+        """Get the information about a single system to be stored in the
+           index, or None if its metadata has not been downloaded yet"""
+        try:
+            with open(self.get_filename(name, 'metadata.yaml'),
+                      encoding='utf-8') as fh:
+                meta = yaml.safe_load(fh)
+            with open(self.get_filename(name, 'github.json'),
+                      encoding='utf-8') as fh:
+                github = json.load(fh)
+        except FileNotFoundError:
+            return None
+        if meta is None:
+            return None
+        try:
+            with open(self.get_filename(name, 'pubmed.json'),
+                      encoding='utf-8') as fh:
+                pubmed_title = format_citation(json.load(fh))
+        except FileNotFoundError:
+            pubmed_title = None
+        return {'metadata': meta,
+                'github': dict((k, github.get(k))
+                               for k in ('description', 'homepage',
+                                         'html_url', 'default_branch')),
+                'pubmed_title': pubmed_title,
+                'tags': meta.get('tags', []),
+                'has_thumbnail':
+                    self.get_filename(name, 'thumb.png').exists()}
+
+    def write_index(self, names):
+        """Write a single index file containing the metadata of all
+           systems, so that the web server need not parse each system's
+           files individually"""
+        index = {}
+        for name in names:
+            entry = self.get_index_entry(name)
+            if entry is not None:
+                index[name] = entry
+        self.write_file_atomic(self.root / 'index.json',
+                               json.dumps(index, sort_keys=True))
+
+
+def format_exception(exc):
+    return ''.join(traceback.format_exception(type(exc), exc,
+                                              exc.__traceback__))
+
+
+def format_citation(pubmed):
+    """Get a short citation from a PubMed esummary JSON response"""
+    pmid = pubmed['result']['uids'][0]
+    ref = pubmed['result'][pmid]
+
+    authors = [x['name'] for x in ref['authors'] if x['authtype'] == 'Author']
+    if len(authors) > 2:
+        citation = ', '.join(authors[:2]) + ' et al.'
+    else:
+        citation = ', '.join(authors) + '.'
+
+    return citation + ' %s %s, %s' % (ref['source'], ref['volume'],
+                                      ref['pubdate'].split()[0])
 
 
 class DatabaseConnection:
@@ -215,12 +880,45 @@ def read_config():
         return json.load(fh)
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Update metadata of all systems from GitHub and PubMed")
+    parser.add_argument("--workers", type=int, default=8,
+                        help="Number of systems to update in parallel "
+                             "(default 8)")
+    parser.add_argument("--per-host", type=int, default=4,
+                        help="Maximum number of simultaneous requests to "
+                             "each web server (default 4)")
+    parser.add_argument("--pubmed-ttl", type=float,
+                        default=PUBMED_CACHE_TTL / 86400.,
+                        help="Number of days for which cached PubMed "
+                             "summaries are used (default %(default)g)")
+    parser.add_argument("--graphql", action="store_true",
+                        help="Get repository information with a few GitHub "
+                             "GraphQL queries rather than several REST API "
+                             "requests per system")
+    return parser.parse_args()
+
+
 def main():
+    args = parse_args()
     config = read_config()
-    u = FileUpdater(root=Path(config['system_top']), auth=config['github'])
+    u = FileUpdater(root=Path(config['system_top']), auth=config['github'],
+                    client=HTTPClient(max_per_host=args.per_host),
+                    github_api=config.get('github_api', GITHUB_API),
+                    eutils_api=config.get('eutils_api', EUTILS_API),
+                    pubmed_ttl=args.pubmed_ttl * 86400.,
+                    github_graphql=config.get('github_graphql'))
     d = DatabaseConnection(config['sql'])
-    for s in d.get_systems():
-        u.update(name=s['name'], repo=s['repo'])
+    systems = [(s['name'], s['repo']) for s in d.get_systems()]
+    report = u.update_all(systems, workers=args.workers,
+                          graphql=args.graphql)
+    # Update the index even if some systems failed, since the others
+    # may have changed
+    u.write_index([name for name, repo in systems])
+    if report.failures:
+        print(report.format(), file=sys.stderr)
+        sys.exit(1)
 
 
 if __name__ == '__main__':